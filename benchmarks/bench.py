@@ -0,0 +1,187 @@
+"""
+Benchmarks eyaml against synthetic configs of a configurable size.
+
+    python benchmarks/bench.py --envs 20 --keys 200 --depth 3 --secrets 50
+
+Each stage is timed best of --repeat runs, then run once more under
+tracemalloc for its peak memory. Results are written as JSON to stdout or
+--output so they can be compared between commits.
+"""
+import os
+import gc
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+
+import click
+
+from eyaml.constants import DEFAULT_VAULT_ID
+from eyaml.django import load_settings_from_config
+from eyaml.processor import SecretYAML
+
+PASSWORD = "benchmark-password"
+
+
+def nested_lines(prefix, keys, depth, indent, secrets=0, required=False):
+    """
+    Lines for a mapping of `keys` keys, every tenth key holding a mapping
+    nested `depth` levels deep, and the first `secrets` keys being !secrets.
+    With required set every tenth plain key is !required instead.
+    """
+    lines = []
+    pad = "  " * indent
+    for k in range(keys):
+        if k < secrets:
+            lines.append(f"{pad}{prefix}_secret_{k}: !secret secret-{prefix}-{k}")
+        elif depth > 1 and k % 10 == 0:
+            lines.append(f"{pad}{prefix}_nested_{k}:")
+            lines.extend(nested_lines(f"{prefix}_{k}", 5, depth - 1, indent + 1))
+        elif required and k % 10 == 7:
+            lines.append(f"{pad}{prefix}_key_{k}: !required")
+        elif k % 10 == 5:
+            lines.append(f"{pad}{prefix}_list_{k}: [a, b, {k}]")
+        else:
+            lines.append(f'{pad}{prefix}_key_{k}: "value {k}"')
+    return lines
+
+
+def generate_config(filepath, envs, keys, depth, secrets):
+    lines = ["version: 1.0", "!default common:"]
+    lines.extend(
+        nested_lines("default", keys, depth, 1, secrets=secrets, required=True)
+    )
+    for e in range(envs):
+        lines.append("")
+        lines.append(f"!env env_{e}:")
+        lines.extend(nested_lines("default", keys // 2, depth, 1, secrets=secrets))
+    with open(filepath, "w") as stream:
+        stream.write("\n".join(lines) + "\n")
+    return filepath
+
+
+def clear_vault_key_cache():
+    # newer ansible-core memoizes derived vault keys, which would hide the
+    # key derivation cost on every run after the first
+    from ansible.parsing.vault import VaultAES256
+
+    cache_clear = getattr(VaultAES256._gen_key_initctr, "cache_clear", None)
+    if cache_clear:
+        cache_clear()
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        setup = func()
+        clear_vault_key_cache()
+        gc.collect()
+        start = time.perf_counter()
+        setup()
+        timings.append(time.perf_counter() - start)
+
+    setup = func()
+    clear_vault_key_cache()
+    gc.collect()
+    tracemalloc.start()
+    setup()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": min(timings),
+        "mean_seconds": sum(timings) / len(timings),
+        "peak_bytes": peak,
+    }
+
+
+def run_benchmarks(envs, keys, depth, secrets, repeat, workers):
+    tmp_dir = tempfile.mkdtemp(prefix="eyaml-bench")
+    plain_path = generate_config(
+        os.path.join(tmp_dir, "plain.yml"), envs, keys, depth, secrets
+    )
+    env = "env_0"
+
+    # an encrypted copy for the decrypt and end to end stages
+    encrypted = SecretYAML(filepath=plain_path)
+    encrypted.encrypt_default(PASSWORD, workers=workers)
+    for env_name in encrypted.env_names:
+        encrypted.encrypt_env(str(env_name), PASSWORD, workers=workers)
+    encrypted_path = os.path.join(tmp_dir, "encrypted.yml")
+    encrypted.save_file(encrypted_path)
+    passwords = {DEFAULT_VAULT_ID: PASSWORD, env: PASSWORD}
+
+    def load(mode):
+        return lambda: lambda: SecretYAML(filepath=plain_path, mode=mode)
+
+    def on_loaded(path, stage):
+        def setup():
+            config = SecretYAML(filepath=path)
+            return lambda: stage(config)
+
+        return setup
+
+    stages = {
+        "load_validate": load("roundtrip"),
+        "load_validate_read_mode": load("read"),
+        "encrypt_env": on_loaded(
+            plain_path, lambda c: c.encrypt_env(env, PASSWORD, workers=workers)
+        ),
+        "decrypt_env": on_loaded(
+            encrypted_path, lambda c: c.decrypt_env(env, PASSWORD, workers=workers)
+        ),
+        "to_dict": on_loaded(plain_path, lambda c: c.to_dict()),
+        "get_env_as_dict": on_loaded(plain_path, lambda c: c.get_env_as_dict(env)),
+        "missing_required_keys": on_loaded(
+            plain_path, lambda c: c.missing_required_keys()
+        ),
+        "save_file": on_loaded(
+            plain_path, lambda c: c.save_file(os.path.join(tmp_dir, "saved.yml"))
+        ),
+        "load_settings_from_config": lambda: lambda: load_settings_from_config(
+            encrypted_path, env, passwords=passwords, workers=workers
+        ),
+    }
+
+    results = {name: measure(stage, repeat) for name, stage in stages.items()}
+    with open(plain_path) as stream:
+        line_count = sum(1 for _ in stream)
+
+    return {
+        "parameters": {
+            "envs": envs,
+            "keys": keys,
+            "depth": depth,
+            "secrets": secrets,
+            "repeat": repeat,
+            "workers": workers,
+            "lines": line_count,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+@click.command()
+@click.option("--envs", default=10, help="Number of !env sections")
+@click.option("--keys", default=100, help="Keys in the default section, envs get half")
+@click.option("--depth", default=2, help="Nesting depth of nested mappings")
+@click.option("--secrets", default=20, help="!secret values per section")
+@click.option("--repeat", default=3, help="Timed runs per stage, the best is reported")
+@click.option("-j", "--jobs", type=int, default=None, help="Worker processes for encrypt/decrypt")
+@click.option("-o", "--output", default=None, help="Write the JSON results to a file")
+def main(envs, keys, depth, secrets, repeat, jobs, output):
+    results = run_benchmarks(envs, keys, depth, secrets, repeat, jobs)
+    report = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as stream:
+            stream.write(report + "\n")
+    click.echo(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,7 @@ import argparse
 from ansible.errors import AnsibleParserError
 from ansible.module_utils.common.text.converters import to_native
 from ansible.plugins.vars import BaseVarsPlugin
+from ansible.utils.display import Display
 from ansible.utils.path import basedir
 from ansible.inventory.group import InventoryObjectType
 from ansible.utils.vars import combine_vars
@@ -37,11 +38,23 @@ from ansible.utils.vars import combine_vars
 from eyaml.django import load_settings_from_config
 from eyaml.utils import flatten_list
 
+display = Display()
+
 CANONICAL_PATHS = {}  # type: dict[str, str]
-FOUND = {}  # type: dict[str, list[str]]
+FOUND = {}  # type: dict[str, dict]
 NAK = set()  # type: set[str]
 PATH_CACHE = {}  # type: dict[tuple[str, str], str]
 
+# the command line does not change during a run, parse it once
+PARSED_ARGS = []  # type: list[argparse.Namespace]
+# decrypted settings, keyed by config and password file signatures and the env
+SETTINGS_CACHE = {}  # type: dict[tuple, dict]
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return os.path.realpath(path), stat.st_mtime_ns, stat.st_size
+
 
 class VarsModule(BaseVarsPlugin):
     allow_extras = True
@@ -56,14 +69,35 @@ class VarsModule(BaseVarsPlugin):
         return data
 
     def parse_args(self):
+        if PARSED_ARGS:
+            return PARSED_ARGS[0]
         parser = argparse.ArgumentParser()
         parser.add_argument("playbook")  # positional argument
         parser.add_argument("-i", "--inventory")  # option that takes a value
         parser.add_argument("-l", "--limit")
         parser.add_argument("--vault-password-file", action="append", nargs="+")
         args, unknown = parser.parse_known_args()
+        PARSED_ARGS.append(args)
         return args
 
+    def load_settings(self, config_file_path, env, vault_password_files):
+        """
+        Decrypts the env at most once per run, unless the config or one of
+        the password files changes on disk.
+        """
+        key = (
+            file_signature(config_file_path),
+            env,
+            tuple(file_signature(path) for path in vault_password_files),
+        )
+        try:
+            return SETTINGS_CACHE[key]
+        except KeyError:
+            SETTINGS_CACHE[key] = settings = load_settings_from_config(
+                config_file_path, env, password_files=vault_password_files
+            )
+            return settings
+
     def get_vars(self, loader, path, entities, cache=True):
         """parses the inventory file"""
 
@@ -76,15 +110,28 @@ class VarsModule(BaseVarsPlugin):
         except KeyError:
             CANONICAL_PATHS[path] = realpath_basedir = os.path.realpath(basedir(path))
 
-        args = self.parse_args()
         config_file_path, origin = self.get_option_and_origin("config_file_path")
-        full_config_file_path = os.path.join(realpath_basedir, config_file_path)
+        try:
+            full_config_file_path = PATH_CACHE[(realpath_basedir, config_file_path)]
+        except KeyError:
+            full_config_file_path = os.path.join(realpath_basedir, config_file_path)
+            PATH_CACHE[(realpath_basedir, config_file_path)] = full_config_file_path
 
         data = {}
 
-        for entity in entities:
-            # print(entity)
+        if full_config_file_path in NAK:
+            return data
+        if not os.path.isfile(full_config_file_path):
+            NAK.add(full_config_file_path)
+            display.warning(
+                "Encrypted config %s not found" % to_native(full_config_file_path)
+            )
+            return data
+
+        args = self.parse_args()
+        vault_password_files = flatten_list(args.vault_password_file or [])
 
+        for entity in entities:
             try:
                 entity_name = entity.name
             except AttributeError:
@@ -101,10 +148,13 @@ class VarsModule(BaseVarsPlugin):
                     % (type(entity))
                 )
 
-        vault_password_files = flatten_list(args.vault_password_file)
-        data = load_settings_from_config(
-            full_config_file_path, args.limit, password_files=vault_password_files
-        )
+            key = "%s.%s" % (entity_name, full_config_file_path)
+            if cache and key in FOUND:
+                entity_data = FOUND[key]
+            else:
+                FOUND[key] = entity_data = self.load_settings(
+                    full_config_file_path, args.limit, vault_password_files
+                )
+            data = combine_vars(data, entity_data)
 
-        breakpoint()
         return data
@@ -0,0 +1,99 @@
+import os
+import hmac
+import json
+import hashlib
+import logging
+import tempfile
+
+from .constants import (
+    CACHE_DIR_NAME,
+    CACHE_KDF_ITERATIONS,
+)
+
+logger = logging.getLogger("eyaml")
+
+
+def hash_file(filepath):
+    with open(filepath, "rb") as stream:
+        return hashlib.sha256(stream.read()).hexdigest()
+
+
+class SettingsCache:
+    """
+    Encrypted on-disk cache of a resolved environment dict.
+
+    Entries are keyed by the sha256 of the config file contents, the env name
+    and a fingerprint of the passwords, and encrypted with AES-GCM under a key
+    derived once from the passwords, so a cache hit skips parsing and the vault.
+    """
+
+    def __init__(self, config_file_path, environment, labelled, unlabelled, cache_dir=None):
+        realpath = os.path.realpath(config_file_path)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(realpath), CACHE_DIR_NAME)
+        self.cache_dir = cache_dir
+
+        content_hash = hash_file(realpath)
+        self.key = self.derive_key(labelled, unlabelled, salt=content_hash)
+        fingerprint = hmac.new(self.key, b"fingerprint", hashlib.sha256).hexdigest()
+
+        # entries for the same file and env share a prefix so stale ones can be pruned
+        self.prefix = hashlib.sha256(f"{realpath}:{environment}".encode()).hexdigest()[:16]
+        entry = hashlib.sha256(f"{content_hash}:{environment}:{fingerprint}".encode())
+        self.filename = f"{self.prefix}-{entry.hexdigest()}.cache"
+        self.path = os.path.join(self.cache_dir, self.filename)
+
+    @staticmethod
+    def derive_key(labelled, unlabelled, salt):
+        material = json.dumps(
+            {"labelled": labelled, "unlabelled": unlabelled}, sort_keys=True
+        ).encode()
+        return hashlib.pbkdf2_hmac(
+            "sha256", material, salt.encode(), CACHE_KDF_ITERATIONS
+        )
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        with open(self.path, "rb") as stream:
+            data = stream.read()
+        try:
+            plaintext = AESGCM(self.key).decrypt(
+                data[:12], data[12:], self.filename.encode()
+            )
+        except (InvalidTag, ValueError):
+            logger.warning(f"Ignoring unreadable settings cache {self.path}")
+            return None
+        logger.debug(f"Loaded settings from cache {self.path}")
+        return json.loads(plaintext)
+
+    def save(self, settings):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        try:
+            plaintext = json.dumps(settings).encode()
+        except TypeError as e:
+            logger.warning(f"Settings can not be cached: {e}")
+            return False
+
+        nonce = os.urandom(12)
+        data = nonce + AESGCM(self.key).encrypt(
+            nonce, plaintext, self.filename.encode()
+        )
+
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as stream:
+            stream.write(data)
+        os.replace(tmp_path, self.path)
+        self.prune()
+        return True
+
+    def prune(self):
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith(self.prefix) and filename != self.filename:
+                os.remove(os.path.join(self.cache_dir, filename))
@@ -0,0 +1,555 @@
+import os
+import re
+import glob
+import pprint
+import subprocess
+from itertools import repeat
+
+from eyaml.tags import SecretString, EncryptedString
+from eyaml.envelope import is_envelope_value
+from eyaml.constants import DEFAULT_VAULT_ID, READ_MODE
+from eyaml.diff import flatten, sections_of
+from eyaml.utils import (
+    run_in_pool,
+    verify_values,
+    password_fingerprint,
+    resolve_password,
+)
+
+ENCRYPT = "encrypt"
+DECRYPT = "decrypt"
+REKEY = "rekey"
+YAML_SUFFIXES = (".yml", ".yaml")
+# a top level !default map, what every eyaml config has
+DEFAULT_MAP_PATTERN = re.compile(r"^!default[ \t]", re.MULTILINE)
+
+MISSING = object()
+
+
+class ConfigResult:
+    """
+    Outcome of processing one config file, returned from worker processes.
+    changed and skipped hold (section, reason) pairs.
+    """
+
+    def __init__(self, filepath, changed=None, skipped=None, error=None, output=None):
+        self.filepath = filepath
+        self.changed = changed or []
+        self.skipped = skipped or []
+        self.error = error
+        self.output = output
+
+
+def read_password_file(password_file):
+    if not os.path.isfile(password_file):
+        raise FileNotFoundError(password_file)
+    with open(password_file, "r") as file:
+        return file.read().strip()
+
+
+def parse_vault_ids(vault_ids):
+    """
+    Parses ansible style LABEL@PASSWORD_FILE options into {label: password}.
+    """
+    passwords = {}
+    for vault_id in vault_ids or []:
+        label, sep, password_file = vault_id.partition("@")
+        if not sep or not label or not password_file:
+            raise ValueError(f"Expected LABEL@PASSWORD_FILE, got {vault_id}")
+        passwords[label] = read_password_file(password_file)
+    return passwords
+
+
+def split_targets(targets):
+    """
+    Splits positional targets into config paths or globs, and env names.
+    Anything that is an existing file or a glob pattern is a config.
+    """
+    patterns, envs = [], []
+    for target in targets:
+        if os.path.isfile(target) or glob.has_magic(target):
+            patterns.append(target)
+        else:
+            envs.append(target)
+    return patterns, envs
+
+
+def expand_configs(patterns):
+    configs = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matches = [pattern]
+        for match in matches:
+            if os.path.isfile(match) and match not in configs:
+                configs.append(match)
+    return configs
+
+
+def git_paths(*args):
+    """The paths git prints for args, relative to the current directory."""
+    toplevel = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    names = subprocess.run(
+        ["git", *args, "-z"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return [
+        os.path.relpath(os.path.join(toplevel, name))
+        for name in names.split("\0")
+        if name
+    ]
+
+
+def staged_files():
+    """
+    Added, copied, modified or renamed files in the git index, as paths
+    relative to the current directory.
+    """
+    return git_paths("diff", "--cached", "--name-only", "--diff-filter=ACMR")
+
+
+def unstaged_files():
+    """Files whose working tree differs from the git index."""
+    return git_paths("diff", "--name-only")
+
+
+def partially_staged(configs):
+    """The configs with changes that are not staged."""
+    unstaged = {os.path.realpath(path) for path in unstaged_files()}
+    return [path for path in configs if os.path.realpath(path) in unstaged]
+
+
+def stage_files(paths):
+    """Adds the written files to the git index again."""
+    if paths:
+        subprocess.run(["git", "add", "--", *paths], check=True)
+
+
+def read_staged(path):
+    """The contents of path in the git index."""
+    content, _ = read_config_source(f":./{os.path.relpath(path)}")
+    return content
+
+
+def read_config_source(source, path=None):
+    """
+    The contents of one version of a config, source being a file, REV:PATH
+    for the file at a git revision, or a bare revision of path. Returns the
+    contents and the path a bare revision of the other version refers to.
+    """
+    if os.path.isfile(source):
+        with open(source, "r") as stream:
+            # ./ makes git resolve the path from the current directory
+            return stream.read(), f"./{os.path.relpath(source)}"
+
+    revision, sep, rev_path = source.partition(":")
+    if not sep:
+        if path is None:
+            raise FileNotFoundError(source)
+        revision, rev_path = source, path
+    shown = subprocess.run(
+        ["git", "show", f"{revision}:{rev_path}"],
+        capture_output=True,
+        text=True,
+    )
+    if shown.returncode != 0:
+        raise ValueError(f"Could not read {revision}:{rev_path}, {shown.stderr.strip()}")
+    return shown.stdout, rev_path
+
+
+def is_eyaml_config(path):
+    """
+    Whether path has a top level !default map. Read as text rather than
+    parsed, other yaml files may use tags eyaml does not know.
+    """
+    try:
+        with open(path, "r") as stream:
+            return DEFAULT_MAP_PATTERN.search(stream.read()) is not None
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def select_staged(configs, staged):
+    """
+    The staged files among configs, or every staged eyaml config when no
+    configs were given, and the staged yaml files which are not eyaml
+    configs, e.g. docker-compose.yml, to report as skipped.
+    """
+    if not configs:
+        yaml_files = [path for path in staged if path.endswith(YAML_SUFFIXES)]
+        selected = [path for path in yaml_files if is_eyaml_config(path)]
+        return selected, [path for path in yaml_files if path not in selected]
+    staged = {os.path.realpath(path) for path in staged}
+    return [path for path in configs if os.path.realpath(path) in staged], []
+
+
+def load_committed(filepath, metrics=None):
+    """
+    The config as committed at HEAD of the git repository holding filepath,
+    None outside git, for a file that was never committed or one that does
+    not parse.
+    """
+    from eyaml.processor import SecretYAML
+
+    try:
+        shown = subprocess.run(
+            ["git", "show", f"HEAD:./{os.path.basename(filepath)}"],
+            cwd=os.path.dirname(os.path.abspath(filepath)),
+            capture_output=True,
+            text=True,
+        )
+        if shown.returncode != 0:
+            return None
+        config = SecretYAML(mode=READ_MODE, metrics=metrics)
+        config.filepath = filepath
+        config.load_string(shown.stdout)
+    except Exception:
+        # nothing is reused, every secret is encrypted again
+        return None
+    return config
+
+
+def restore_origins(config, committed, section, password, workers=None):
+    """
+    Gives the !secret values of section which hold the plaintext of the
+    committed ciphertext at the same key path that ciphertext as their
+    origin, so encrypt_walk writes it back instead of encrypting again and
+    decrypting, editing and encrypting a file in separate runs only changes
+    the edited values. Returns the number of restored values.
+
+    Only committed values whose key holds a !secret in the working tree are
+    decrypted, as one batch across `workers` processes.
+    """
+    secrets = {
+        path: value
+        for path, value in flatten(config.env(section)).items()
+        if isinstance(value, SecretString) and value.origin is None
+    }
+    committed_section = sections_of(committed).get(section) if committed else None
+    if not secrets or committed_section is None:
+        return 0
+
+    # envelope values only decrypt with the data key they were encrypted with
+    same_data_key = config.keyring.wrapped_keys.get(section) is not None and (
+        config.keyring.wrapped_keys.get(section)
+        == committed.keyring.wrapped_keys.get(section)
+    )
+    candidates = []
+    for path, tag in flatten(committed_section).items():
+        if (
+            path in secrets
+            and isinstance(tag, EncryptedString)
+            and (same_data_key or not is_envelope_value(tag.value))
+        ):
+            candidates.append((secrets[path], tag))
+    plaintexts = committed.decrypt_tags(
+        [tag for _, tag in candidates],
+        password,
+        raise_exception=False,
+        workers=workers,
+        vault_id=section,
+    )
+
+    restored = 0
+    for (secret, tag), plaintext in zip(candidates, plaintexts):
+        if plaintext is not None and plaintext == secret.value:
+            secret.origin = (
+                tag.value,
+                plaintext,
+                password_fingerprint(
+                    tag.value, resolve_password(tag.value, password, vault_id=section)
+                ),
+            )
+            restored += 1
+    return restored
+
+
+def section_names(config, envs, all_envs):
+    if all_envs:
+        return [DEFAULT_VAULT_ID] + [str(name) for name in config.env_names]
+    return list(envs) or [DEFAULT_VAULT_ID]
+
+
+def process_config(
+    filepath,
+    action,
+    envs,
+    passwords,
+    password=None,
+    all_envs=False,
+    dryrun=False,
+    verbose=False,
+    workers=None,
+    metrics=None,
+    new_passwords=None,
+    new_password=None,
+):
+    """
+    Encrypts, decrypts or rekeys the given sections of one config, "default"
+    being the !default section. Sections already in the target state are
+    skipped and the file is only written, once, when a section changed.
+    Secrets encrypted again keep their ciphertext committed at git HEAD
+    when their plaintext and password did not change.
+
+    passwords maps section names to passwords, password is used for sections
+    without one. new_passwords and new_password are the passwords to rekey to.
+    """
+    from eyaml.processor import SecretYAML
+
+    result = ConfigResult(filepath)
+    committed = MISSING
+    try:
+        config = SecretYAML(filepath=filepath, metrics=metrics)
+        for section in section_names(config, envs, all_envs):
+            defined = section in config.tag_index.envs_by_name
+            if section != DEFAULT_VAULT_ID and not defined:
+                result.skipped.append((section, "not defined"))
+                continue
+
+            node = config.env(section)
+            if action == ENCRYPT and config.has_no_secret_tags(node):
+                result.skipped.append((section, "already encrypted"))
+                continue
+            if action == DECRYPT and config.has_not_encrypted_tags(node):
+                result.skipped.append((section, "already decrypted"))
+                continue
+            if (
+                action == REKEY
+                and config.has_not_encrypted_tags(node)
+                and section not in config.keyring.wrapped_keys
+            ):
+                result.skipped.append((section, "nothing encrypted"))
+                continue
+
+            section_password = passwords.get(section, password)
+            if section_password is None:
+                raise ValueError(f"No password given for {section}")
+
+            if action == REKEY:
+                section_new_password = (new_passwords or {}).get(section, new_password)
+                if section_new_password is None:
+                    raise ValueError(f"No new password given for {section}")
+                config.rekey_walk(
+                    node,
+                    section_password,
+                    section_new_password,
+                    workers=workers,
+                    vault_id=section,
+                )
+                result.changed.append((section, "rekeyed"))
+                continue
+
+            if action == ENCRYPT:
+                if committed is MISSING:
+                    committed = load_committed(filepath, metrics=metrics)
+                restore_origins(
+                    config, committed, section, section_password, workers=workers
+                )
+                config.encrypt_walk(
+                    node, section_password, workers=workers, vault_id=section
+                )
+            else:
+                config.decrypt_walk(
+                    node, section_password, workers=workers, vault_id=section
+                )
+            result.changed.append((section, action + "ed"))
+
+        if result.changed and not dryrun:
+            config.save_file()
+        if verbose:
+            result.output = pprint.pformat(config.to_dict(), indent=4, width=1)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def process_configs(
+    configs,
+    action,
+    envs,
+    passwords,
+    password=None,
+    all_envs=False,
+    dryrun=False,
+    verbose=False,
+    workers=None,
+    metrics=None,
+    new_passwords=None,
+    new_password=None,
+):
+    """
+    Processes many configs in one process. With several files the workers
+    are spread across files and each file's values are processed serially,
+    a single file fans its values out across the workers instead.
+    """
+    if len(configs) > 1 and workers and workers > 1:
+        # metrics collected in worker processes would be lost
+        return run_in_pool(
+            process_config,
+            configs,
+            repeat(action, len(configs)),
+            repeat(envs, len(configs)),
+            repeat(passwords, len(configs)),
+            repeat(password, len(configs)),
+            repeat(all_envs, len(configs)),
+            repeat(dryrun, len(configs)),
+            repeat(verbose, len(configs)),
+            repeat(None, len(configs)),
+            repeat(None, len(configs)),
+            repeat(new_passwords, len(configs)),
+            repeat(new_password, len(configs)),
+            workers=workers,
+        )
+    return [
+        process_config(
+            filepath,
+            action,
+            envs,
+            passwords,
+            password=password,
+            all_envs=all_envs,
+            dryrun=dryrun,
+            verbose=verbose,
+            workers=workers,
+            metrics=metrics,
+            new_passwords=new_passwords,
+            new_password=new_password,
+        )
+        for filepath in configs
+    ]
+
+
+class SectionReport:
+    """
+    Verification outcome of one section of a config, problems is empty when
+    every check passed.
+    """
+
+    def __init__(self, section):
+        self.section = section
+        self.encrypted = 0
+        self.problems = []
+
+    @property
+    def ok(self):
+        return not self.problems
+
+
+class VerifyResult:
+    def __init__(self, filepath, sections=None, error=None):
+        self.filepath = filepath
+        self.sections = sections or []
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and all(report.ok for report in self.sections)
+
+
+def verify_configs(
+    configs, envs, passwords, password=None, workers=None, metrics=None, staged=False
+):
+    """
+    Checks that every !encrypted value of the given sections, or of every
+    section when no envs are given, decrypts with its password, that no
+    !secret plaintext is left and that every env defines the !required keys
+    of the default section. Files are only read, never written. With staged
+    set the contents in the git index are checked, which is what gets
+    committed, rather than the working tree.
+
+    The ansible vault values of all files are checked in a single pool, the
+    workers only hand back whether a value decrypted. Envelope values need
+    one key unwrap per env and are checked in process.
+    """
+    from eyaml.processor import SecretYAML
+
+    results = []
+    values, value_passwords, vault_ids, checks = [], [], [], []
+    failed = {}
+    for filepath in configs:
+        result = VerifyResult(filepath)
+        results.append(result)
+        try:
+            if staged:
+                config = SecretYAML(mode=READ_MODE, metrics=metrics)
+                config.filepath = filepath
+                config.load_string(read_staged(filepath))
+            else:
+                config = SecretYAML(filepath=filepath, mode=READ_MODE, metrics=metrics)
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"
+            continue
+
+        sections = section_names(config, envs, not envs)
+        # every !required key against every env in one pass over the file
+        missing = config.missing_required_keys(
+            [name for name in sections if name in config.tag_index.envs_by_name]
+        )
+        for section in sections:
+            report = SectionReport(section)
+            result.sections.append(report)
+            defined = section in config.tag_index.envs_by_name
+            if section != DEFAULT_VAULT_ID and not defined:
+                report.problems.append("not defined")
+                continue
+            if section in missing:
+                report.problems.append(
+                    f"missing required key(s): {', '.join(missing[section])}"
+                )
+
+            node = config.env(section)
+            secrets = config.collect_tags_of_type(node, SecretString)
+            if secrets:
+                report.problems.append(
+                    f"{len(secrets)} !secret value(s) left unencrypted"
+                )
+
+            encrypted = config.collect_tags_of_type(node, EncryptedString)
+            report.encrypted = len(encrypted)
+            if not encrypted:
+                continue
+            section_password = passwords.get(section, password)
+            if section_password is None:
+                report.problems.append("no password given")
+                continue
+
+            for _, _, tag in encrypted:
+                if not is_envelope_value(tag.value):
+                    values.append(tag.value)
+                    value_passwords.append(section_password)
+                    vault_ids.append(section)
+                    checks.append(report)
+                elif (
+                    config.keyring.decrypt_value(
+                        tag.value,
+                        section_password,
+                        tag,
+                        raise_exception=False,
+                        vault_id=section,
+                    )
+                    is None
+                ):
+                    failed[id(report)] = failed.get(id(report), 0) + 1
+
+    decrypted = verify_values(
+        values, value_passwords, workers=workers, vault_ids=vault_ids
+    )
+    for report, ok in zip(checks, decrypted):
+        if not ok:
+            failed[id(report)] = failed.get(id(report), 0) + 1
+
+    for result in results:
+        for report in result.sections:
+            if id(report) in failed:
+                report.problems.append(
+                    f"{failed[id(report)]} value(s) failed to decrypt"
+                )
+    return results
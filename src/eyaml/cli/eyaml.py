@@ -5,89 +5,234 @@ import pprint
 
 import click
 
-from eyaml.processor import SecretYAML
+from eyaml import compiled
+from eyaml.django import compile_settings_from_config
+from eyaml.constants import READ_MODE, SECRET_MASK
+from eyaml.instrumentation import ProfileCollector
+from eyaml.cli.bulk import (
+    ENCRYPT,
+    DECRYPT,
+    REKEY,
+    read_password_file,
+    parse_vault_ids,
+    read_config_source,
+    split_targets,
+    expand_configs,
+    staged_files,
+    select_staged,
+    partially_staged,
+    stage_files,
+    process_configs,
+    verify_configs,
+)
 
 logger = logging.getLogger(__name__)
 logger.level = logging.INFO
 
 @click.group()
-def main():
-    pass
+@click.option('--profile', is_flag=True, default=False, help='Print a per phase timing breakdown to stderr')
+@click.pass_context
+def main(ctx, profile):
+    ctx.ensure_object(dict)
+    ctx.obj["metrics"] = None
+    if profile:
+        metrics = ProfileCollector()
+        ctx.obj["metrics"] = metrics
+        ctx.call_on_close(lambda: click.echo(metrics.report(), err=True))
 
-@click.command(context_settings=dict(
-    ignore_unknown_options=True,
-))
-@click.argument('config')
-@click.argument('env', default="default")
-@click.option('-p', '--password',  help='password for specified env, you can specify it multiple times')
-@click.option('-pf', '--password-file',  help='password file for specified env, you can specify it multiple times')
-@click.option('--dryrun', is_flag=True, default=False, help='Dry run verbose mode')
-@click.option('-v', '--verbose', is_flag=True, default=False, help='Enables verbose mode')
-def encrypt(config, env, password, password_file, dryrun, verbose):
-    if password_file:
-        if not os.path.isfile(pf):
-            raise FileNotFoundError(pf)
-        with open(pf, "r") as file:
-            password = file.read().strip()
 
-    if not os.path.isfile(config):
-        raise FileNotFoundError(configg)
+def get_metrics():
+    ctx = click.get_current_context(silent=True)
+    if ctx is None or not isinstance(ctx.obj, dict):
+        return None
+    return ctx.obj.get("metrics")
 
-    config = SecretYAML(filepath=config)
-    if env == "default":
-        config.encrypt_default(password)
-    else:
-        config.encrypt_env(env, password)
-
-    if not dryrun:
-        config.save_file()
-        click.echo(f"Encrypted {env} in {config}")
-        output = pprint.pformat(config.to_dict(), indent=4, width=1)
-        if verbose:
-            click.echo(output)
-    else:
-        output = pprint.pformat(config.to_dict(), indent=4, width=1)
-        click.echo(f"[dry-run] Encrypted {env} in {config}")
-        if verbose:
-            click.echo(output)
+def bulk_options(func):
+    options = [
+        click.argument('targets', nargs=-1),
+        click.option('-e', '--env', 'envs', multiple=True, help='Env to process, "default" is the !default section, can be given multiple times'),
+        click.option('--all-envs', is_flag=True, default=False, help='Process the !default section and every !env'),
+        click.option('--staged', is_flag=True, default=False, help='Only process config files staged in the git index'),
+        click.option('-p', '--password', help='Password for envs without a --vault-id'),
+        click.option('-pf', '--password-file', help='Password file for envs without a --vault-id'),
+        click.option('--vault-id', 'vault_ids', multiple=True, help='Password file of one env as ENV@PASSWORD_FILE, can be given multiple times'),
+        click.option('-j', '--jobs', type=int, default=None, help='Number of worker processes, spread across files when given several'),
+        click.option('--dryrun', is_flag=True, default=False, help='Dry run verbose mode'),
+        click.option('-v', '--verbose', is_flag=True, default=False, help='Enables verbose mode'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
 
 
-@click.command(context_settings=dict(
-    ignore_unknown_options=True,
-))
-@click.argument('config')
-@click.argument('env', default="default")
-@click.option('-p', '--password',  help='password for specified env')
-@click.option('-pf', '--password-file',  help='password file for specified env')
-@click.option('--dryrun', is_flag=True, default=False, help='Dry run verbose mode')
-@click.option('-v', '--verbose', is_flag=True, default=False, help='Enables verbose mode')
-def decrypt(config, env, password, password_file, dryrun, verbose):
+def collect_bulk_args(targets, envs, staged, password, password_file, vault_ids):
+    """
+    Resolves targets, config paths or globs followed by env names, into the
+    config files and envs to process, and reads the passwords.
+    """
+    patterns, env_names = split_targets(targets)
+    envs = list(envs) + env_names
+    configs = expand_configs(patterns)
+    if staged:
+        configs, ignored = select_staged(configs, staged_files())
+        for path in ignored:
+            click.echo(f"Skipped {path}, not an eyaml config")
+    elif not configs:
+        raise click.UsageError("No config files given")
+
     if password_file:
-        if not os.path.isfile(password_file):
-            raise FileNotFoundError(password_filee)
-        with open(password_file, "r") as file:
-            password = file.read().strip()
+        password = read_password_file(password_file)
+    try:
+        passwords = parse_vault_ids(vault_ids)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--vault-id')
+    return configs, envs, passwords, password
+
+
+def run_bulk(action, targets, envs, all_envs, staged, password, password_file, vault_ids, jobs, dryrun, verbose):
+    """
+    Encrypts or decrypts envs across every config matched by targets, which
+    are config paths or globs followed by env names, e.g.
+    eyaml encrypt 'services/*/config.yml' dev stage
+    """
+    configs, envs, passwords, password = collect_bulk_args(
+        targets, envs, staged, password, password_file, vault_ids
+    )
+    if staged:
+        # staging the written file would also stage the unstaged changes
+        partial = partially_staged(configs)
+        if partial:
+            raise click.UsageError(
+                f"Unstaged changes in {', '.join(partial)}, stage or stash them first"
+            )
+    results = process_configs(
+        configs,
+        action,
+        envs,
+        passwords,
+        password=password,
+        all_envs=all_envs,
+        dryrun=dryrun,
+        verbose=verbose,
+        workers=jobs,
+        metrics=get_metrics(),
+    )
+    if staged and not dryrun:
+        stage_files(
+            [result.filepath for result in results if result.changed and not result.error]
+        )
+    report_results(action, results, dryrun)
+
+
+def report_results(action, results, dryrun):
+    prefix = "[dry-run] " if dryrun else ""
+    failed = False
+    for result in results:
+        if result.error:
+            failed = True
+            click.echo(f"Error in {result.filepath}: {result.error}", err=True)
+            continue
+        if result.changed:
+            sections = ", ".join(section for section, _ in result.changed)
+            click.echo(f"{prefix}{action.capitalize()}ed {sections} in {result.filepath}")
+        for section, reason in result.skipped:
+            click.echo(f"Skipped {section} in {result.filepath}, {reason}")
+        if result.output:
+            click.echo(result.output)
+    if failed:
+        sys.exit(1)
+
+
+@click.command()
+@bulk_options
+def encrypt(**kwargs):
+    run_bulk(ENCRYPT, **kwargs)
+
+
+@click.command()
+@bulk_options
+def decrypt(**kwargs):
+    run_bulk(DECRYPT, **kwargs)
 
+
+@click.command()
+@click.argument('targets', nargs=-1)
+@click.option('-e', '--env', 'envs', multiple=True, help='Env to rekey, "default" is the !default section, can be given multiple times')
+@click.option('--all-envs', is_flag=True, default=False, help='Rekey the !default section and every !env')
+@click.option('--old-password-file', help='Current password file for envs without an --old-vault-id')
+@click.option('--new-password-file', help='New password file for envs without a --new-vault-id')
+@click.option('--old-vault-id', 'old_vault_ids', multiple=True, help='Current password file of one env as ENV@PASSWORD_FILE')
+@click.option('--new-vault-id', 'new_vault_ids', multiple=True, help='New password file of one env as ENV@PASSWORD_FILE')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of worker processes used to re-encrypt secrets')
+@click.option('--dryrun', is_flag=True, default=False, help='Rekey in memory without writing the files')
+def rekey(targets, envs, all_envs, old_password_file, new_password_file, old_vault_ids, new_vault_ids, jobs, dryrun):
+    """
+    Re-encrypts envs from their old to their new password in memory, writing
+    each file once, the plaintext never touches the disk.
+    """
+    configs, envs, old_passwords, old_password = collect_bulk_args(
+        targets, envs, False, None, old_password_file, old_vault_ids
+    )
+    new_password = read_password_file(new_password_file) if new_password_file else None
+    try:
+        new_passwords = parse_vault_ids(new_vault_ids)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--new-vault-id')
+
+    results = process_configs(
+        configs,
+        REKEY,
+        envs,
+        old_passwords,
+        password=old_password,
+        all_envs=all_envs,
+        dryrun=dryrun,
+        workers=jobs,
+        metrics=get_metrics(),
+        new_passwords=new_passwords,
+        new_password=new_password,
+    )
+    report_results(REKEY, results, dryrun)
+
+
+@click.command(name='compile')
+@click.argument('config')
+@click.argument('env')
+@click.option('-k', '--key-file', required=True, help='Key file the secrets are encrypted with, a new key is generated when it does not exist')
+@click.option('-o', '--output', default=None, help='Artifact path, defaults to CONFIG_NAME.ENV.json next to the config')
+@click.option('-p', '--password', help='Password for every env, when no --vault-id is given')
+@click.option('-pf', '--password-file', help='Password file for every env, when no --vault-id is given')
+@click.option('--vault-id', 'vault_ids', multiple=True, help='Password file of one env as ENV@PASSWORD_FILE, can be given multiple times')
+def compile_env(config, env, key_file, output, password, password_file, vault_ids):
+    """
+    Resolves ENV into a JSON artifact that eyaml.django.load_compiled_settings
+    loads without ruamel or ansible, secrets stay encrypted under the key.
+    """
     if not os.path.isfile(config):
         raise FileNotFoundError(config)
+    if password_file:
+        password = read_password_file(password_file)
+    try:
+        passwords = parse_vault_ids(vault_ids) or None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--vault-id')
+    if passwords is None and password:
+        passwords = [password]
 
-    config = SecretYAML(filepath=config)
-    if env == "default":
-        config.decrypt_default(password)
+    if os.path.isfile(key_file):
+        key = compiled.read_key_file(key_file)
     else:
-        config.decrypt_env(env, password)
+        key = compiled.generate_key()
+        compiled.write_key_file(key_file, key)
+        click.echo(f"Generated a new key in {key_file}")
 
-    if not dryrun:
-        config.save_file()
-        output = pprint.pformat(config.to_dict(), indent=4, width=1)
-        click.echo(f"Decrypted {env} in {config}")
-        if verbose:
-            click.echo(output)
-    else:
-        output = pprint.pformat(config.to_dict(), indent=4, width=1)
-        if verbose:
-            click.echo(output)
-        click.echo(f"[dry-run] Decrypted {env} in {config}")
+    if output is None:
+        output = f"{os.path.splitext(config)[0]}.{env}.json"
+    artifact = compile_settings_from_config(
+        config, env, key, passwords=passwords
+    )
+    compiled.write_compiled_settings(output, artifact)
+    click.echo(f"Compiled {env} of {config} to {output}")
 
 
 @click.command(context_settings=dict(
@@ -95,6 +240,8 @@ def decrypt(config, env, password, password_file, dryrun, verbose):
 ))
 @click.argument('config')
 def dump():
+    from eyaml.processor import SecretYAML
+
     password = None
     if args.password:
         password = args.password
@@ -122,15 +269,121 @@ def dump():
         config.decrypt_env(env, password)
         pp.pprint(config.get_env_as_dict(env))
 
-@click.command(context_settings=dict(
-    ignore_unknown_options=True,
-))
-@click.argument('config')
-def verify():
-    pass
+@click.command()
+@click.argument('targets', nargs=-1)
+@click.option('-e', '--env', 'envs', multiple=True, help='Env to verify, every env when not given, can be given multiple times')
+@click.option('--staged', is_flag=True, default=False, help='Only verify config files staged in the git index')
+@click.option('-p', '--password', help='Password for envs without a --vault-id')
+@click.option('-pf', '--password-file', help='Password file for envs without a --vault-id')
+@click.option('--vault-id', 'vault_ids', multiple=True, help='Password file of one env as ENV@PASSWORD_FILE, can be given multiple times')
+@click.option('-j', '--jobs', type=int, default=None, help='Number of worker processes used to check the values')
+def verify(targets, envs, staged, password, password_file, vault_ids, jobs):
+    """
+    Checks that every !encrypted value decrypts with the given passwords, no
+    !secret is left unencrypted and every env defines the !required keys of
+    the default section, without writing any file. Exits non-zero when any
+    check fails.
+    """
+    configs, envs, passwords, password = collect_bulk_args(
+        targets, envs, staged, password, password_file, vault_ids
+    )
+    results = verify_configs(
+        configs,
+        envs,
+        passwords,
+        password=password,
+        workers=jobs,
+        metrics=get_metrics(),
+        staged=staged,
+    )
+
+    for result in results:
+        click.echo(f"{result.filepath}: {'ok' if result.ok else 'FAILED'}")
+        if result.error:
+            click.echo(f"  {result.error}")
+        for report in result.sections:
+            status = "; ".join(report.problems) or "ok"
+            click.echo(f"  {report.section}: {report.encrypted} encrypted, {status}")
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
+
+@click.command()
+@click.argument('old')
+@click.argument('new')
+@click.argument('envs', nargs=-1)
+@click.option('-p', '--password', help='Password for envs without a --vault-id')
+@click.option('-pf', '--password-file', help='Password file for envs without a --vault-id')
+@click.option('--vault-id', 'vault_ids', multiple=True, help='Password file of one env as ENV@PASSWORD_FILE, can be given multiple times')
+@click.option('--show-secrets', is_flag=True, default=False, help='Print secret values instead of masking them')
+def diff(old, new, envs, password, password_file, vault_ids, show_secrets):
+    """
+    Shows the keys added, removed or changed between two versions of a
+    config, of ENVS or every env. OLD and NEW are files or git revisions as
+    REV:PATH, OLD may also be a bare revision of NEW, e.g.
+    eyaml diff HEAD config.yml dev
+
+    Ciphertexts are compared first and only values whose ciphertext differs
+    are decrypted, when passwords are given. Exits 1 when the versions differ.
+    """
+    from eyaml.processor import SecretYAML
+    from eyaml.diff import diff_configs, ADDED, REMOVED, REENCRYPTED
+
+    try:
+        new_content, new_path = read_config_source(new)
+        old_content, _ = read_config_source(old, new_path)
+    except FileNotFoundError as e:
+        raise click.BadParameter(f"{e} is neither a file nor REV:PATH")
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    if password_file:
+        password = read_password_file(password_file)
+    try:
+        passwords = parse_vault_ids(vault_ids)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--vault-id')
+
+    configs = []
+    for content in (old_content, new_content):
+        config = SecretYAML(mode=READ_MODE, metrics=get_metrics())
+        config.load_string(content)
+        configs.append(config)
+    changes = diff_configs(
+        *configs,
+        sections=list(envs),
+        passwords=passwords,
+        password=password,
+        reveal=show_secrets,
+    )
+
+    def show(value, secret):
+        if secret and not show_secrets:
+            return SECRET_MASK
+        return "<encrypted>" if secret and value is None else repr(value)
+
+    section = None
+    for change in changes:
+        if change.section != section:
+            section = change.section
+            click.echo(section)
+        if change.kind == ADDED:
+            click.echo(f"  + {change.path}: {show(change.new, change.secret)}")
+        elif change.kind == REMOVED:
+            click.echo(f"  - {change.path}: {show(change.old, change.secret)}")
+        elif change.kind == REENCRYPTED:
+            click.echo(f"  = {change.path}: re-encrypted, value unchanged")
+        else:
+            click.echo(
+                f"  ~ {change.path}: {show(change.old, change.secret)} -> {show(change.new, change.secret)}"
+            )
+    if any(change.kind != REENCRYPTED for change in changes):
+        sys.exit(1)
 
 
 main.add_command(encrypt)
 main.add_command(decrypt)
 main.add_command(verify)
+main.add_command(rekey)
+main.add_command(compile_env)
+main.add_command(diff)
 main.add_command(dump)
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""
+Compiled settings artifacts, an env resolved ahead of time into JSON so it
+can be loaded at boot without ruamel or ansible.
+
+Secrets stay encrypted in the artifact under a single key read from a key
+file, with AES-GCM and the key path of each value as associated data, so a
+secret can not be moved to another key of the artifact.
+"""
+import os
+import json
+import base64
+import tempfile
+
+from .constants import (
+    COMPILED_FORMAT_VERSION,
+    COMPILED_SECRET_KEY,
+    COMPILED_KEY_LENGTH,
+)
+from .exceptions import CompiledSettingsError
+
+NONCE_LENGTH = 12
+
+
+def generate_key():
+    return os.urandom(COMPILED_KEY_LENGTH)
+
+
+def write_key_file(key_file, key):
+    """Writes key hex encoded, readable by the owner only."""
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as stream:
+        stream.write(key.hex() + "\n")
+
+
+def read_key_file(key_file):
+    if not os.path.isfile(key_file):
+        raise FileNotFoundError(f"{key_file} found not be found")
+    with open(key_file, "r") as stream:
+        try:
+            key = bytes.fromhex(stream.read().strip())
+        except ValueError as e:
+            raise CompiledSettingsError(f"{key_file} is not a hex encoded key") from e
+    if len(key) != COMPILED_KEY_LENGTH:
+        raise CompiledSettingsError(
+            f"{key_file} must hold a {COMPILED_KEY_LENGTH} byte key"
+        )
+    return key
+
+
+def encrypt_secret(value, key, path):
+    """
+    Encrypts value bound to its key path, so it can not be moved to another
+    key of the artifact.
+    """
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    nonce = os.urandom(NONCE_LENGTH)
+    ciphertext = AESGCM(key).encrypt(nonce, value.encode(), path.encode())
+    return base64.b64encode(nonce + ciphertext).decode()
+
+
+def decrypt_secret(token, key, path):
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    token = base64.b64decode(token.encode(), validate=True)
+    try:
+        plaintext = AESGCM(key).decrypt(
+            token[:NONCE_LENGTH], token[NONCE_LENGTH:], path.encode()
+        )
+    except InvalidTag as e:
+        raise CompiledSettingsError(f"Could not decrypt {path}, wrong key") from e
+    return plaintext.decode()
+
+
+def _encode(value, key, path, is_secret):
+    if isinstance(value, dict):
+        return {
+            f"{k}": _encode(v, key, f"{path}.{k}" if path else f"{k}", is_secret)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [
+            _encode(item, key, f"{path}[{i}]", is_secret)
+            for i, item in enumerate(value)
+        ]
+    if is_secret(value):
+        return {COMPILED_SECRET_KEY: encrypt_secret(str(value), key, path)}
+    return value
+
+
+def _decode(value, key, path):
+    if isinstance(value, dict):
+        if len(value) == 1 and COMPILED_SECRET_KEY in value:
+            return decrypt_secret(value[COMPILED_SECRET_KEY], key, path)
+        return {
+            k: _decode(v, key, f"{path}.{k}" if path else k) for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [_decode(item, key, f"{path}[{i}]") for i, item in enumerate(value)]
+    return value
+
+
+def compile_settings(settings, key, environment, is_secret, source_hash=None):
+    """
+    The artifact for settings as a JSON serialisable dict, values for which
+    is_secret is true are encrypted under key.
+    """
+    return {
+        "format": COMPILED_FORMAT_VERSION,
+        "environment": environment,
+        "source_sha256": source_hash,
+        "settings": _encode(settings, key, "", is_secret),
+    }
+
+
+def write_compiled_settings(filepath, artifact):
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".eyaml-compiled")
+    try:
+        with os.fdopen(fd, "w") as stream:
+            json.dump(artifact, stream, separators=(",", ":"))
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        # no half written temporary files left next to the artifact
+        os.unlink(tmp_path)
+        raise
+
+
+def load_compiled_settings(filepath, key):
+    """The settings stored in a compiled artifact, secrets decrypted."""
+    with open(filepath, "r") as stream:
+        artifact = json.load(stream)
+    if artifact.get("format") != COMPILED_FORMAT_VERSION:
+        raise CompiledSettingsError(
+            f"Unsupported compiled settings format: {artifact.get('format')}"
+        )
+    return _decode(artifact["settings"], key, "")
@@ -2,8 +2,56 @@ CONTAINS_ENCRYPTED_TAGS = "yaml contains encrypted tags"
 CONTAINS_UNENCRYPTED_TAGS = "yaml contains unencrypted tags"
 
 
+# SecretYAML load modes, read mode skips ruamel round trip construction
+ROUND_TRIP_MODE = "roundtrip"
+READ_MODE = "read"
+
+VALID_MODES = [ROUND_TRIP_MODE, READ_MODE]
+
+# vault-id label used for values encrypted in the !default section
+DEFAULT_VAULT_ID = "default"
+
 ANSIBLE_VAULT_ENCRYPTION_METHOD = 'ansible-vault'
+ENVELOPE_ENCRYPTION_METHOD = 'envelope'
 
 VALID_ENCRYPTION_METHODS = [
-    ANSIBLE_VAULT_ENCRYPTION_METHOD
-]
\ No newline at end of file
+    ANSIBLE_VAULT_ENCRYPTION_METHOD,
+    ENVELOPE_ENCRYPTION_METHOD,
+]
+
+# reserved key in an !env naming the env it inherits from, instead of !default
+EXTENDS_KEY = "__extends__"
+
+# envelope encryption, one wrapped data key per env stored under ENCRYPTION_KEYS_KEY
+ENCRYPTION_KEYS_KEY = "encryption_keys"
+ENVELOPE_VALUE_HEADER = "$EYAML_ENVELOPE"
+ENVELOPE_KEY_HEADER = "$EYAML_KEY"
+ENVELOPE_VERSION = "1.0"
+ENVELOPE_KDF_ITERATIONS = 600_000
+
+# resolved settings cache
+CACHE_DIR_NAME = ".eyaml_cache"
+CACHE_KDF_ITERATIONS = 100_000
+
+# compiled settings artifacts, see eyaml.compiled
+COMPILED_FORMAT_VERSION = 2
+COMPILED_SECRET_KEY = "$eyaml_secret"
+COMPILED_KEY_LENGTH = 32
+
+# how a key present in several layers of a LayeredMapping is combined
+MERGE_STRATEGY = "merge"
+REPLACE_STRATEGY = "replace"
+APPEND_STRATEGY = "append"
+
+VALID_MERGE_STRATEGIES = [
+    MERGE_STRATEGY,
+    REPLACE_STRATEGY,
+    APPEND_STRATEGY,
+]
+
+# environment variable overrides, see eyaml.environ_helper
+ENV_FILE_NAME = ".env"
+ENV_NESTING_SEPARATOR = "__"
+
+# printed in place of secret values, see eyaml diff
+SECRET_MASK = "******"
@@ -0,0 +1,155 @@
+"""
+Key path level diff of two versions of a config.
+
+Values are compared section by section, the ciphertexts of !encrypted values
+first: an unchanged ciphertext is an unchanged value and is never decrypted.
+Only values whose ciphertext differs are decrypted, to tell a changed secret
+from one that was merely encrypted again, so the decryption cost grows with
+the number of changed secrets rather than the size of the file.
+"""
+from .constants import DEFAULT_VAULT_ID
+from .tags import EncryptedString, SecretString
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+REENCRYPTED = "re-encrypted"
+
+MISSING = object()
+
+
+class KeyChange:
+    """
+    One added, removed, changed or re-encrypted key of a section. old and new
+    hold the plain values, secrets that were not decrypted are None.
+    """
+
+    def __init__(self, section, path, kind, old=None, new=None, secret=False):
+        self.section = section
+        self.path = path
+        self.kind = kind
+        self.old = old
+        self.new = new
+        self.secret = secret
+
+    def __repr__(self):
+        return f"<KeyChange {self.section} {self.path} {self.kind}>"
+
+
+def is_secret(value):
+    return isinstance(value, (EncryptedString, SecretString))
+
+
+def flatten(node, path="", leaves=None):
+    """
+    The values under node by dotted key path, list items as path[i]. Empty
+    dicts and lists are kept as values so they show up when added or removed.
+    """
+    if leaves is None:
+        leaves = {}
+    if isinstance(node, dict) and (node or not path):
+        for key, value in node.items():
+            flatten(value, f"{path}.{key}" if path else f"{key}", leaves)
+    elif isinstance(node, list) and node:
+        for i, item in enumerate(node):
+            flatten(item, f"{path}[{i}]", leaves)
+    else:
+        leaves[path] = node
+    return leaves
+
+
+def sections_of(config):
+    """The default section and every env of config by name."""
+    sections = {DEFAULT_VAULT_ID: config.get_default()}
+    sections.update(config.tag_index.envs_by_name)
+    return sections
+
+
+def diff_configs(old, new, sections=None, passwords=None, password=None, reveal=False):
+    """
+    The KeyChanges between two loaded configs, for the given section names or
+    every section of either. passwords maps section names to passwords,
+    password is used for sections without one.
+
+    Secrets whose ciphertexts differ are decrypted when a password is given,
+    changes which decrypt to the same value are reported as re-encrypted.
+    Added and removed secrets are only decrypted with reveal set.
+    """
+    old_sections, new_sections = sections_of(old), sections_of(new)
+    if not sections:
+        sections = list(old_sections) + [
+            name for name in new_sections if name not in old_sections
+        ]
+
+    changes = []
+    # {(config, section): [(change, attribute, tag)]} of values to decrypt
+    pending = {}
+    for section in sections:
+        old_leaves = flatten(old_sections.get(section) or {})
+        new_leaves = flatten(new_sections.get(section) or {})
+        paths = list(old_leaves) + [p for p in new_leaves if p not in old_leaves]
+        for path in paths:
+            old_value = old_leaves.get(path, MISSING)
+            new_value = new_leaves.get(path, MISSING)
+            if (
+                isinstance(old_value, EncryptedString)
+                and isinstance(new_value, EncryptedString)
+                and old_value.value == new_value.value
+            ):
+                # same ciphertext, same value
+                continue
+            if not (is_secret(old_value) or is_secret(new_value)) and (
+                type(old_value) is type(new_value) and old_value == new_value
+            ):
+                continue
+
+            if old_value is MISSING:
+                kind = ADDED
+            elif new_value is MISSING:
+                kind = REMOVED
+            else:
+                kind = CHANGED
+            change = KeyChange(
+                section,
+                path,
+                kind,
+                secret=is_secret(old_value) or is_secret(new_value),
+            )
+            changes.append(change)
+            for config, attribute, value in (
+                (old, "old", old_value),
+                (new, "new", new_value),
+            ):
+                if isinstance(value, EncryptedString):
+                    if kind == CHANGED or reveal:
+                        pending.setdefault((id(config), section), []).append(
+                            (change, attribute, value)
+                        )
+                elif isinstance(value, SecretString):
+                    setattr(change, attribute, value.value)
+                elif value is not MISSING:
+                    setattr(change, attribute, value)
+
+    configs = {id(old): old, id(new): new}
+    for (config_id, section), values in pending.items():
+        section_password = (passwords or {}).get(section, password)
+        if section_password is None:
+            continue
+        decrypted = configs[config_id].decrypt_tags(
+            [tag for _, _, tag in values],
+            section_password,
+            raise_exception=False,
+            vault_id=section,
+        )
+        for (change, attribute, _), plaintext in zip(values, decrypted):
+            setattr(change, attribute, plaintext)
+
+    for change in changes:
+        if (
+            change.kind == CHANGED
+            and change.secret
+            and change.old is not None
+            and change.old == change.new
+        ):
+            change.kind = REENCRYPTED
+    return changes
@@ -1,52 +1,258 @@
 import os
-from typing import List
-from eyaml.processor import SecretYAML
+from typing import Dict, List, Union
+from eyaml import compiled
+from eyaml.cache import SettingsCache, hash_file
+from eyaml.constants import READ_MODE, DEFAULT_VAULT_ID
+from eyaml.instrumentation import timed
+from eyaml.mappings import thaw
+from eyaml.exceptions import CompiledSettingsError
+from eyaml.utils import ForkSafeLock
+
+
+def read_password_file(password_file: str):
+    if not os.path.isfile(password_file):
+        raise FileNotFoundError(f"{password_file} found not be found")
+    with open(password_file, "r") as file:
+        return file.read()
+
+
+def collect_passwords(passwords=None, password_files=None):
+    """
+    Splits the supplied passwords into vault-id labelled passwords, given as
+    dicts of {label: password} or {label: password_file}, and a list of
+    unlabelled passwords that have to be tried in turn.
+    """
+    labelled, unlabelled = {}, []
+
+    if isinstance(passwords, dict):
+        labelled.update(passwords)
+    elif passwords:
+        unlabelled.extend(passwords)
+
+    if isinstance(password_files, dict):
+        for label, password_file in password_files.items():
+            labelled[label] = read_password_file(password_file)
+    elif password_files:
+        for password_file in password_files:
+            unlabelled.append(read_password_file(password_file))
+
+    return labelled, unlabelled
 
 
 def load_settings_from_config(
     config_file_path: str,
     environment: str,
-    passwords: List = None,
-    password_files: List = None,
+    passwords: Union[List, Dict] = None,
+    password_files: Union[List, Dict] = None,
+    workers: int = None,
+    cache: bool = False,
+    cache_dir: str = None,
+    lazy: bool = False,
+    metrics=None,
 ):
+    """
+    Loads the environment as a dict, merged over the default section. The
+    dict and everything in it are plain, mutable dicts and lists, as django
+    writes to its settings, e.g. DATABASES.
+
+    passwords and password_files may be lists, in which case every password is
+    tried against every encrypted value, or dicts keyed by vault-id label,
+    e.g. {"dev": ..., "default": ...}, in which case each value is decrypted
+    exactly once with the password matching the label in its header.
+
+    With cache or cache_dir set, the resolved dict is stored encrypted in
+    cache_dir (default .eyaml_cache next to the config) and reused while the
+    file contents, env and passwords stay the same.
+
+    With lazy set, encrypted values are returned as LazySecret handles which
+    decrypt on first use, so only the secrets a process reads are decrypted.
+    Lazy settings are never written to the cache.
+
+    metrics is an optional sink called as metrics(phase, seconds, count) for
+    the parse, validate, decrypt, decrypt_failed, to_dict and merge phases,
+    e.g. an eyaml.instrumentation.ProfileCollector.
+    """
     if not os.path.isfile(config_file_path):
         raise FileNotFoundError(f"{config_file_path} found not be found")
 
-    config = SecretYAML(filepath=config_file_path)
+    labelled, unlabelled = collect_passwords(passwords, password_files)
+
+    settings_cache = None
+    if cache or cache_dir:
+        settings_cache = SettingsCache(
+            config_file_path, environment, labelled, unlabelled, cache_dir=cache_dir
+        )
+        with timed(metrics, "cache_load"):
+            settings = settings_cache.load()
+        if settings is not None:
+            return settings
+
+    # imported here so loading compiled settings never pulls in ruamel or ansible
+    from eyaml.processor import SecretYAML
+    from eyaml.tags import EncryptedString
+
+    config = SecretYAML(filepath=config_file_path, mode=READ_MODE, metrics=metrics)
     # TODO: check if yaml has the specified environment
 
-    if config.is_default_decrypted() and config.is_env_decrypted(environment):
-        # returns the config as a dict, when neither default or environment is encrypted
-        return config.get_env_as_dict(environment)
-
-    if config.is_default_encrypted():
-        if not passwords and not password_files:
-            raise Exception("No passwords or password files specified")
-
-        if passwords:
-            for password in passwords:
-                config.decrypt_default(password, raise_exception=False)
-
-        if password_files:
-            for password_file in password_files:
-                if not os.path.isfile(password_file):
-                    raise FileNotFoundError(f"{password_file} found not be found")
-                password = open(password_file, "r").read()
-                config.decrypt_default(password, raise_exception=False)
-
-    if config.is_env_encrypted(environment):
-        if not passwords and not password_files:
-            raise Exception("No passwords or password files specified")
-
-        if passwords:
-            for password in passwords:
-                config.decrypt_env(environment, password, raise_exception=False)
-
-        if password_files:
-            for password_file in password_files:
-                if not os.path.isfile(password_file):
-                    raise FileNotFoundError(f"{password_file} found not be found")
-                password = open(password_file, "r").read()
-                config.decrypt_env(environment, password, raise_exception=False)
-
-    return config.get_env_as_dict(environment)
+    # the default section and every env the environment inherits from
+    sections = [DEFAULT_VAULT_ID] + config.get_env_chain(environment)
+    encrypted = [
+        section for section in sections if config.is_encrypted(config.env(section))
+    ]
+
+    if not encrypted:
+        # returns the config as a dict, when none of the sections are encrypted
+        settings = thaw(config.get_env_as_dict(environment))
+        if settings_cache:
+            settings_cache.save(settings)
+        return settings
+
+    if not (passwords or password_files):
+        raise Exception("No passwords or password files specified")
+
+    if lazy:
+        return lazy_settings(config, environment, encrypted, labelled, unlabelled)
+
+    for section in encrypted:
+        node = config.env(section)
+        if labelled:
+            config.decrypt_walk(
+                node, labelled, raise_exception=False, workers=workers, vault_id=section
+            )
+
+        for password in unlabelled:
+            # not is_encrypted, which warns about the values just decrypted
+            if not config.has_tag_of_type(node, EncryptedString):
+                break
+            config.decrypt_walk(
+                node, password, raise_exception=False, workers=workers, vault_id=section
+            )
+
+    settings = thaw(config.get_env_as_dict(environment))
+    if settings_cache and not any(
+        config.has_tag_of_type(config.env(section), EncryptedString)
+        for section in encrypted
+    ):
+        # only fully decrypted settings are cached
+        settings_cache.save(settings)
+    return settings
+
+
+def lazy_settings(config, environment, sections, labelled, unlabelled):
+    """
+    The environment of a loaded config with the values of sections as
+    LazySecret handles, tried with the labelled passwords first.
+    """
+    candidates = ([labelled] if labelled else []) + unlabelled
+    for section in sections:
+        config.lazy_decrypt_walk(config.env(section), candidates, vault_id=section)
+    return thaw(config.get_env_as_dict(environment))
+
+
+def compile_settings_from_config(
+    config_file_path: str,
+    environment: str,
+    key: bytes,
+    passwords: Union[List, Dict] = None,
+    password_files: Union[List, Dict] = None,
+):
+    """
+    Resolves the environment, merged over the default section and the envs
+    it extends, into a compiled settings artifact, see eyaml.compiled.
+    Values that are !encrypted in the config are encrypted under key in the
+    artifact, everything else is stored as is.
+    """
+    from eyaml.processor import SecretYAML
+    from eyaml.tags import SecretString
+    from eyaml.lazy import LazySecret
+
+    if not os.path.isfile(config_file_path):
+        raise FileNotFoundError(f"{config_file_path} found not be found")
+
+    config = SecretYAML(filepath=config_file_path, mode=READ_MODE)
+    sections = [DEFAULT_VAULT_ID] + config.get_env_chain(environment)
+    for section in sections:
+        if config.has_tag_of_type(config.env(section), SecretString):
+            raise CompiledSettingsError(
+                f"{section} has unencrypted !secret values, encrypt it before compiling"
+            )
+
+    encrypted = [
+        section for section in sections if config.is_encrypted(config.env(section))
+    ]
+    if encrypted and not (passwords or password_files):
+        raise Exception("No passwords or password files specified")
+    labelled, unlabelled = collect_passwords(passwords, password_files)
+    # the config parsed above, not a second parse of the file
+    settings = lazy_settings(config, environment, encrypted, labelled, unlabelled)
+    return compiled.compile_settings(
+        settings,
+        key,
+        environment,
+        lambda value: isinstance(value, LazySecret),
+        source_hash=hash_file(config_file_path),
+    )
+
+
+def load_compiled_settings(artifact_path: str, key: bytes = None, key_file: str = None):
+    """
+    Loads settings compiled with `eyaml compile` without ruamel or ansible,
+    secrets are decrypted with key or the key read from key_file.
+    """
+    if key is None:
+        if key_file is None:
+            raise CompiledSettingsError("No key or key file specified")
+        key = compiled.read_key_file(key_file)
+    return compiled.load_compiled_settings(artifact_path, key)
+
+
+class SettingsRegistry:
+    """
+    Process wide registry of resolved settings by config path and env. Under
+    a prefork server (gunicorn --preload, uwsgi without lazy-apps) the master
+    resolves an env once and every forked worker inherits the resolved dict,
+    so no worker parses or decrypts the config again.
+
+    The lock is a ForkSafeLock, a child forked while another thread was
+    resolving settings gets a fresh lock instead of deadlocking on it.
+    """
+
+    def __init__(self):
+        self._settings = {}
+        self._lock = ForkSafeLock()
+        self.resolved_in = {}
+
+    def get(self, config_file_path: str, environment: str, **kwargs):
+        """
+        The settings of environment, resolved with load_settings_from_config
+        and kwargs on first use in this process or any process it forked from.
+        """
+        key = (os.path.abspath(config_file_path), environment)
+        settings = self._settings.get(key)
+        if settings is None:
+            with self._lock:
+                settings = self._settings.get(key)
+                if settings is None:
+                    settings = load_settings_from_config(
+                        config_file_path, environment, **kwargs
+                    )
+                    self._settings[key] = settings
+                    self.resolved_in[key] = os.getpid()
+        return settings
+
+    def clear(self):
+        with self._lock:
+            self._settings = {}
+            self.resolved_in = {}
+
+
+SETTINGS_REGISTRY = SettingsRegistry()
+
+
+def get_shared_settings(config_file_path: str, environment: str, **kwargs):
+    """
+    Loads settings through the process wide SETTINGS_REGISTRY, call it in the
+    master before the workers fork, e.g. from the django settings module with
+    gunicorn --preload, and every worker reuses the resolved settings.
+    """
+    return SETTINGS_REGISTRY.get(config_file_path, environment, **kwargs)
@@ -0,0 +1,180 @@
+import os
+import base64
+import hashlib
+import logging
+
+from .constants import (
+    ENVELOPE_VALUE_HEADER,
+    ENVELOPE_KEY_HEADER,
+    ENVELOPE_VERSION,
+    ENVELOPE_KDF_ITERATIONS,
+)
+from .exceptions import EnvelopeKeyError
+from .utils import get_vault_id, resolve_password, password_fingerprint, ForkSafeLock
+
+logger = logging.getLogger("eyaml")
+
+DATA_KEY_LENGTH = 32
+NONCE_LENGTH = 12
+SALT_LENGTH = 16
+
+
+def _aesgcm(key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    return AESGCM(key)
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode()
+
+
+def _b64decode(data):
+    return base64.b64decode(data.encode(), validate=True)
+
+
+def is_envelope_value(value):
+    return isinstance(value, str) and value.startswith(ENVELOPE_VALUE_HEADER + ";")
+
+
+def generate_data_key():
+    return os.urandom(DATA_KEY_LENGTH)
+
+
+def wrap_data_key(data_key, password, vault_id, iterations=ENVELOPE_KDF_ITERATIONS):
+    """
+    Wraps a data key with a key derived from the password, the vault-id is
+    bound as associated data so a header can not be moved to another env.
+    $EYAML_KEY;1.0;PBKDF2-SHA256;<iterations>|<salt>|<nonce + wrapped key>
+    """
+    salt = os.urandom(SALT_LENGTH)
+    kek = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    nonce = os.urandom(NONCE_LENGTH)
+    wrapped = _aesgcm(kek).encrypt(nonce, data_key, vault_id.encode())
+    return (
+        f"{ENVELOPE_KEY_HEADER};{ENVELOPE_VERSION};PBKDF2-SHA256;{iterations}"
+        f"|{_b64encode(salt)}|{_b64encode(nonce + wrapped)}"
+    )
+
+
+def unwrap_data_key(header, password, vault_id):
+    from cryptography.exceptions import InvalidTag
+
+    try:
+        envelope, salt, wrapped = header.split("|")
+        _, version, kdf, iterations = envelope.split(";")
+        kek = hashlib.pbkdf2_hmac(
+            "sha256", password.encode(), _b64decode(salt), int(iterations)
+        )
+        wrapped = _b64decode(wrapped)
+        return _aesgcm(kek).decrypt(
+            wrapped[:NONCE_LENGTH], wrapped[NONCE_LENGTH:], vault_id.encode()
+        )
+    except (InvalidTag, ValueError) as e:
+        raise EnvelopeKeyError(
+            f"Could not unwrap the data key for {vault_id}, wrong password"
+        ) from e
+
+
+def encrypt_with_data_key(value, data_key, vault_id):
+    """
+    $EYAML_ENVELOPE;1.0;AES256GCM;<vault_id>|<nonce + ciphertext>
+    """
+    nonce = os.urandom(NONCE_LENGTH)
+    ciphertext = _aesgcm(data_key).encrypt(nonce, value.encode(), vault_id.encode())
+    return (
+        f"{ENVELOPE_VALUE_HEADER};{ENVELOPE_VERSION};AES256GCM;{vault_id}"
+        f"|{_b64encode(nonce + ciphertext)}"
+    )
+
+
+def decrypt_with_data_key(value, data_key, vault_id):
+    envelope, ciphertext = value.split("|", 1)
+    ciphertext = _b64decode(ciphertext)
+    return (
+        _aesgcm(data_key)
+        .decrypt(
+            ciphertext[:NONCE_LENGTH], ciphertext[NONCE_LENGTH:], vault_id.encode()
+        )
+        .decode()
+    )
+
+
+class KeyRing:
+    """
+    The wrapped data keys of a document by vault-id label, and the data keys
+    unwrapped so far. Each data key is unwrapped, paying the key derivation,
+    once per password no matter how many values it decrypts.
+    """
+
+    def __init__(self, wrapped_keys=None):
+        self.wrapped_keys = dict(wrapped_keys or {})
+        self._data_keys = {}
+        self._lock = ForkSafeLock()
+
+    def data_key(self, vault_id, password):
+        header = self.wrapped_keys.get(vault_id)
+        if header is None:
+            raise EnvelopeKeyError(f"No data key defined for {vault_id}")
+
+        cache_key = (vault_id, header, password_fingerprint(header, password))
+        with self._lock:
+            if cache_key not in self._data_keys:
+                self._data_keys[cache_key] = unwrap_data_key(
+                    header, password, vault_id
+                )
+            return self._data_keys[cache_key]
+
+    def encryption_key(self, vault_id, password, replace=False):
+        """
+        Returns the data key to encrypt vault_id with, and the new wrapped
+        header when a key had to be generated. A key is generated when there
+        is none yet, a key wrapped with another password raises
+        EnvelopeKeyError unless replace is set. Only replace a key no value
+        is encrypted with any more, those values could never be decrypted.
+        """
+        if vault_id in self.wrapped_keys:
+            try:
+                return self.data_key(vault_id, password), None
+            except EnvelopeKeyError:
+                if not replace:
+                    raise
+                logger.info(f"Replacing the unused data key of {vault_id}")
+
+        data_key = generate_data_key()
+        header = wrap_data_key(data_key, password, vault_id)
+        self.wrapped_keys[vault_id] = header
+        with self._lock:
+            self._data_keys[
+                (vault_id, header, password_fingerprint(header, password))
+            ] = data_key
+        return data_key, header
+
+    def rewrap_key(self, vault_id, old_password, new_password):
+        """
+        Wraps the data key of vault_id with new_password and returns the new
+        header, the values encrypted with the data key stay valid as they are.
+        """
+        data_key = self.data_key(vault_id, old_password)
+        header = wrap_data_key(data_key, new_password, vault_id)
+        self.wrapped_keys[vault_id] = header
+        with self._lock:
+            self._data_keys[
+                (vault_id, header, password_fingerprint(header, new_password))
+            ] = data_key
+        return header
+
+    def decrypt_value(self, value, password, node, raise_exception=True, vault_id=None):
+        label = get_vault_id(value) or vault_id
+        password = resolve_password(value, password, vault_id=vault_id)
+        try:
+            if password is None:
+                raise EnvelopeKeyError(f"No password for vault-id {label}")
+            return decrypt_with_data_key(
+                value, self.data_key(label, password), label
+            )
+        except Exception as e:
+            if raise_exception:
+                logger.error(f"Error during decryption: {e}")
+                raise EnvelopeKeyError(f"Could not decrypt node: {node}") from e
+            logger.debug(f"Error during decryption: {e}")
@@ -1,23 +1,160 @@
+import os
+import json
+
 from environ import Env
 from django.conf import settings
 
+from .constants import ENV_FILE_NAME, ENV_NESTING_SEPARATOR
+from .exceptions import InvalidEnvironOverride
+from .mappings import thaw
+
+MISSING = object()
+
+
+def read_env_file(env_file):
+    """
+    The variables of a .env file as a dict, without touching os.environ.
+    Blank lines, comments and an `export ` prefix are skipped, values may be
+    wrapped in single or double quotes.
+    """
+    variables = {}
+    with open(env_file, "r") as stream:
+        for line in stream:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("export "):
+                line = line[len("export "):].lstrip()
+            name, sep, value = line.partition("=")
+            if not sep:
+                continue
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"":
+                value = value[1:-1]
+            variables[name.strip()] = value
+    return variables
+
+
+class EnvironOverlay:
+    """
+    Index of environment variable overrides, built from os.environ and the
+    .env file in a single scan. Set variables win over the .env file.
+
+    Variables are indexed by their top level key, nested keys are reached
+    through the separator, e.g. DATABASES__default__HOST overrides
+    config["DATABASES"]["default"]["HOST"] and ALLOWED_HOSTS__0 the first
+    item of a list. Applying the overlay only visits the indexed variables
+    whose top level key is in the config, not every key of the config.
+    """
+
+    def __init__(self, environ=None, env_file=None, separator=ENV_NESTING_SEPARATOR):
+        if environ is None:
+            environ = os.environ
+        if env_file is None and os.path.isfile(ENV_FILE_NAME):
+            env_file = ENV_FILE_NAME
+        self.separator = separator
+
+        variables = read_env_file(env_file) if env_file else {}
+        variables.update(environ)
+        # {top level key: [(nested key path, variable name, raw value)]}
+        self.index = {}
+        for name, value in variables.items():
+            top, *path = name.split(separator)
+            if top and all(path):
+                self.index.setdefault(top, []).append((path, name, value))
+        for overrides in self.index.values():
+            # parents first, so nested variables refine a replaced parent
+            overrides.sort(key=lambda override: len(override[0]))
+
+    def apply(self, config):
+        """
+        config with the overrides applied, coerced to the type of the value
+        they replace. Only the dicts and lists along an overridden path are
+        copied, everything else is shared with config.
+        """
+        result = dict(config)
+        for top in self.index.keys() & config.keys():
+            for path, name, raw in self.index[top]:
+                result[top] = self._override(result[top], path, name, raw)
+        return result
+
+    def _override(self, node, path, name, raw):
+        if not path:
+            return coerce(raw, node, name)
+        key, rest = path[0], path[1:]
+        if isinstance(node, dict) and (key in node or not rest):
+            node = dict(node)
+            node[key] = self._override(node.get(key, MISSING), rest, name, raw)
+            return node
+        if isinstance(node, list) and key.isdigit() and int(key) < len(node):
+            node = list(node)
+            node[int(key)] = self._override(node[int(key)], rest, name, raw)
+            return node
+        # nothing to nest into, the variable does not address this config
+        return node
+
+
+def coerce(raw, current, name):
+    """
+    raw read as the type of the YAML value it replaces. Lists and dicts are
+    read as JSON when they look like it, otherwise as django-environ does,
+    a,b,c and key=value,key2=value2, items taking the type of the items
+    they replace.
+    """
+    try:
+        if current is MISSING or current is None:
+            return raw
+        if isinstance(current, bool):
+            return Env.parse_value(raw, bool)
+        if isinstance(current, (int, float)):
+            return Env.parse_value(raw, type(current))
+        if isinstance(current, list):
+            if raw.lstrip().startswith("["):
+                return json.loads(raw)
+            sample = current[0] if current else MISSING
+            return [coerce(item, sample, name) for item in raw.split(",") if item]
+        if isinstance(current, dict):
+            if raw.lstrip().startswith("{"):
+                return json.loads(raw)
+            return {
+                key: coerce(value, current.get(key, MISSING), name)
+                for key, value in Env.parse_value(raw, dict).items()
+            }
+    except ValueError as e:
+        raise InvalidEnvironOverride(name, type(current).__name__) from e
+    return raw
+
+
+_overlay = None
+
+
+def get_overlay():
+    """The overlay of this process, os.environ and .env are only scanned once."""
+    global _overlay
+    if _overlay is None:
+        _overlay = EnvironOverlay()
+    return _overlay
+
+
+def reset_overlay():
+    """Drops the overlay, the next call scans os.environ and .env again."""
+    global _overlay
+    _overlay = None
+
 
-def generate_dynamic_environ(config):
-    env = Env()
-    env.read_env()
-    settings.configure({})
-    # Set environment variables dynamically
-    for key, value in list(config.items()):
-        # Determine the type of the value
-        if isinstance(value, bool):
-            # For booleans
-            setattr(settings, key, env.bool(key, default=value))
-        elif isinstance(value, int):
-            setattr(settings, key, env.int(key, default=value))
-        elif isinstance(value, float):
-            # For floats
-            setattr(settings, key, env.float(key, default=value))
-        else:
-            # Default to string
-            var = env.str(key, default=str(value))
-            setattr(settings, key, var)
+def generate_dynamic_environ(config, overlay=None):
+    """
+    Sets every key of config on django settings, overridden from the
+    environment, and returns the resulting dict, plain dicts and lists all
+    the way down. Settings are configured on the first call only, so this
+    is safe to call repeatedly.
+    """
+    if overlay is None:
+        overlay = get_overlay()
+    if not settings.configured:
+        settings.configure()
+    # plain copies, django writes to its settings dicts
+    resolved = thaw(overlay.apply(config))
+    for key, value in resolved.items():
+        setattr(settings, key, value)
+    return resolved
@@ -1,4 +1,4 @@
-from .constants import VALID_ENCRYPTION_METHODS
+from .constants import VALID_ENCRYPTION_METHODS, VALID_MODES, VALID_MERGE_STRATEGIES
 class InvalidSettingsProvided(Exception):
     pass
 
@@ -13,6 +13,12 @@ class TooManyDefaultMapTagsDefinedException(Exception):
         super().__init__(msg)
 
 
+class EnvironmentInheritanceCycle(Exception):
+    def __init__(self, chain):
+        msg = f"Environments extend each other in a cycle: {' -> '.join(chain)}"
+        super().__init__(msg)
+
+
 class EnvironmentNotFound(Exception):
     def __init__(self, msg="Environment not found"):
         super().__init__(msg)
@@ -62,3 +68,53 @@ class UnsupportedEncryptionMethodSpecified(Exception):
         encryption_methods = ', '.join(VALID_ENCRYPTION_METHODS)
         msg = f"Invalid encryption method specified: {encryption_method}, must be one of {encryption_methods}"
         super().__init__(msg)
+
+
+
+class UnsupportedModeSpecified(Exception):
+    def __init__(self, mode):
+        modes = ', '.join(VALID_MODES)
+        msg = f"Invalid mode specified: {mode}, must be one of {modes}"
+        super().__init__(msg)
+
+
+class UnsupportedMergeStrategy(Exception):
+    def __init__(self, strategy):
+        strategies = ', '.join(VALID_MERGE_STRATEGIES)
+        msg = f"Invalid merge strategy: {strategy}, must be one of {strategies}"
+        super().__init__(msg)
+
+
+class ReadOnlyModeException(Exception):
+    def __init__(self, msg="Config was loaded in read mode and can not be saved"):
+        super().__init__(msg)
+
+
+class ReadOnlyViewError(TypeError):
+    def __init__(self, msg="Config dicts are read-only views, copy them to modify"):
+        super().__init__(msg)
+
+
+class EnvelopeKeyError(Exception):
+    def __init__(self, msg="Could not unwrap the envelope data key, wrong password"):
+        super().__init__(msg)
+
+
+class CompiledSettingsError(Exception):
+    def __init__(self, msg="Compiled settings could not be loaded"):
+        super().__init__(msg)
+
+
+class InvalidEnvironOverride(ValueError):
+    def __init__(self, name, expected):
+        # the value is left out, it may be a secret
+        msg = f"Environment variable {name} can not be read as {expected}"
+        super().__init__(msg)
+
+
+class RequiredKeysMissing(Exception):
+    def __init__(self, missing):
+        self.missing = missing
+        envs = "; ".join(f"{env}: {', '.join(paths)}" for env, paths in missing.items())
+        msg = f"Environments do not define the required keys of the default section, {envs}"
+        super().__init__(msg)
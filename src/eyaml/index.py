@@ -0,0 +1,159 @@
+from collections import Counter
+
+from .constants import EXTENDS_KEY
+from .exceptions import EnvironmentInheritanceCycle, EnvironmentNotFound
+
+from .tags import (
+    DefaultSecretConfigMap,
+    EnvSecretConfigMap,
+    EncryptedString,
+    SecretString,
+    RequiredString,
+)
+
+INDEXED_TAGS = (SecretString, EncryptedString, RequiredString)
+
+
+class TagIndex:
+    """
+    Index of a loaded document built in a single walk: the top level keys by
+    name, every !default and !env section, and how many !secret, !encrypted and
+    !required values sit under each section and under the whole document.
+    Envs naming a parent env under __extends__ are recorded in extends.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.top_level = {}
+        self.defaults = {}
+        self.envs = {}
+        self.envs_by_name = {}
+        self.counts = {}
+        self.extends = {}
+        self.nested_sections = False
+        self._chains = {}
+        self._key_paths = {}
+
+        if isinstance(data, dict):
+            self.top_level = {str(k): v for k, v in data.items()}
+        self.counts[id(data)] = Counter()
+        self._walk(data, [self.counts[id(data)]])
+
+    def _walk(self, node, counters):
+        if isinstance(node, INDEXED_TAGS):
+            for counter in counters:
+                counter[type(node)] += 1
+        elif isinstance(node, dict):
+            for key, value in node.items():
+                if isinstance(key, (DefaultSecretConfigMap, EnvSecretConfigMap)):
+                    self._add_section(key, value, counters)
+                else:
+                    self._walk(value, counters)
+        elif isinstance(node, list):
+            for item in node:
+                self._walk(item, counters)
+
+    def _add_section(self, key, node, counters):
+        if isinstance(key, DefaultSecretConfigMap):
+            self.defaults[key] = node
+        else:
+            self.envs[key] = node
+            self.envs_by_name[str(key)] = node
+            if isinstance(node, dict):
+                for name, value in node.items():
+                    if str(name) == EXTENDS_KEY:
+                        self.extends[str(key)] = str(value)
+
+        if len(counters) > 1:
+            self.nested_sections = True
+        counter = self.counts.setdefault(id(node), Counter())
+        self._walk(node, counters + [counter])
+
+    def env_chain(self, name, resolving=()):
+        """
+        Names of the envs name inherits from, outermost first and ending with
+        name itself. Each chain is resolved once and shared by its children.
+        """
+        chain = self._chains.get(name)
+        if chain is not None:
+            return chain
+        if name in resolving:
+            raise EnvironmentInheritanceCycle(list(resolving) + [name])
+        if name not in self.envs_by_name:
+            raise EnvironmentNotFound(msg=f"Environment of {name} not found")
+
+        parent = self.extends.get(name)
+        if parent is None:
+            chain = (name,)
+        else:
+            chain = self.env_chain(parent, resolving + (name,)) + (name,)
+        self._chains[name] = chain
+        return chain
+
+    def descendants(self, name):
+        """Names of the envs inheriting from name, directly or not."""
+        return [
+            env
+            for env in self.envs_by_name
+            if env != name and name in self.env_chain(env)
+        ]
+
+    def key_paths(self, node):
+        """
+        The key paths defined under node, a section, and the subset of them
+        holding !required, e.g. "DATABASES.default.PASSWORD". Walked once per
+        section and memoized, the index is rebuilt whenever the data changes.
+        """
+        cached = self._key_paths.get(id(node))
+        if cached is None:
+            defined, required = set(), []
+            _collect_key_paths(node, "", defined, required)
+            cached = self._key_paths[id(node)] = (frozenset(defined), tuple(required))
+        return cached
+
+    def is_current(self, data):
+        return self.data is data
+
+    def count(self, node, of_type):
+        """
+        Number of values of of_type under node, or None when node is not an
+        indexed section and has to be walked instead.
+        """
+        if of_type not in INDEXED_TAGS or id(node) not in self.counts:
+            return None
+        return self.counts[id(node)][of_type]
+
+    def moved(self, node, from_type, to_type, count):
+        """
+        Record that `count` values under node were converted from from_type to
+        to_type, returns False when the index can not be patched in place and
+        should be rebuilt.
+        """
+        if count == 0:
+            return True
+        if (
+            self.nested_sections
+            or node is self.data
+            or id(node) not in self.counts
+        ):
+            return False
+
+        for counter in (self.counts[id(node)], self.counts[id(self.data)]):
+            counter[from_type] -= count
+            counter[to_type] += count
+        return True
+
+
+def _collect_key_paths(node, path, defined, required):
+    if isinstance(node, dict):
+        items = ((f"{path}.{k}" if path else f"{k}", v) for k, v in node.items())
+    elif isinstance(node, list):
+        items = ((f"{path}[{i}]", v) for i, v in enumerate(node))
+    else:
+        return
+    for key_path, value in items:
+        if isinstance(value, RequiredString):
+            required.append(key_path)
+            continue
+        defined.add(key_path)
+        _collect_key_paths(value, key_path, defined, required)
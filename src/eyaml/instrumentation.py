@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+NULL_TIMER = nullcontext()
+
+
+@contextmanager
+def _timer(sink, phase, count):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        sink(phase, time.perf_counter() - start, count)
+
+
+def timed(sink, phase, count=1):
+    """
+    Times the block and reports it to sink as sink(phase, seconds, count).
+    With no sink this is a shared no-op context manager, so instrumentation
+    costs nothing when disabled.
+    """
+    if sink is None:
+        return NULL_TIMER
+    return _timer(sink, phase, count)
+
+
+def record(sink, phase, count, seconds=0.0):
+    """Reports a count, e.g. failed trial decryptions, without timing anything."""
+    if sink is not None:
+        sink(phase, seconds, count)
+
+
+class ProfileCollector:
+    """
+    Metrics sink which aggregates calls, counts and time per phase, e.g.
+    parse, validate, decrypt, decrypt_failed, to_dict and merge.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, phase, seconds, count=1):
+        calls, total_count, total_seconds = self.phases.get(phase, (0, 0, 0.0))
+        self.phases[phase] = (calls + 1, total_count + count, total_seconds + seconds)
+
+    def as_dict(self):
+        return {
+            phase: {"calls": calls, "count": count, "seconds": seconds}
+            for phase, (calls, count, seconds) in self.phases.items()
+        }
+
+    def report(self):
+        lines = [f"{'phase':<20}{'calls':>8}{'count':>8}{'total ms':>12}{'ms/item':>10}"]
+        for phase, (calls, count, seconds) in self.phases.items():
+            per_item = seconds * 1000 / count if count else 0.0
+            lines.append(
+                f"{phase:<20}{calls:>8}{count:>8}{seconds * 1000:>12.2f}{per_item:>10.3f}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,84 @@
+from .utils import decrypt_value, ForkSafeLock
+from .envelope import is_envelope_value
+
+
+class LazySecret:
+    """
+    Handle to an !encrypted value which is only decrypted on first str() or
+    attribute access, the plaintext is then memoized. A lock makes sure
+    concurrent first accesses derive the key only once.
+
+    password may be a password, a dict of vault-id labels to passwords, or a
+    list of either which are tried in turn.
+    """
+
+    def __init__(self, ciphertext, password, vault_id=None, style=None, keyring=None):
+        self.ciphertext = ciphertext
+        self.vault_id = vault_id
+        self.style = style
+        self._password = password
+        self._keyring = keyring
+        self._value = None
+        self._lock = ForkSafeLock()
+
+    @property
+    def is_decrypted(self):
+        return self._value is not None
+
+    @property
+    def value(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._decrypt()
+                    # the plaintext is all that is needed from now on
+                    self._password = None
+                    self._keyring = None
+        return self._value
+
+    def _decrypt(self):
+        passwords = self._password
+        if not isinstance(passwords, list):
+            passwords = [passwords]
+
+        decrypt = decrypt_value
+        if is_envelope_value(self.ciphertext):
+            # envelope values share their env's data key, unwrapped once by the keyring
+            decrypt = self._keyring.decrypt_value
+
+        for password in passwords[:-1]:
+            value = decrypt(
+                self.ciphertext,
+                password,
+                self,
+                raise_exception=False,
+                vault_id=self.vault_id,
+            )
+            if value is not None:
+                return value
+        return decrypt(self.ciphertext, passwords[-1], self, vault_id=self.vault_id)
+
+    def __getattr__(self, name):
+        # only reached for attributes LazySecret does not define itself,
+        # private names are never delegated so copy/pickle probing stays lazy
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __str__(self):
+        return self.value
+
+    def __repr__(self):
+        state = "decrypted" if self.is_decrypted else "encrypted"
+        return f"<LazySecret {self.vault_id or ''} ({state})>"
+
+    def __eq__(self, other):
+        if isinstance(other, LazySecret):
+            other = other.value
+        return self.value == other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __len__(self):
+        return len(self.value)
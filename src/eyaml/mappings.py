@@ -0,0 +1,170 @@
+from collections.abc import Mapping
+
+from .constants import (
+    MERGE_STRATEGY,
+    REPLACE_STRATEGY,
+    APPEND_STRATEGY,
+    VALID_MERGE_STRATEGIES,
+)
+from .exceptions import ReadOnlyViewError, UnsupportedMergeStrategy
+
+
+def thaw(value):
+    """
+    A deep copy of value with every mapping, FrozenDict and LayeredMapping
+    included, as a plain dict and every list as a plain list, for code that
+    writes to its settings, like django does.
+    """
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [thaw(item) for item in value]
+    return value
+
+
+def _read_only(self, *args, **kwargs):
+    raise ReadOnlyViewError()
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict handed out from the memoized dicts of SecretYAML. It is a
+    real dict so json, pprint and isinstance checks keep working, copy() and
+    dict(...) return a plain mutable dict.
+    """
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    __ior__ = _read_only
+    clear = _read_only
+    pop = _read_only
+    popitem = _read_only
+    setdefault = _read_only
+    update = _read_only
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+class FrozenList(list):
+    """Read-only list, the FrozenDict counterpart for sequences."""
+
+    __setitem__ = _read_only
+    __delitem__ = _read_only
+    __iadd__ = _read_only
+    __imul__ = _read_only
+    append = _read_only
+    clear = _read_only
+    extend = _read_only
+    insert = _read_only
+    pop = _read_only
+    remove = _read_only
+    reverse = _read_only
+    sort = _read_only
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+    def copy(self):
+        return list(self)
+
+
+class LayeredMapping(Mapping):
+    """
+    Read-only view of several mappings stacked on top of each other, e.g. the
+    default section and an env, the last layer winning. Nothing is copied up
+    front, a key is resolved on first access and memoized: mappings present
+    in several layers become a nested LayeredMapping over just those, any
+    other value is taken from the topmost layer holding the key.
+
+    strategies maps dotted key paths, e.g. "ALLOWED_HOSTS" or
+    "DATABASES.default.OPTIONS", to how that key is combined across layers:
+    merge (the default for mappings), replace (the default for anything else)
+    or append, which concatenates lists from the bottom layer up.
+    """
+
+    def __init__(self, *layers, strategies=None, path=""):
+        for strategy in (strategies or {}).values():
+            if strategy not in VALID_MERGE_STRATEGIES:
+                raise UnsupportedMergeStrategy(strategy)
+        self.layers = layers
+        self.strategies = strategies or {}
+        self.path = path
+        self._resolved = {}
+        self._keys = None
+
+    def _key_path(self, key):
+        return f"{self.path}.{key}" if self.path else f"{key}"
+
+    def __getitem__(self, key):
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+
+        values = [layer[key] for layer in self.layers if key in layer]
+        if not values:
+            raise KeyError(key)
+        value = self._resolved[key] = self._combine(key, values)
+        return value
+
+    def _combine(self, key, values):
+        path = self._key_path(key)
+        strategy = self.strategies.get(path)
+        top = values[-1]
+        if strategy == REPLACE_STRATEGY:
+            return top
+
+        if strategy == APPEND_STRATEGY and isinstance(top, list):
+            # concatenate the lists above the last layer replacing it outright
+            start = len(values) - 1
+            while start > 0 and isinstance(values[start - 1], list):
+                start -= 1
+            combined = []
+            for value in values[start:]:
+                combined.extend(value)
+            return FrozenList(combined)
+
+        if isinstance(top, Mapping) and strategy in (None, MERGE_STRATEGY):
+            start = len(values) - 1
+            while start > 0 and isinstance(values[start - 1], Mapping):
+                start -= 1
+            if start == len(values) - 1:
+                return top
+            return LayeredMapping(
+                *values[start:], strategies=self.strategies, path=path
+            )
+        return top
+
+    def keys_in_order(self):
+        if self._keys is None:
+            keys = {}
+            for layer in self.layers:
+                keys.update(dict.fromkeys(layer))
+            self._keys = list(keys)
+        return self._keys
+
+    def __iter__(self):
+        return iter(self.keys_in_order())
+
+    def __len__(self):
+        return len(self.keys_in_order())
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self.layers)
+
+    def materialize(self):
+        """
+        The view as a FrozenDict, nested views included. Values taken from a
+        single layer are shared, not copied.
+        """
+        return FrozenDict(
+            (
+                key,
+                value.materialize() if isinstance(value, LayeredMapping) else value,
+            )
+            for key, value in self.items()
+        )
+
+    def __repr__(self):
+        return f"<LayeredMapping {self.path or '.'} ({len(self.layers)} layers)>"
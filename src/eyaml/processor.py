@@ -4,10 +4,10 @@ import logging
 import pprint
 
 import ruamel.yaml as ruml
-from ruamel.yaml import CommentedMap, CommentedSeq
+from ruamel.yaml import CommentedMap
+from ruamel.yaml.constructor import SafeConstructor
 from ruamel.yaml.scalarfloat import ScalarFloat
 
-from .environ_helper import generate_dynamic_environ
 from .exceptions import (
     NoDefaultMapTagDefinedException,
     TooManyDefaultMapTagsDefinedException,
@@ -19,6 +19,9 @@ from .exceptions import (
     VersionTagNotSpecified,
     UnsupportedVersionSpecified,
     UnsupportedEncryptionMethodSpecified,
+    UnsupportedModeSpecified,
+    ReadOnlyModeException,
+    RequiredKeysMissing,
 )
 
 from .tags import (
@@ -31,8 +34,22 @@ from .tags import (
 )
 
 
-from .constants import CONTAINS_ENCRYPTED_TAGS, CONTAINS_UNENCRYPTED_TAGS, VALID_ENCRYPTION_METHODS, ANSIBLE_VAULT_ENCRYPTION_METHOD
-from .utils import deep_update, encrypt_value, decrypt_value
+from .index import TagIndex
+from .lazy import LazySecret
+from .instrumentation import timed, record
+from .mappings import FrozenDict, FrozenList, LayeredMapping, thaw
+from .envelope import KeyRing, is_envelope_value, encrypt_with_data_key
+from .constants import EXTENDS_KEY, CONTAINS_ENCRYPTED_TAGS, CONTAINS_UNENCRYPTED_TAGS, VALID_ENCRYPTION_METHODS, ANSIBLE_VAULT_ENCRYPTION_METHOD, ENVELOPE_ENCRYPTION_METHOD, ENCRYPTION_KEYS_KEY, DEFAULT_VAULT_ID, ROUND_TRIP_MODE, READ_MODE, VALID_MODES
+from .utils import (
+    deep_update,
+    encrypt_values,
+    decrypt_values,
+    rekey_values,
+    can_reuse_ciphertext,
+    password_fingerprint,
+    resolve_password,
+    get_vault_id,
+)
 
 from ruamel.yaml.nodes import ScalarNode
 
@@ -71,17 +88,43 @@ def scalar_representer(dumper, data):
         )
 
 
+class ReadOnlyConstructor(SafeConstructor):
+    """
+    Safe constructor used in read mode, kept separate so registering the eyaml
+    tags does not leak onto ruamel's own SafeConstructor.
+    """
+
+
 logger = logging.getLogger("eyaml")
 
 
 class SecretYAML(ruml.YAML):
-    def __init__(self, *args, filepath=None, **kwargs):
+    def __init__(
+        self, *args, filepath=None, mode=ROUND_TRIP_MODE, metrics=None, **kwargs
+    ):
+        if mode not in VALID_MODES:
+            raise UnsupportedModeSpecified(mode)
+        if mode == READ_MODE:
+            # plain dicts and lists from the (C accelerated) safe loader, no
+            # comment, quote or style tracking
+            kwargs.setdefault("typ", "safe")
         super().__init__(*args, **kwargs)
+        if mode == READ_MODE:
+            self.Constructor = ReadOnlyConstructor
         # self.indent(mapping=4, sequence=4, offset=2)
         self.width = 100000
+        self.mode = mode
         self.filepath = filepath
+        # optional sink called as metrics(phase, seconds, count), see instrumentation
+        self.metrics = metrics
         self.data = None
         self.status = None
+        self._tag_index = None
+        self._keyring = None
+        self._keyring_data = None
+        # memoized read-only dicts, see to_dict and invalidate
+        self._dict_cache = {}
+        self._dict_cache_data = None
         self.encryption_method = ANSIBLE_VAULT_ENCRYPTION_METHOD # defaults to ansible vault
 
         # ruamel yaml settings
@@ -91,8 +134,11 @@ class SecretYAML(ruml.YAML):
         self.register_class(SecretString)
         self.register_class(RequiredString)
         self.register_class(OtherScalar)
-        self.constructor.add_constructor("tag:yaml.org,2002:str", scalar_constructor)
-        self.representer.add_representer(StyledScalar, scalar_representer)
+        if mode == ROUND_TRIP_MODE:
+            self.constructor.add_constructor(
+                "tag:yaml.org,2002:str", scalar_constructor
+            )
+            self.representer.add_representer(StyledScalar, scalar_representer)
 
         self.default_flow_style = True
         self.preserve_quotes = True
@@ -140,35 +186,187 @@ class SecretYAML(ruml.YAML):
                 return True
         return found
 
+    @classmethod
+    def collect_tags_of_type(cls, node, of_type, parent=None, key=None, found=None):
+        """
+        Collect every value of of_type under node in document order, as
+        (parent, key, tag) tuples so the value can be replaced in place.
+        """
+        if found is None:
+            found = []
+        if isinstance(node, of_type):
+            found.append((parent, key, node))
+        elif isinstance(node, dict):
+            for k, v in node.items():
+                cls.collect_tags_of_type(v, of_type, parent=node, key=k, found=found)
+        elif isinstance(node, list):
+            for idx, item in enumerate(node):
+                cls.collect_tags_of_type(
+                    item, of_type, parent=node, key=idx, found=found
+                )
+        return found
+
+    @property
+    def tag_index(self):
+        if self._tag_index is None or not self._tag_index.is_current(self.data):
+            self._tag_index = TagIndex(self.data)
+        return self._tag_index
+
+    def reindex(self):
+        """Rebuild the tag index, needed after self.data is mutated by hand."""
+        self._tag_index = TagIndex(self.data)
+        self.invalidate()
+        return self._tag_index
+
+    def invalidate(self, node=None):
+        """
+        Drop the memoized dicts built from node, a !default or !env section,
+        along with the whole document's. Any other node, or none, drops them
+        all. Call after mutating a section by hand, the walks do it for you.
+        """
+        if self._dict_cache_data is not self.data:
+            self._dict_cache = {}
+            self._dict_cache_data = self.data
+            return
+
+        env_names = []
+        if node is not None and not self.tag_index.nested_sections:
+            env_names = [
+                name
+                for name, env_node in self.tag_index.envs_by_name.items()
+                if env_node is node
+            ]
+        if not env_names:
+            # the default section, or a node we can not attribute to one env
+            self._dict_cache = {}
+            return
+
+        self._dict_cache.pop(id(node), None)
+        self._dict_cache.pop(id(self.data), None)
+        for name in list(env_names):
+            # envs inheriting from a changed env merged its values too
+            env_names.extend(self.tag_index.descendants(name))
+        for key in list(self._dict_cache):
+            if isinstance(key, tuple) and key[0] in env_names:
+                del self._dict_cache[key]
+
+    def _memoized(self, key, node, build):
+        if self._dict_cache_data is not self.data:
+            self.invalidate()
+        cached = self._dict_cache.get(key)
+        # node is kept alongside so a recycled id can never hit
+        if cached is None or cached[0] is not node:
+            cached = self._dict_cache[key] = (node, build())
+        return cached[1]
+
+    @property
+    def keyring(self):
+        """Envelope data keys of the document, see eyaml.envelope."""
+        if self._keyring is None or self._keyring_data is not self.data:
+            keys = self.tag_index.top_level.get(ENCRYPTION_KEYS_KEY) or {}
+            self._keyring = KeyRing({str(k): str(v) for k, v in keys.items()})
+            self._keyring_data = self.data
+        return self._keyring
+
+    def set_wrapped_key(self, vault_id, header):
+        """Stores the wrapped data key of vault_id under the top level encryption_keys."""
+        keys = self.tag_index.top_level.get(ENCRYPTION_KEYS_KEY)
+        if keys is None:
+            keys = CommentedMap() if self.mode == ROUND_TRIP_MODE else {}
+            if isinstance(self.data, CommentedMap):
+                # keep the keys next to the encryption spec, ahead of the sections
+                top_level_names = [str(k) for k in self.data.keys()]
+                position = 0
+                for name in ("version", "encryption_method"):
+                    if name in top_level_names:
+                        position = top_level_names.index(name) + 1
+                self.data.insert(position, ENCRYPTION_KEYS_KEY, keys)
+            else:
+                self.data[ENCRYPTION_KEYS_KEY] = keys
+            self.tag_index.top_level[ENCRYPTION_KEYS_KEY] = keys
+
+        key = next((k for k in keys.keys() if str(k) == vault_id), vault_id)
+        keys[key] = header
+        self.keyring.wrapped_keys[vault_id] = header
+        self.invalidate(keys)
+
+    def has_tag_of_type(self, node, of_type):
+        count = self.tag_index.count(node, of_type)
+        if count is None:
+            return self.contains_tag_of_type(node, of_type)
+        return count > 0
+
     def validate(self):
-        self.get_default()
-        if len(self.envs) == 0:
-            raise NoEnvironmentsDefinedException()
-        self.version_check()
-        self.encryption_spec_check()
+        with timed(self.metrics, "validate"):
+            self.reindex()
+            self.get_default()
+            if len(self.envs) == 0:
+                raise NoEnvironmentsDefinedException()
+            for name in self.tag_index.extends:
+                # raises on unknown parents and cycles
+                self.tag_index.env_chain(name)
+            self.version_check()
+            self.encryption_spec_check()
+
+    def missing_required_keys(self, envs=None):
+        """
+        The !required keys of the default section each env, or each of envs,
+        leaves undefined, as {env: [key paths]} holding only envs with
+        missing keys. An env defines a key when it or an env it extends does.
+
+        Every section is walked once into a set of its key paths, each
+        required key is then a set lookup per env in the chain.
+        """
+        default = self.get_default()
+        if not self.has_tag_of_type(default, RequiredString):
+            return {}
+        _, required = self.tag_index.key_paths(default)
+
+        missing = {}
+        for name in envs or self.tag_index.envs_by_name:
+            defined = [
+                self.tag_index.key_paths(self.get_env_by_name(env))[0]
+                for env in self.tag_index.env_chain(name)
+            ]
+            undefined = [
+                path
+                for path in required
+                if not any(path in paths for paths in defined)
+            ]
+            if undefined:
+                missing[name] = undefined
+        return missing
+
+    def validate_required(self, envs=None):
+        """Raises RequiredKeysMissing listing every env missing a !required key."""
+        missing = self.missing_required_keys(envs)
+        if missing:
+            raise RequiredKeysMissing(missing)
 
     def version_check(self):
-        version = self.to_dict().get("version", False)
-        if not version:
+        version = self.tag_index.top_level.get("version")
+        if version is None or not str(version):
             raise VersionTagNotSpecified()
         if str(version) != "1.0":
             raise UnsupportedVersionSpecified()
 
     def encryption_spec_check(self):
-        encryption_method = self.to_dict().get("encryption_method", self.encryption_method)
-        if str(encryption_method) not in VALID_ENCRYPTION_METHODS:
+        encryption_method = str(
+            self.tag_index.top_level.get("encryption_method", self.encryption_method)
+        )
+        if encryption_method not in VALID_ENCRYPTION_METHODS:
             raise UnsupportedEncryptionMethodSpecified(encryption_method)
 
         logger.debug(f'Using {encryption_method} encryption method')
         self.encryption_method = encryption_method
 
     def has_no_secret_tags(self, node):
-        return not self.contains_tag_of_type(node, SecretString)
+        return not self.has_tag_of_type(node, SecretString)
 
     def has_not_encrypted_tags(self, node):
-        return not self.contains_tag_of_type(node, EncryptedString)
+        return not self.has_tag_of_type(node, EncryptedString)
 
-    def encrypt_env(self, env_name, password):
+    def encrypt_env(self, env_name, password, workers=None):
         node = self.get_env_by_name(env_name)
         if self.is_encrypted(node):
             raise EnvironmentIsAlreadyEncrypted()
@@ -176,25 +374,53 @@ class SecretYAML(ruml.YAML):
         if self.has_no_secret_tags(node):
             raise EnvironmentHasNoSecretTagsException()
 
-        self.encrypt_walk(node, password)
+        self.encrypt_walk(node, password, workers=workers, vault_id=env_name)
         logger.info(f"Encrypted environment {env_name}")
 
-    def decrypt_env(self, env_name, password, raise_exception=True):
+    def decrypt_env(self, env_name, password, raise_exception=True, workers=None):
         node = self.get_env_by_name(env_name)
         if self.is_decrypted(node):
             if raise_exception:
                 raise EnvironmentIsAlreadyDecrypted()
 
-        self.decrypt_walk(node, password, raise_exception=raise_exception)
+        self.decrypt_walk(
+            node,
+            password,
+            raise_exception=raise_exception,
+            workers=workers,
+            vault_id=env_name,
+        )
         logger.info(f"Encrypted environment {env_name}")
 
-    def encrypt_default(self, password):
+    def encrypt_default(self, password, workers=None):
         node = self.get_default()
-        self.encrypt_walk(node, password)
+        self.encrypt_walk(node, password, workers=workers, vault_id=DEFAULT_VAULT_ID)
 
-    def decrypt_default(self, password, raise_exception=True):
+    def decrypt_default(self, password, raise_exception=True, workers=None):
         node = self.get_default()
-        self.decrypt_walk(node, password, raise_exception=raise_exception)
+        self.decrypt_walk(
+            node,
+            password,
+            raise_exception=raise_exception,
+            workers=workers,
+            vault_id=DEFAULT_VAULT_ID,
+        )
+
+    def rekey_env(self, env_name, old_password, new_password, workers=None):
+        node = self.get_env_by_name(env_name)
+        return self.rekey_walk(
+            node, old_password, new_password, workers=workers, vault_id=env_name
+        )
+
+    def rekey_default(self, old_password, new_password, workers=None):
+        node = self.get_default()
+        return self.rekey_walk(
+            node,
+            old_password,
+            new_password,
+            workers=workers,
+            vault_id=DEFAULT_VAULT_ID,
+        )
 
     def is_default_encrypted(self):
         node = self.get_default()
@@ -204,34 +430,243 @@ class SecretYAML(ruml.YAML):
         node = self.get_default()
         return self.is_decrypted(node)
 
-    def encrypt_walk(self, node, password):
-        if isinstance(node, SecretString):
-            encrypted_string = encrypt_value(node.value, password, node)
-            node = EncryptedString(encrypted_string, style=node.style)
-        elif isinstance(node, dict):
-            for k, v in node.items():
-                node[k] = self.encrypt_walk(v, password)
-        elif isinstance(node, list):
-            for idx, item in enumerate(node):
-                node[idx] = self.encrypt_walk(item, password)
-        return node
+    def encrypt_tags(self, tags, password, workers=None, vault_id=None):
+        """
+        Encrypts the values of tags with the document's encryption method.
+        Ansible vault values are fanned out across `workers` processes, envelope
+        values all share the env's data key, derived once from the password.
+        """
+        if not tags:
+            return []
+        with timed(self.metrics, "encrypt", len(tags)):
+            if self.encryption_method != ENVELOPE_ENCRYPTION_METHOD:
+                return encrypt_values(
+                    [str(tag.value) for tag in tags],
+                    password,
+                    nodes=tags,
+                    workers=workers,
+                    vault_id=vault_id,
+                )
 
-    def decrypt_walk(self, node, password, raise_exception=True):
-        if isinstance(node, EncryptedString):
-            decrypted_string = decrypt_value(
-                node.value, password, node, raise_exception=raise_exception
+            vault_id = vault_id or DEFAULT_VAULT_ID
+            # a wrong password only gets a new data key when no value needs the old one
+            data_key, header = self.keyring.encryption_key(
+                vault_id, password, replace=not self.has_envelope_values(vault_id)
             )
-            node = SecretString(decrypted_string, style=node.style)
-        elif isinstance(node, dict):
-            for k, v in node.items():
-                node[k] = self.decrypt_walk(
-                    v, password, raise_exception=raise_exception
+            if header is not None:
+                self.set_wrapped_key(vault_id, header)
+            return [
+                encrypt_with_data_key(str(tag.value), data_key, vault_id)
+                for tag in tags
+            ]
+
+    def has_envelope_values(self, vault_id):
+        """Whether any value of the document is encrypted with vault_id's data key."""
+        return any(
+            is_envelope_value(tag.value) and get_vault_id(tag.value) == vault_id
+            for _, _, tag in self.collect_tags_of_type(self.data, EncryptedString)
+        )
+
+    def decrypt_tags(
+        self, tags, password, raise_exception=True, workers=None, vault_id=None
+    ):
+        """
+        Decrypts the values of tags in order, ansible vault and envelope
+        values side by side, returning None for values that failed.
+        """
+        if not tags:
+            return []
+        envelope_tags = [tag for tag in tags if is_envelope_value(tag.value)]
+        vault_tags = [tag for tag in tags if not is_envelope_value(tag.value)]
+        with timed(self.metrics, "decrypt", len(tags)):
+            decrypted = dict(
+                zip(
+                    map(id, vault_tags),
+                    decrypt_values(
+                        [tag.value for tag in vault_tags],
+                        password,
+                        nodes=vault_tags,
+                        raise_exception=raise_exception,
+                        workers=workers,
+                        vault_id=vault_id,
+                    ),
                 )
-        elif isinstance(node, list):
-            for idx, item in enumerate(node):
-                node[idx] = self.decrypt_walk(
-                    item, password, raise_exception=raise_exception
+            )
+            for tag in envelope_tags:
+                decrypted[id(tag)] = self.keyring.decrypt_value(
+                    tag.value,
+                    password,
+                    tag,
+                    raise_exception=raise_exception,
+                    vault_id=vault_id or DEFAULT_VAULT_ID,
                 )
+        results = [decrypted[id(tag)] for tag in tags]
+        # values the password did not open, e.g. while trying several passwords
+        record(self.metrics, "decrypt_failed", results.count(None))
+        return results
+
+    def encrypt_walk(self, node, password, workers=None, vault_id=None):
+        """
+        Encrypt every !secret value under node as one batch, fanned out across
+        `workers` processes, keeping the original style of each value.
+        A vault_id labels the ciphertext with a Vault 1.2 header.
+
+        Secrets which still hold the plaintext they were decrypted from get
+        their original ciphertext back, only new or changed secrets are
+        encrypted.
+        """
+        envelope = self.encryption_method == ENVELOPE_ENCRYPTION_METHOD
+        section = node
+        found = self.collect_tags_of_type(node, SecretString)
+        changed = [
+            (parent, key, tag)
+            for parent, key, tag in found
+            if not (
+                can_reuse_ciphertext(tag, password, vault_id=vault_id)
+                and is_envelope_value(tag.origin[0]) == envelope
+            )
+        ]
+        encrypted_strings = self.encrypt_tags(
+            [tag for _, _, tag in changed],
+            password,
+            workers=workers,
+            vault_id=vault_id,
+        )
+        ciphertexts = {
+            id(tag): encrypted_string
+            for (_, _, tag), encrypted_string in zip(changed, encrypted_strings)
+        }
+        for parent, key, tag in found:
+            encrypted_string = ciphertexts.get(id(tag))
+            if encrypted_string is None:
+                encrypted_string = tag.origin[0]
+            encrypted = EncryptedString(encrypted_string, style=tag.style)
+            if parent is None:
+                node = encrypted
+            else:
+                parent[key] = encrypted
+        if not self.tag_index.moved(node, SecretString, EncryptedString, len(found)):
+            self.reindex()
+        self.invalidate(section)
+        logger.debug(f"Encrypted {len(changed)} of {len(found)} secrets")
+        return node
+
+    def decrypt_walk(
+        self, node, password, raise_exception=True, workers=None, vault_id=None
+    ):
+        """
+        Decrypt every !encrypted value under node. All values are gathered
+        first so they can be decrypted concurrently across `workers` processes,
+        values that fail to decrypt are left encrypted.
+
+        password may be a dict of vault-id labels to passwords, each value is
+        then decrypted once with the password matching its header label, or
+        vault_id when the value is unlabelled.
+        """
+        section = node
+        found = self.collect_tags_of_type(node, EncryptedString)
+        decrypted_strings = self.decrypt_tags(
+            [tag for _, _, tag in found],
+            password,
+            raise_exception=raise_exception,
+            workers=workers,
+            vault_id=vault_id,
+        )
+        decrypted_count = 0
+        for (parent, key, tag), decrypted_string in zip(found, decrypted_strings):
+            if decrypted_string is None:
+                continue
+            secret = SecretString(
+                decrypted_string,
+                style=tag.style,
+                origin=(
+                    tag.value,
+                    decrypted_string,
+                    password_fingerprint(
+                        tag.value,
+                        resolve_password(tag.value, password, vault_id=vault_id),
+                    ),
+                ),
+            )
+            decrypted_count += 1
+            if parent is None:
+                node = secret
+            else:
+                parent[key] = secret
+        if not self.tag_index.moved(
+            node, EncryptedString, SecretString, decrypted_count
+        ):
+            self.reindex()
+        self.invalidate(section)
+        return node
+
+    def rekey_walk(
+        self, node, old_password, new_password, workers=None, vault_id=None
+    ):
+        """
+        Re-encrypt every !encrypted value under node from old_password to
+        new_password in memory. Ansible vault values are decrypted and
+        re-encrypted within the same worker process, envelope values keep
+        their ciphertext and only the env's data key is wrapped again.
+        Raises when a value does not decrypt with old_password, leaving the
+        document unchanged.
+        """
+        vault_id = vault_id or DEFAULT_VAULT_ID
+        section = node
+        found = self.collect_tags_of_type(node, EncryptedString)
+        vault_found = [
+            (parent, key, tag)
+            for parent, key, tag in found
+            if not is_envelope_value(tag.value)
+        ]
+
+        with timed(self.metrics, "rekey", len(vault_found)):
+            encrypted_strings = rekey_values(
+                [tag.value for _, _, tag in vault_found],
+                old_password,
+                new_password,
+                nodes=[tag for _, _, tag in vault_found],
+                workers=workers,
+                vault_id=vault_id,
+            )
+
+        if vault_id in self.keyring.wrapped_keys:
+            self.set_wrapped_key(
+                vault_id,
+                self.keyring.rewrap_key(vault_id, old_password, new_password),
+            )
+        for (parent, key, tag), encrypted_string in zip(vault_found, encrypted_strings):
+            encrypted = EncryptedString(encrypted_string, style=tag.style)
+            if parent is None:
+                node = encrypted
+            else:
+                parent[key] = encrypted
+        self.invalidate(section)
+        logger.debug(f"Rekeyed {len(found)} values of {vault_id}")
+        return node
+
+    def lazy_decrypt_walk(self, node, password, vault_id=None):
+        """
+        Swap every !encrypted value under node for a LazySecret handle which
+        decrypts on first use, nothing is decrypted up front.
+        """
+        section = node
+        found = self.collect_tags_of_type(node, EncryptedString)
+        for parent, key, tag in found:
+            secret = LazySecret(
+                tag.value,
+                password,
+                vault_id=vault_id,
+                style=tag.style,
+                keyring=self.keyring,
+            )
+            if parent is None:
+                node = secret
+            else:
+                parent[key] = secret
+        if not self.tag_index.moved(node, EncryptedString, LazySecret, len(found)):
+            self.reindex()
+        self.invalidate(section)
         return node
 
     def load_file(self, filepath):
@@ -240,10 +675,23 @@ class SecretYAML(ruml.YAML):
 
         with open(filepath, "r") as stream:
             data_str = stream.read()
-            self.representer.ignore_aliases = lambda *data: True
+        self.representer.ignore_aliases = lambda *data: True
+        with timed(self.metrics, "parse"):
             return self.load(data_str)
 
+    def load_string(self, content):
+        """
+        Loads and validates content in place of a file, e.g. a config read
+        from a git revision.
+        """
+        with timed(self.metrics, "parse"):
+            self.data = self.load(content)
+        self.validate()
+        return self.data
+
     def save_file(self, filepath=None):
+        if self.mode == READ_MODE:
+            raise ReadOnlyModeException()
         if filepath is None:
             filepath = self.filepath
 
@@ -261,9 +709,10 @@ class SecretYAML(ruml.YAML):
         return self.load(stream)
 
     def get_default(self, node=None):
-        if node is None:
-            node = self.data
-        base = self.get_tags_of_type(node, DefaultSecretConfigMap)
+        if node is None or node is self.data:
+            base = self.tag_index.defaults
+        else:
+            base = self.get_tags_of_type(node, DefaultSecretConfigMap)
         base_count = len(base.keys())
         if base_count == 0:
             raise NoDefaultMapTagDefinedException()
@@ -271,22 +720,21 @@ class SecretYAML(ruml.YAML):
         if base_count != 1:
             raise TooManyDefaultMapTagsDefinedException()
 
-        default_env_key = list(base.keys())[0]
-        return self.data[default_env_key]
+        return next(iter(base.values()))
 
     @property
     def envs(self):
-        return self.get_tags_of_type(self.data, EnvSecretConfigMap)
+        return dict(self.tag_index.envs)
 
     @property
     def env_names(self):
         return list(self.envs.keys())
 
     def get_env_by_name(self, name):
-        mapping_by_str = {str(k): v for k, v in self.envs.items()}
-        if name not in list(mapping_by_str.keys()):
+        try:
+            return self.tag_index.envs_by_name[name]
+        except KeyError:
             raise EnvironmentNotFound(msg=f"Environment of {name} not found")
-        return mapping_by_str[name]
 
     def env(self, env_name):
         if env_name == "default":
@@ -308,30 +756,41 @@ class SecretYAML(ruml.YAML):
     def is_encrypted(self, node=None):
         if node is None:
             node = self.data
-        if self.contains_tag_of_type(node, SecretString):
+        if self.has_tag_of_type(node, SecretString):
             logger.warning(CONTAINS_UNENCRYPTED_TAGS)
-        return self.contains_tag_of_type(node, EncryptedString)
+        return self.has_tag_of_type(node, EncryptedString)
 
     def is_decrypted(self, node=None):
         if node is None:
             node = self.data
-        if self.contains_tag_of_type(node, EncryptedString):
-            pass
-            # logger.warning(CONTAINS_ENCRYPTED_TAGS)
-
-        return self.contains_tag_of_type(node, SecretString)
+        return self.has_tag_of_type(node, SecretString)
 
     def to_dict(self, node=None):
+        """
+        The node, or the whole document, as read-only FrozenDict/FrozenList
+        views. Sections and the document are memoized until a walk or
+        invalidate() touches them, copy the result to modify it.
+        """
         if node is None:
             node = self.data
+        if node is not self.data and id(node) not in self.tag_index.counts:
+            return self._timed_to_dict(node)
+        return self._memoized(id(node), node, lambda: self._timed_to_dict(node))
+
+    def _timed_to_dict(self, node):
+        with timed(self.metrics, "to_dict"):
+            return self._to_dict(node)
+
+    def _to_dict(self, node):
         if isinstance(node, EncryptedString):
             # TODO: raise warning on encrypted string being dict dumped
             return f"{node.value}"
-        if isinstance(node, CommentedMap):
-            return {f"{k}": self.to_dict(v) for k, v in node.items()}
-        elif isinstance(node, CommentedSeq):
-            return [self.to_dict(item) for item in node]
-        elif isinstance(node, ScalarFloat):
+        if isinstance(node, dict):
+            # CommentedMap in round trip mode, dict in read mode
+            return FrozenDict({f"{k}": self._to_dict(v) for k, v in node.items()})
+        elif isinstance(node, list):
+            return FrozenList(self._to_dict(item) for item in node)
+        elif isinstance(node, (ScalarFloat, float, str)):
             return node
         elif isinstance(node, ScalarNode):
             return f"{node}"
@@ -339,10 +798,13 @@ class SecretYAML(ruml.YAML):
             return f"{node}"
         elif isinstance(node, SecretString):
             return f"{node.value}"
-        elif isinstance(node, int):
+        elif isinstance(node, RequiredString):
+            # the placeholder an env is expected to override
+            return node.value
+        elif isinstance(node, LazySecret):
             return node
         else:
-            print(type(node))
+            # ints, bools, None, dates and any other scalar as they are
             return node
 
     def get_default_as_dict(self):
@@ -350,18 +812,67 @@ class SecretYAML(ruml.YAML):
         default_dict = self.to_dict(default_node)
         return default_dict
 
-    def get_env_as_dict(self, env, use_default=True):
-        default_node = self.get_default()
+    def get_env_as_dict(self, env, use_default=True, layered=False, strategies=None):
+        """
+        The env merged over the default section as a read-only view, memoized
+        per env, the merge shares every value it did not have to merge.
+
+        With layered set a LayeredMapping over the default and env dicts is
+        returned instead, which resolves keys on access without building a
+        merged dict at all. strategies, e.g. {"allowed_hosts": "append"},
+        picks how individual keys are combined, see LayeredMapping.
+        """
         env_node = self.get_env_by_name(env)
+        env_node_dict = self._own_env_dict(env, env_node)
+        if not use_default:
+            return env_node_dict
+
+        if strategies:
+            # not memoized, strategies vary per call
+            return self._layer_env(env, env_node_dict, layered, strategies)
+        return self._memoized(
+            (env, "layered" if layered else "merged"),
+            env_node,
+            lambda: self._layer_env(env, env_node_dict, layered),
+        )
+
+    def get_env_chain(self, env):
+        """
+        Names of the envs env inherits from through __extends__, outermost
+        first and ending with env, all of them merged over the default.
+        """
+        return list(self.tag_index.env_chain(env))
+
+    def _own_env_dict(self, env, env_node):
         env_node_dict = self.to_dict(env_node)
-        if use_default:
-            default_dict = self.to_dict(default_node)
-            default_dict = deep_update(default_dict, env_node_dict)
-            return default_dict
-        return env_node_dict
+        if EXTENDS_KEY not in env_node_dict:
+            return env_node_dict
+        return self._memoized(
+            (env, "own"),
+            env_node,
+            lambda: FrozenDict(
+                (k, v) for k, v in env_node_dict.items() if k != EXTENDS_KEY
+            ),
+        )
+
+    def _layer_env(self, env, env_node_dict, layered, strategies=None):
+        chain = self.tag_index.env_chain(env)
+        if len(chain) > 1:
+            # the parent's memoized snapshot, shared by all of its children
+            base = self.get_env_as_dict(
+                chain[-2], layered=layered, strategies=strategies
+            )
+        else:
+            base = self.to_dict(self.get_default())
+        layers = LayeredMapping(base, env_node_dict, strategies=strategies)
+        if layered:
+            return layers
+        with timed(self.metrics, "merge"):
+            return layers.materialize()
 
     def patch_object_with_env(self, obj, env_name):
-        env = self.get_env_as_dict(env_name)
+        # plain copies, the object owns and may modify what it is patched with
+        env = thaw(self.get_env_as_dict(env_name))
         if isinstance(obj, dict):
             obj = deep_update(obj, env)
             return obj
@@ -373,6 +884,9 @@ class SecretYAML(ruml.YAML):
             return obj
 
     def patch_environs(self, env):
+        # django and django-environ are only needed here
+        from .environ_helper import generate_dynamic_environ
+
         obj = {}
         config = self.get_env_as_dict(env)
         return generate_dynamic_environ(config)
@@ -0,0 +1,290 @@
+"""
+Hot reload of the settings of one env when its config file changes.
+
+A SettingsWatcher keeps the resolved settings as an immutable snapshot and
+checks the file by polling its inode, mtime and size, or through inotify
+when the optional inotify_simple package is installed. The file is only
+parsed again when the sha256 of its contents changed, and only values whose
+ciphertext changed are decrypted again, unchanged ciphertexts reuse the
+plaintext of the previous load.
+"""
+import os
+import hashlib
+import logging
+import threading
+
+from .constants import READ_MODE, DEFAULT_VAULT_ID
+from .instrumentation import timed
+from .utils import ForkSafeLock
+
+logger = logging.getLogger("eyaml")
+
+MISSING = object()
+
+
+def changed_keys(old, new, path=""):
+    """
+    Dotted key paths, e.g. "DATABASES.default.HOST", that were added, removed
+    or changed between two settings dicts. Dicts are compared key by key,
+    anything else, lists included, as a whole.
+    """
+    changed = []
+    if isinstance(old, dict) and isinstance(new, dict):
+        if old is new:
+            return changed
+        for key in list(old) + [k for k in new if k not in old]:
+            key_path = f"{path}.{key}" if path else f"{key}"
+            changed.extend(
+                changed_keys(old.get(key, MISSING), new.get(key, MISSING), key_path)
+            )
+    elif old is MISSING or new is MISSING or old != new:
+        changed.append(path)
+    return changed
+
+
+def _matches(changed, keys):
+    """Whether any changed path is one of keys, nested under one, or holds one."""
+    for path in changed:
+        for key in keys:
+            if path == key or path.startswith(key + ".") or key.startswith(path + "."):
+                return True
+    return False
+
+
+class SettingsWatcher:
+    """
+    The settings of environment, as loaded by load_settings_from_config,
+    reloaded whenever the config file changes.
+
+    settings is always a complete read-only snapshot, a reload builds a new
+    one and swaps it in with a single assignment, so readers never see a half
+    updated dict. Hold on to the snapshot for the length of a request to see
+    consistent values throughout.
+
+    Reload failures, e.g. a half written file, are logged and the previous
+    snapshot is kept. The polling thread does not survive a fork, start it in
+    each worker, e.g. from gunicorn's post_fork hook.
+    """
+
+    def __init__(
+        self,
+        config_file_path,
+        environment,
+        passwords=None,
+        password_files=None,
+        interval=1.0,
+        workers=None,
+        metrics=None,
+    ):
+        from .django import collect_passwords
+
+        if not os.path.isfile(config_file_path):
+            raise FileNotFoundError(f"{config_file_path} found not be found")
+        self.filepath = config_file_path
+        self.environment = environment
+        self.labelled, self.unlabelled = collect_passwords(passwords, password_files)
+        self.interval = interval
+        self.workers = workers
+        self.metrics = metrics
+        self.settings = None
+        self.content_hash = None
+        self.last_error = None
+        # plaintexts of the last load by ciphertext
+        self._plaintexts = {}
+        self._signature = None
+        self._subscribers = []
+        self._lock = ForkSafeLock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.check(raise_exception=True)
+
+    def subscribe(self, callback, keys=None):
+        """
+        Calls callback(settings, changed) after every reload that changed a
+        key, changed being the sorted dotted key paths. With keys given, e.g.
+        ["CACHES", "FEATURE_LIMIT"], only reloads touching one of them or
+        anything nested under them are reported.
+        """
+        self._subscribers.append((callback, keys))
+        return callback
+
+    def unsubscribe(self, callback):
+        self._subscribers = [
+            (subscriber, keys)
+            for subscriber, keys in self._subscribers
+            if subscriber is not callback
+        ]
+
+    def check(self, raise_exception=False):
+        """
+        Reloads the settings when the file changed since the last check,
+        returning the changed key paths, empty when nothing changed.
+        """
+        with self._lock:
+            try:
+                notify, changed = self._check()
+                settings = self.settings
+            except Exception as e:
+                if raise_exception:
+                    raise
+                self.last_error = e
+                logger.error(f"Could not reload {self.filepath}: {e}")
+                return []
+        # outside the lock, subscribers may call check() themselves
+        if notify:
+            self._notify(settings, changed)
+        return changed
+
+    def _check(self):
+        """
+        Swaps in new settings when the file changed, returns whether
+        subscribers should be notified and the changed key paths.
+        """
+        try:
+            stat = os.stat(self.filepath)
+        except FileNotFoundError:
+            # editors replacing the file may briefly remove it
+            return False, []
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return False, []
+
+        with open(self.filepath, "rb") as stream:
+            content = stream.read()
+        self._signature = signature
+        content_hash = hashlib.sha256(content).hexdigest()
+        if content_hash == self.content_hash:
+            # touched or rewritten with the same contents
+            return False, []
+
+        with timed(self.metrics, "reload"):
+            settings = self._load(content.decode())
+        changed = sorted(changed_keys(self.settings or {}, settings))
+        previous = self.settings
+        self.settings = settings
+        self.content_hash = content_hash
+        self.last_error = None
+        return previous is not None and bool(changed), changed
+
+    def _load(self, content):
+        from .processor import SecretYAML
+        from .tags import EncryptedString, SecretString
+
+        config = SecretYAML(mode=READ_MODE, metrics=self.metrics)
+        config.filepath = self.filepath
+        config.load_string(content)
+
+        sections = [DEFAULT_VAULT_ID] + config.get_env_chain(self.environment)
+        reused = 0
+        for section in sections:
+            for parent, key, tag in config.collect_tags_of_type(
+                config.env(section), EncryptedString
+            ):
+                plaintext = self._plaintexts.get(tag.value)
+                if plaintext is not None and parent is not None:
+                    parent[key] = SecretString(
+                        plaintext, style=tag.style, origin=(tag.value, plaintext, None)
+                    )
+                    reused += 1
+        if reused:
+            config.reindex()
+
+        for section in sections:
+            node = config.env(section)
+            # not is_encrypted, which warns about the reused plaintexts
+            if not config.has_tag_of_type(node, EncryptedString):
+                continue
+            if not (self.labelled or self.unlabelled):
+                raise Exception("No passwords or password files specified")
+            if self.labelled:
+                config.decrypt_walk(
+                    node,
+                    self.labelled,
+                    raise_exception=False,
+                    workers=self.workers,
+                    vault_id=section,
+                )
+            for password in self.unlabelled:
+                if not config.has_tag_of_type(node, EncryptedString):
+                    break
+                config.decrypt_walk(
+                    node,
+                    password,
+                    raise_exception=False,
+                    workers=self.workers,
+                    vault_id=section,
+                )
+
+        plaintexts = {}
+        for section in sections:
+            for _, _, secret in config.collect_tags_of_type(
+                config.env(section), SecretString
+            ):
+                if secret.origin is not None:
+                    plaintexts[secret.origin[0]] = secret.origin[1]
+        # ciphertexts no longer in the file are dropped along with their plaintext
+        self._plaintexts = plaintexts
+        return config.get_env_as_dict(self.environment)
+
+    def _notify(self, settings, changed):
+        for callback, keys in list(self._subscribers):
+            if keys is not None and not _matches(changed, keys):
+                continue
+            try:
+                callback(settings, changed)
+            except Exception as e:
+                logger.error(f"Settings subscriber {callback!r} failed: {e}")
+
+    def start(self):
+        """Checks the file from a daemon thread until stop() is called."""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="eyaml-settings-watcher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stops the thread, waiting up to timeout seconds for it to end."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if not self._thread.is_alive():
+                self._thread = None
+
+    def _run(self):
+        wait = self._inotify_waiter() or self._stopped.wait
+        while not self._stopped.is_set():
+            wait(self.interval)
+            if not self._stopped.is_set():
+                self.check()
+
+    def _inotify_waiter(self):
+        """
+        A wait(timeout) returning early when the config file's directory sees
+        a write or rename, None without inotify_simple. The directory is
+        watched since editors and deploys usually replace the file.
+        """
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            return None
+
+        inotify = INotify()
+        inotify.add_watch(
+            os.path.dirname(os.path.abspath(self.filepath)),
+            flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE,
+        )
+        filename = os.path.basename(self.filepath)
+
+        def wait(timeout):
+            for event in inotify.read(timeout=int(timeout * 1000)):
+                if event.name == filename:
+                    return
+
+        return wait
+
+    def __repr__(self):
+        return f"<SettingsWatcher {self.filepath} {self.environment}>"
@@ -77,10 +77,13 @@ class SecretString:
     yaml_tag = "!secret"
     alias_key = None
     style = None
+    # set when decrypted from an !encrypted value, (ciphertext, plaintext, password fingerprint)
+    origin = None
 
-    def __init__(self, value, style=None):
+    def __init__(self, value, style=None, origin=None):
         self.value = value
         self.style = style
+        self.origin = origin
 
     @classmethod
     def to_yaml(cls, representer, node):
@@ -1,14 +1,67 @@
+import os
+import hmac
+import hashlib
+import logging
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from typing import (
     Any,
     Dict,
+    List,
     TypeVar,
 )
 
-from ansible.parsing.vault import VaultLib, VaultSecret, AnsibleVaultError
-from ansible.constants import DEFAULT_VAULT_ID_MATCH
+from .constants import DEFAULT_VAULT_ID
 
 KeyType = TypeVar("KeyType")
 
+logger = logging.getLogger("eyaml")
+
+
+class ForkSafeLock:
+    """
+    A threading.Lock that is replaced after a fork. A lock held by another
+    thread when the process forked would never be released in the child, so
+    every ForkSafeLock gets a fresh lock in the child through
+    os.register_at_fork, before any thread of the child can touch it. Servers
+    which fork from C, like uwsgi, skip that hook, for them the first use in
+    a new PID replaces the lock instead.
+    """
+
+    def __init__(self):
+        self._reset(os.getpid())
+        _fork_safe_locks.add(self)
+
+    def _reset(self, pid):
+        # the lock first, a thread seeing the new PID must see the new lock
+        self._lock = threading.Lock()
+        self._pid = pid
+
+    def __enter__(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._reset(pid)
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
+_fork_safe_locks = weakref.WeakSet()
+
+
+def _reset_fork_safe_locks():
+    pid = os.getpid()
+    for lock in list(_fork_safe_locks):
+        lock._reset(pid)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_fork_safe_locks)
+
 
 def deep_update(
     mapping: Dict[KeyType, Any], *updating_mappings: Dict[KeyType, Any]
@@ -27,29 +80,216 @@ def deep_update(
     return updated_mapping
 
 
-def encrypt_value(value, password, node):
+def get_vault_id(value):
+    """
+    Returns the vault-id label from a Vault 1.2 header, e.g.
+    $ANSIBLE_VAULT;1.2;AES256;dev, or None for unlabelled ciphertext.
+    """
+    header = value.split("|", 1)[0].strip().split(";")
+    if len(header) >= 4 and header[3]:
+        return header[3]
+    return None
+
+
+def resolve_password(value, password, vault_id=None):
+    """
+    Picks the password for a ciphertext. When password is a dict of vault-id
+    labels to passwords, the label in the ciphertext header is used, falling
+    back to vault_id for unlabelled values. Returns None if no label matches.
+    """
+    if not isinstance(password, dict):
+        return password
+    label = get_vault_id(value) or vault_id
+    return password.get(label)
+
+
+def password_fingerprint(ciphertext, password):
+    """
+    Fingerprint of the password a ciphertext was decrypted with, keyed by the
+    ciphertext so it can not be compared across values.
+    """
+    if not isinstance(password, str):
+        return None
+    return hmac.new(ciphertext.encode(), password.encode(), hashlib.sha256).digest()
+
+
+def can_reuse_ciphertext(secret, password, vault_id=None):
+    """
+    True when a !secret still holds the plaintext it was decrypted from, and
+    would be encrypted with the same password and vault-id label, so the
+    original ciphertext can be written back instead of encrypting again.
+    """
+    if secret.origin is None:
+        return False
+    ciphertext, plaintext, fingerprint = secret.origin
+    label = get_vault_id(ciphertext)
+    if label is None and vault_id == DEFAULT_VAULT_ID:
+        # ansible writes values for the default vault-id without a label
+        label = DEFAULT_VAULT_ID
+    return (
+        secret.value == plaintext
+        and label == vault_id
+        and fingerprint is not None
+        and hmac.compare_digest(password_fingerprint(ciphertext, password), fingerprint)
+    )
+
+
+def get_vault(password, vault_id=None):
+    """
+    A VaultLib holding password as the secret of vault_id, or of ansible's
+    default identity. With ANSIBLE_VAULT_ID_MATCH set ansible only tries the
+    secret whose label matches the value's header, so it has to be the real one.
+    """
+    # ansible is only imported once something is actually encrypted or
+    # decrypted, importing it costs more than parsing most configs
+    from ansible.parsing.vault import VaultLib, VaultSecret
+    from ansible.constants import DEFAULT_VAULT_IDENTITY
+
+    return VaultLib(
+        [(vault_id or DEFAULT_VAULT_IDENTITY, VaultSecret(password.encode()))]
+    )
+
+
+def encrypt_value(value, password, node, vault_id=None):
+    from ansible.parsing.vault import AnsibleVaultError
+
     try:
-        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(password.encode()))])
-        encrypted_value = vault.encrypt(value.encode())
+        vault = get_vault(password, vault_id)
+        encrypted_value = vault.encrypt(value.encode(), vault_id=vault_id)
         return encrypted_value.decode().replace(
             "\n", "|"
         )  # replace new lines with pipe
     except Exception as e:
-        print(f"Error during encryption: {e}")
+        logger.error(f"Error during encryption: {e}")
         raise AnsibleVaultError(f"Could not encrypt node: {node}")
 
 
-def decrypt_value(value, password, node, raise_exception=True):
+def decrypt_value(value, password, node, raise_exception=True, vault_id=None):
+    from ansible.parsing.vault import AnsibleVaultError
+
+    password = resolve_password(value, password, vault_id=vault_id)
+    if password is None:
+        # no labelled password for this value, skip the key derivation entirely
+        logger.debug(f"No password for vault-id {get_vault_id(value) or vault_id}")
+        if raise_exception:
+            raise AnsibleVaultError(f"No password to decrypt node: {node}")
+        return None
+
     try:
-        vault = VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(password.encode()))])
+        # unlabelled values are read as ansible's default identity
+        vault = get_vault(password, get_vault_id(value))
         decrypted_value = vault.decrypt(
             value.replace("|", "\n").encode()
         )  # replace pipe with new lines
         return decrypted_value.decode()
     except Exception as e:
-        print(f"Error during decryption: {e}")
         if raise_exception:
-            raise AnsibleVaultError(f"Could not encrypt node: {node}")
+            logger.error(f"Error during decryption: {e}")
+            raise AnsibleVaultError(f"Could not decrypt node: {node}")
+        logger.debug(f"Error during decryption: {e}")
+
+
+def rekey_value(value, old_password, new_password, node, vault_id=None):
+    """
+    Re-encrypts value under new_password, decrypting and encrypting in the
+    same process so the plaintext never has to be handed back.
+    """
+    plaintext = decrypt_value(value, old_password, node, vault_id=vault_id)
+    return encrypt_value(plaintext, new_password, node, vault_id=vault_id)
+
+
+def run_in_pool(func, *iterables, workers=None):
+    """
+    Map func over iterables, in a process pool when workers is greater than 1.
+    Results are always returned in the order of the input.
+    """
+    iterables = [list(iterable) for iterable in iterables]
+    if not workers or workers <= 1 or len(iterables[0]) <= 1:
+        return list(map(func, *iterables))
+
+    chunksize = max(1, len(iterables[0]) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, *iterables, chunksize=chunksize))
+
+
+def encrypt_values(
+    values: List[str], password, nodes=None, workers=None, vault_id=None
+) -> List[str]:
+    if nodes is None:
+        nodes = values
+    return run_in_pool(
+        encrypt_value,
+        values,
+        repeat(password, len(values)),
+        nodes,
+        repeat(vault_id, len(values)),
+        workers=workers,
+    )
+
+
+def decrypt_values(
+    values: List[str],
+    password,
+    nodes=None,
+    raise_exception=True,
+    workers=None,
+    vault_id=None,
+) -> List[str]:
+    if nodes is None:
+        nodes = values
+    return run_in_pool(
+        decrypt_value,
+        values,
+        repeat(password, len(values)),
+        nodes,
+        repeat(raise_exception, len(values)),
+        repeat(vault_id, len(values)),
+        workers=workers,
+    )
+
+
+def verify_value(value, password, vault_id=None) -> bool:
+    """
+    True when value decrypts with password, the plaintext is dropped straight
+    away so only the result leaves a worker process.
+    """
+    return (
+        decrypt_value(value, password, value, raise_exception=False, vault_id=vault_id)
+        is not None
+    )
+
+
+def verify_values(
+    values: List[str], passwords: List, workers=None, vault_ids: List = None
+) -> List[bool]:
+    """
+    Checks values which may each need their own password and vault-id, e.g.
+    values gathered from several envs and files, in one pool.
+    """
+    if vault_ids is None:
+        vault_ids = repeat(None, len(values))
+    return run_in_pool(verify_value, values, passwords, vault_ids, workers=workers)
+
+
+def rekey_values(
+    values: List[str],
+    old_password,
+    new_password,
+    nodes=None,
+    workers=None,
+    vault_id=None,
+) -> List[str]:
+    if nodes is None:
+        nodes = values
+    return run_in_pool(
+        rekey_value,
+        values,
+        repeat(old_password, len(values)),
+        repeat(new_password, len(values)),
+        nodes,
+        repeat(vault_id, len(values)),
+        workers=workers,
+    )
 
 
 def flatten_list(matrix):
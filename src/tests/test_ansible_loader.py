@@ -0,0 +1,74 @@
+import argparse
+import os
+
+from eyaml.ansible import loader
+
+
+def path_from_fixtures(file_name):
+    return os.path.join(os.path.dirname(__file__), file_name)
+
+
+ENCRYPTED_CONFIG_PATH_1 = path_from_fixtures("fixtures/django/encrypted_01.yml")
+
+
+class Entity:
+    def __init__(self, name):
+        self.name = name
+
+
+def test_vars_plugin_decrypts_env_once_per_run(monkeypatch, tmp_path):
+    """
+    Test if the vars plugin decrypts the env once for all hosts and groups,
+    and again only once the config changes on disk.
+    """
+    password_file = tmp_path / "dev"
+    password_file.write_text("PASSWORDdev")
+    config_file = tmp_path / "config.yml"
+    config_file.write_text(open(ENCRYPTED_CONFIG_PATH_1).read())
+
+    monkeypatch.setattr(
+        loader,
+        "PARSED_ARGS",
+        [
+            argparse.Namespace(
+                playbook="server.yml",
+                inventory="inventory.yml",
+                limit="dev",
+                vault_password_file=[[str(password_file)]],
+            )
+        ],
+    )
+    monkeypatch.setattr(loader, "FOUND", {})
+    monkeypatch.setattr(loader, "NAK", set())
+    monkeypatch.setattr(loader, "SETTINGS_CACHE", {})
+
+    calls = []
+
+    def counting_load(*args, **kwargs):
+        calls.append(args)
+        return {"postgres_password": "DEVELOPMENT"}
+
+    monkeypatch.setattr(loader, "load_settings_from_config", counting_load)
+
+    plugin = loader.VarsModule()
+    monkeypatch.setattr(
+        plugin,
+        "get_option_and_origin",
+        lambda option: ("config.yml", "ini"),
+    )
+    inventory_file = tmp_path / "inventory.yml"
+    inventory_file.write_text("all:\n  hosts:\n")
+    inventory_path = str(inventory_file)
+    for name in ["all", "development", "staging", "production"]:
+        data = plugin.get_vars(None, inventory_path, [Entity(name)])
+        assert data == {"postgres_password": "DEVELOPMENT"}
+    assert len(calls) == 1
+
+    # uncached lookups still reuse the decrypted env while the file is unchanged
+    plugin.get_vars(None, inventory_path, [Entity("development")], cache=False)
+    assert len(calls) == 1
+
+    config_file.write_text(open(ENCRYPTED_CONFIG_PATH_1).read() + "\n# changed\n")
+    plugin.get_vars(None, inventory_path, [Entity("development")], cache=False)
+    assert len(calls) == 2
+
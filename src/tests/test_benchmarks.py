@@ -0,0 +1,49 @@
+import os
+import sys
+import json
+import subprocess
+
+BENCHMARK_SCRIPT = os.path.join(
+    os.path.dirname(__file__), "..", "..", "benchmarks", "bench.py"
+)
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+
+def test_benchmark_suite_reports_json():
+    """
+    Test if the benchmark suite runs against a small generated config and
+    reports a timing and peak memory for every stage as JSON.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [os.path.abspath(SRC_DIR), env.get("PYTHONPATH")])
+    )
+    output = subprocess.run(
+        [
+            sys.executable,
+            BENCHMARK_SCRIPT,
+            "--envs", "2",
+            "--keys", "12",
+            "--depth", "2",
+            "--secrets", "2",
+            "--repeat", "1",
+        ],
+        capture_output=True,
+        check=True,
+        env=env,
+        text=True,
+    ).stdout
+    report = json.loads(output)
+
+    assert report["parameters"]["envs"] == 2
+    for stage in [
+        "load_validate",
+        "encrypt_env",
+        "decrypt_env",
+        "to_dict",
+        "get_env_as_dict",
+        "save_file",
+        "load_settings_from_config",
+    ]:
+        assert report["results"][stage]["seconds"] >= 0
+        assert report["results"][stage]["peak_bytes"] > 0
@@ -0,0 +1,546 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from click.testing import CliRunner
+
+from eyaml.cli.eyaml import main
+from eyaml.diff import flatten
+from eyaml.processor import SecretYAML
+
+
+def path_from_fixtures(file_name):
+    return os.path.join(os.path.dirname(__file__), file_name)
+
+
+TEST_PASSWORD_1 = "Rna!nom8*"
+TEST_YAML_1_PATH = path_from_fixtures("fixtures/basic/test_1.yml")
+
+
+def copy_fixture(fixture_path):
+    tmp_dir = tempfile.mkdtemp(prefix="eyaml-cli")
+    tmp_location = os.path.join(tmp_dir, os.path.basename(fixture_path))
+    shutil.copy(fixture_path, tmp_location)
+    return tmp_location
+
+
+def test_encrypt_and_decrypt_with_jobs():
+    tmp_location = copy_fixture(TEST_YAML_1_PATH)
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main, ["encrypt", tmp_location, "dev", "-p", TEST_PASSWORD_1, "--jobs", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    assert SecretYAML(filepath=tmp_location).is_env_encrypted("dev")
+
+    result = runner.invoke(
+        main, ["decrypt", tmp_location, "dev", "-p", TEST_PASSWORD_1, "--jobs", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    assert SecretYAML(filepath=tmp_location).is_env_decrypted("dev")
+
+
+def test_profile_prints_phase_breakdown():
+    tmp_location = copy_fixture(TEST_YAML_1_PATH)
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main, ["--profile", "encrypt", tmp_location, "dev", "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 0, result.output
+    assert "parse" in result.stderr
+    assert "encrypt" in result.stderr
+    assert "total ms" not in result.stdout
+
+
+def copy_fixtures(fixture_path, count):
+    tmp_dir = tempfile.mkdtemp(prefix="eyaml-cli")
+    paths = []
+    for i in range(count):
+        tmp_location = os.path.join(tmp_dir, f"config_{i}.yml")
+        shutil.copy(fixture_path, tmp_location)
+        paths.append(tmp_location)
+    return tmp_dir, paths
+
+
+def test_encrypt_all_envs_across_a_glob_of_files():
+    tmp_dir, paths = copy_fixtures(TEST_YAML_1_PATH, 3)
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main,
+        [
+            "encrypt",
+            os.path.join(tmp_dir, "*.yml"),
+            "--all-envs",
+            "-p",
+            TEST_PASSWORD_1,
+            "--jobs",
+            "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    for path in paths:
+        config = SecretYAML(filepath=path)
+        assert config.is_default_encrypted()
+        for env in ["dev", "stage", "prod"]:
+            assert config.is_env_encrypted(env)
+            assert config.has_no_secret_tags(config.get_env_by_name(env))
+
+    result = runner.invoke(
+        main,
+        ["decrypt", *paths, "-e", "dev", "-e", "default", "-p", TEST_PASSWORD_1],
+    )
+    assert result.exit_code == 0, result.output
+    config = SecretYAML(filepath=paths[0])
+    assert config.get_env_as_dict("dev")["postgres_password"] == "DEVELOPMENT_PASSWORD"
+    assert config.is_env_encrypted("stage")
+
+
+def test_encrypt_skips_files_already_encrypted_without_writing():
+    tmp_location = copy_fixture(TEST_YAML_1_PATH)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["encrypt", tmp_location, "dev", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 0, result.output
+    modified = os.stat(tmp_location).st_mtime_ns
+
+    result = runner.invoke(main, ["encrypt", tmp_location, "dev", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 0, result.output
+    assert "Skipped dev" in result.output
+    assert os.stat(tmp_location).st_mtime_ns == modified
+
+
+def test_encrypt_with_vault_id_password_files():
+    tmp_location = copy_fixture(TEST_YAML_1_PATH)
+    tmp_dir = os.path.dirname(tmp_location)
+    password_files = {}
+    for env in ["dev", "stage"]:
+        password_files[env] = os.path.join(tmp_dir, f"{env}.pw")
+        with open(password_files[env], "w") as stream:
+            stream.write(f"{env}-password\n")
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main,
+        [
+            "encrypt",
+            tmp_location,
+            "dev",
+            "stage",
+            "--vault-id",
+            f"dev@{password_files['dev']}",
+            "--vault-id",
+            f"stage@{password_files['stage']}",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    config = SecretYAML(filepath=tmp_location)
+    config.decrypt_env("stage", "stage-password")
+    assert config.get_env_as_dict("stage")["postgres_password"] == "STAGING_PASSWORD"
+
+    result = runner.invoke(main, ["encrypt", tmp_location, "prod"])
+    assert result.exit_code == 1
+    assert "No password given for prod" in result.output
+
+
+def test_encrypt_staged_only_touches_files_in_the_git_index(monkeypatch):
+    tmp_dir, paths = copy_fixtures(TEST_YAML_1_PATH, 2)
+    subprocess.run(["git", "init", "-q"], cwd=tmp_dir, check=True)
+    subprocess.run(["git", "add", "config_0.yml"], cwd=tmp_dir, check=True)
+    monkeypatch.chdir(tmp_dir)
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main, ["encrypt", "--staged", "*.yml", "dev", "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 0, result.output
+    assert SecretYAML(filepath=paths[0]).is_env_encrypted("dev")
+    assert not SecretYAML(filepath=paths[1]).is_env_encrypted("dev")
+    # the encrypted file is staged again, nothing is left in the working tree
+    unstaged = subprocess.run(
+        ["git", "diff", "--name-only"], cwd=tmp_dir, capture_output=True, text=True
+    ).stdout
+    assert unstaged == ""
+
+
+def test_staged_skips_yaml_files_which_are_not_configs(monkeypatch):
+    tmp_dir, paths = copy_fixtures(TEST_YAML_1_PATH, 1)
+    with open(os.path.join(tmp_dir, "docker-compose.yml"), "w") as stream:
+        stream.write("services:\n  web:\n    image: !reset nginx\n")
+    subprocess.run(["git", "init", "-q"], cwd=tmp_dir, check=True)
+    subprocess.run(
+        ["git", "add", "config_0.yml", "docker-compose.yml"], cwd=tmp_dir, check=True
+    )
+    monkeypatch.chdir(tmp_dir)
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main, ["encrypt", "--staged", "--all-envs", "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Skipped docker-compose.yml, not an eyaml config" in result.output
+    assert SecretYAML(filepath=paths[0]).is_env_encrypted("dev")
+
+    result = runner.invoke(main, ["verify", "--staged", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 0, result.output
+    assert "Skipped docker-compose.yml, not an eyaml config" in result.output
+    assert "config_0.yml: ok" in result.output
+
+
+def test_encrypt_staged_refuses_partially_staged_files(monkeypatch):
+    tmp_dir, paths = copy_fixtures(TEST_YAML_1_PATH, 1)
+    subprocess.run(["git", "init", "-q"], cwd=tmp_dir, check=True)
+    subprocess.run(["git", "add", "config_0.yml"], cwd=tmp_dir, check=True)
+    with open(paths[0], "a") as stream:
+        stream.write("# not staged\n")
+    monkeypatch.chdir(tmp_dir)
+
+    result = CliRunner().invoke(
+        main, ["encrypt", "--staged", "dev", "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 2
+    assert "Unstaged changes in config_0.yml" in result.output
+    assert not SecretYAML(filepath=paths[0]).is_env_encrypted("dev")
+
+
+def test_verify_staged_checks_the_index_not_the_working_tree(monkeypatch):
+    tmp_dir, paths = copy_fixtures(TEST_YAML_1_PATH, 1)
+    subprocess.run(["git", "init", "-q"], cwd=tmp_dir, check=True)
+    subprocess.run(["git", "add", "config_0.yml"], cwd=tmp_dir, check=True)
+    monkeypatch.chdir(tmp_dir)
+    runner = CliRunner()
+
+    # encrypted in the working tree only
+    result = runner.invoke(main, ["encrypt", "config_0.yml", "dev", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(main, ["verify", "config_0.yml", "dev", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 0, result.output
+
+    result = runner.invoke(
+        main, ["verify", "--staged", "dev", "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 1
+    assert "dev: 0 encrypted, 1 !secret value(s) left unencrypted" in result.output
+
+
+def test_verify_reports_per_env_and_exits_non_zero_on_failure():
+    tmp_dir, paths = copy_fixtures(TEST_YAML_1_PATH, 2)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["verify", *paths, "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 1
+    assert "dev: 0 encrypted, 1 !secret value(s) left unencrypted" in result.output
+
+    result = runner.invoke(
+        main, ["encrypt", *paths, "--all-envs", "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 0, result.output
+    with open(paths[0]) as stream:
+        encrypted = stream.read()
+
+    result = runner.invoke(
+        main, ["verify", *paths, "-p", TEST_PASSWORD_1, "--jobs", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    assert f"{paths[1]}: ok" in result.output
+    assert "prod: 1 encrypted, ok" in result.output
+    with open(paths[0]) as stream:
+        assert stream.read() == encrypted
+
+    result = runner.invoke(
+        main, ["verify", paths[0], "-p", "wrong", "-e", "dev", "-e", "stage"]
+    )
+    assert result.exit_code == 1
+    assert "dev: 1 encrypted, 1 value(s) failed to decrypt" in result.output
+    assert "prod" not in result.output
+
+
+def test_verify_reports_missing_required_keys():
+    result = CliRunner().invoke(
+        main, ["verify", path_from_fixtures("fixtures/required/required_01.yml")]
+    )
+    assert result.exit_code == 1
+    assert "dev: 0 encrypted, ok" in result.output
+    assert (
+        "prod: 0 encrypted, missing required key(s): SECRET_KEY, DATABASES.default.PASSWORD"
+        in result.output
+    )
+
+
+def test_rekey_many_envs_and_files_in_one_write():
+    tmp_dir, paths = copy_fixtures(TEST_YAML_1_PATH, 2)
+    old_password_file = os.path.join(tmp_dir, "old.pw")
+    new_password_file = os.path.join(tmp_dir, "new.pw")
+    with open(old_password_file, "w") as stream:
+        stream.write(TEST_PASSWORD_1)
+    with open(new_password_file, "w") as stream:
+        stream.write("NEW_PASSWORD")
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main, ["encrypt", *paths, "--all-envs", "-pf", old_password_file]
+    )
+    assert result.exit_code == 0, result.output
+    with open(paths[0]) as stream:
+        encrypted = stream.read()
+
+    result = runner.invoke(
+        main,
+        [
+            "rekey",
+            *paths,
+            "--all-envs",
+            "--old-password-file",
+            new_password_file,
+            "--new-password-file",
+            old_password_file,
+        ],
+    )
+    assert result.exit_code == 1
+    with open(paths[0]) as stream:
+        assert stream.read() == encrypted
+
+    result = runner.invoke(
+        main,
+        [
+            "rekey",
+            *paths,
+            "--all-envs",
+            "--old-password-file",
+            old_password_file,
+            "--new-password-file",
+            new_password_file,
+            "--jobs",
+            "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Rekeyed default, dev, stage, prod" in result.output
+
+    result = runner.invoke(main, ["verify", *paths, "-pf", new_password_file])
+    assert result.exit_code == 0, result.output
+    config = SecretYAML(filepath=paths[1])
+    config.decrypt_env("prod", "NEW_PASSWORD")
+    assert config.get_env_as_dict("prod")["postgres_password"] == "PRODUCTION_PASSWORD"
+
+
+def test_compile_env_to_an_artifact_loadable_without_ruamel():
+    tmp_location = copy_fixture(TEST_YAML_1_PATH)
+    tmp_dir = os.path.dirname(tmp_location)
+    key_file = os.path.join(tmp_dir, "compile.key")
+    runner = CliRunner()
+
+    result = runner.invoke(
+        main, ["encrypt", tmp_location, "--all-envs", "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(
+        main, ["compile", tmp_location, "dev", "-k", key_file, "-p", TEST_PASSWORD_1]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Generated a new key" in result.output
+
+    artifact_path = os.path.join(tmp_dir, "test_1.dev.json")
+    with open(artifact_path) as stream:
+        artifact = stream.read()
+    assert "DEVELOPMENT_PASSWORD" not in artifact
+    assert "wagtail_pg_db" in artifact
+
+    # loading must not need ruamel or ansible
+    script = (
+        "import sys\n"
+        "from eyaml.django import load_compiled_settings\n"
+        f"settings = load_compiled_settings({artifact_path!r}, key_file={key_file!r})\n"
+        "assert settings['postgres_password'] == 'DEVELOPMENT_PASSWORD'\n"
+        "assert settings['google_secret_key'] == 'TEST_KEY'\n"
+        "assert settings['postgres_port'] == 3456\n"
+        "assert settings['allowed_hosts'] == ['localhost', 'sitename.dev.octave.nz']\n"
+        "assert not [m for m in sys.modules if m.startswith(('ruamel', 'ansible'))]\n"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+    subprocess.run([sys.executable, "-c", script], check=True, env=env)
+
+
+def test_diff_against_git_revision_decrypts_changed_ciphertexts_only(monkeypatch):
+    from ansible.parsing.vault import VaultLib
+
+    tmp_dir = tempfile.mkdtemp(prefix="eyaml-diff")
+    config_path = os.path.join(tmp_dir, "config.yml")
+    shutil.copy(TEST_YAML_1_PATH, config_path)
+    monkeypatch.chdir(tmp_dir)
+    runner = CliRunner()
+
+    def git(*args):
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+            check=True,
+            capture_output=True,
+        )
+
+    def eyaml(*args):
+        result = runner.invoke(main, [*args, "-p", TEST_PASSWORD_1])
+        assert result.exit_code == 0, result.output
+
+    git("init", "-q")
+    eyaml("encrypt", "config.yml", "--all-envs")
+    git("add", "config.yml")
+    git("commit", "-q", "-m", "config")
+
+    # dev encrypted again with the same values, stage with a new password
+    eyaml("decrypt", "config.yml", "dev", "stage")
+    with open(config_path) as stream:
+        contents = stream.read()
+    with open(config_path, "w") as stream:
+        stream.write(
+            contents.replace("STAGING_PASSWORD", "NEW_STAGING_PASSWORD")
+            .replace("postgres_port: 3456", "postgres_port: 5432")
+            + "  new_flag: true\n"
+        )
+    eyaml("encrypt", "config.yml", "stage")
+    # the cli would keep the committed ciphertext of the unchanged dev value
+    config = SecretYAML(filepath=config_path)
+    config.encrypt_env("dev", TEST_PASSWORD_1)
+    config.save_file()
+
+    decrypt_calls = []
+    vault_decrypt = VaultLib.decrypt
+
+    def counting_decrypt(self, vaulttext):
+        decrypt_calls.append(vaulttext)
+        return vault_decrypt(self, vaulttext)
+
+    monkeypatch.setattr(VaultLib, "decrypt", counting_decrypt)
+
+    result = runner.invoke(main, ["diff", "HEAD", "config.yml", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 1
+    assert result.output.splitlines() == [
+        "default",
+        "  ~ postgres_port: 3456 -> 5432",
+        "dev",
+        "  = postgres_password: re-encrypted, value unchanged",
+        "stage",
+        "  ~ postgres_password: ****** -> ******",
+        "prod",
+        "  + new_flag: True",
+    ]
+    # both versions of the dev and stage passwords, nothing else
+    assert len(decrypt_calls) == 4
+
+    result = runner.invoke(
+        main,
+        ["diff", "HEAD:config.yml", "config.yml", "stage", "-p", TEST_PASSWORD_1, "--show-secrets"],
+    )
+    assert result.output.splitlines() == [
+        "stage",
+        "  ~ postgres_password: 'STAGING_PASSWORD' -> 'NEW_STAGING_PASSWORD'",
+    ]
+
+    result = runner.invoke(main, ["diff", "config.yml", "config.yml"])
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def test_encrypt_keeps_the_committed_ciphertext_of_unchanged_secrets(monkeypatch):
+    tmp_dir = tempfile.mkdtemp(prefix="eyaml-cli")
+    config_path = os.path.join(tmp_dir, "config.yml")
+    shutil.copy(TEST_YAML_1_PATH, config_path)
+    monkeypatch.chdir(tmp_dir)
+    runner = CliRunner()
+
+    def eyaml(*args):
+        result = runner.invoke(main, [*args, "-p", TEST_PASSWORD_1])
+        assert result.exit_code == 0, result.output
+
+    eyaml("encrypt", "config.yml", "--all-envs")
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "add", "config.yml"], check=True)
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+         "commit", "-q", "-m", "config"],
+        check=True,
+    )
+    committed = SecretYAML(filepath=config_path)
+
+    # decrypted and encrypted again in separate runs, one value edited in between
+    eyaml("decrypt", "config.yml", "--all-envs")
+    with open(config_path) as stream:
+        contents = stream.read()
+    with open(config_path, "w") as stream:
+        stream.write(contents.replace("STAGING_PASSWORD", "NEW_STAGING_PASSWORD"))
+    eyaml("encrypt", "config.yml", "--all-envs")
+
+    def ciphertexts(config):
+        return {
+            section: flatten(config.env(section))["postgres_password"].value
+            for section in ("dev", "stage", "prod")
+        }
+
+    old, new = ciphertexts(committed), ciphertexts(SecretYAML(filepath=config_path))
+    assert new["dev"] == old["dev"]
+    assert new["prod"] == old["prod"]
+    assert new["stage"] != old["stage"]
+    config = SecretYAML(filepath=config_path)
+    config.decrypt_env("stage", TEST_PASSWORD_1)
+    assert config.get_env_as_dict("stage")["postgres_password"] == "NEW_STAGING_PASSWORD"
+
+    # a new password encrypts everything again
+    eyaml("decrypt", "config.yml", "dev")
+    result = runner.invoke(main, ["encrypt", "config.yml", "dev", "-p", "other"])
+    assert result.exit_code == 0, result.output
+    assert ciphertexts(SecretYAML(filepath=config_path))["dev"] != old["dev"]
+
+
+def test_encrypt_decrypts_only_committed_secrets_still_in_the_file(monkeypatch):
+    tmp_dir = tempfile.mkdtemp(prefix="eyaml-cli")
+    config_path = os.path.join(tmp_dir, "config.yml")
+    shutil.copy(TEST_YAML_1_PATH, config_path)
+    monkeypatch.chdir(tmp_dir)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ["encrypt", "config.yml", "--all-envs", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 0, result.output
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "add", "config.yml"], check=True)
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+         "commit", "-q", "-m", "config"],
+        check=True,
+    )
+    result = runner.invoke(main, ["decrypt", "config.yml", "dev", "-p", TEST_PASSWORD_1])
+    assert result.exit_code == 0, result.output
+    with open(config_path) as stream:
+        contents = stream.read()
+    with open(config_path, "w") as stream:
+        stream.write(
+            contents.replace(
+                "postgres_password: !secret DEVELOPMENT_PASSWORD",
+                "postgres_password: !secret DEVELOPMENT_PASSWORD\n  api_key: !secret NEW_KEY",
+            )
+        )
+
+    decrypt_calls = []
+    decrypt_tags = SecretYAML.decrypt_tags
+
+    def recording_decrypt_tags(self, tags, password, **kwargs):
+        decrypt_calls.append((len(tags), kwargs.get("workers")))
+        return decrypt_tags(self, tags, password, **kwargs)
+
+    monkeypatch.setattr(SecretYAML, "decrypt_tags", recording_decrypt_tags)
+    result = runner.invoke(
+        main, ["encrypt", "config.yml", "dev", "-p", TEST_PASSWORD_1, "--jobs", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    # the committed dev password only, none of the other envs, across the workers
+    assert decrypt_calls == [(1, 2)]
+
+
+def test_diff_rejects_a_missing_file():
+    result = CliRunner().invoke(main, ["diff", TEST_YAML_1_PATH, "does_not_exist.yml"])
+    # 2 is a usage error, 1 would mean the versions differ
+    assert result.exit_code == 2
+    assert "does_not_exist.yml is neither a file nor REV:PATH" in result.output
@@ -1,5 +1,26 @@
 import os
-from eyaml.django import load_settings_from_config
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from ansible.parsing.vault import VaultLib
+
+import eyaml.django
+import eyaml.processor
+from eyaml import compiled
+from eyaml.django import (
+    compile_settings_from_config,
+    load_compiled_settings,
+    load_settings_from_config,
+)
+from eyaml.constants import CONTAINS_UNENCRYPTED_TAGS
+from eyaml.exceptions import CompiledSettingsError
+from eyaml.instrumentation import ProfileCollector
+from eyaml.lazy import LazySecret
+from eyaml.processor import SecretYAML
+from eyaml.reload import SettingsWatcher
+from eyaml.utils import ForkSafeLock
 
 
 def path_from_fixtures(file_name):
@@ -11,6 +32,7 @@ DEFAULT_PASSWORD_1 = "four"
 
 UNENCRYPTED_CONFIG_PATH_1 = path_from_fixtures("fixtures/django/unencrypted_01.yml")
 ENCRYPTED_CONFIG_PATH_1 = path_from_fixtures("fixtures/django/encrypted_01.yml")
+DATABASES_CONFIG_PATH_1 = path_from_fixtures("fixtures/django/databases_01.yml")
 
 
 def test_loading_file_using_django_helper_no_password_or_encryption():
@@ -59,3 +81,422 @@ def test_loading_file_using_django_helper_dev_password_no_default():
         "postgres_password": "STAGE",
     }
     assert stage_config_dict == expected_stage_config
+
+
+def test_loading_file_using_django_helper_with_workers():
+    dev_config_dict = load_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1,
+        "dev",
+        passwords=["PASSWORDstage", "PASSWORDdev"],
+        workers=2,
+    )
+    assert dev_config_dict["postgres_password"] == "DEVELOPMENT"
+
+
+def test_loading_file_using_django_helper_with_metrics():
+    """
+    Test if the phases of a load are reported to the metrics sink, including
+    the values a wrong password failed to decrypt while trying passwords.
+    """
+    metrics = ProfileCollector()
+    dev_config_dict = load_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1,
+        "dev",
+        passwords=["PASSWORDstage", "PASSWORDdev"],
+        metrics=metrics,
+    )
+    assert dev_config_dict["postgres_password"] == "DEVELOPMENT"
+
+    phases = metrics.as_dict()
+    for phase in ["parse", "validate", "decrypt", "to_dict", "merge"]:
+        assert phases[phase]["calls"] >= 1
+    assert phases["decrypt"]["count"] == 2
+    assert phases["decrypt_failed"]["count"] == 1
+    assert "decrypt_failed" in metrics.report()
+
+
+def test_loading_file_decrypts_inherited_envs():
+    config = SecretYAML(
+        filepath=path_from_fixtures("fixtures/inheritance/chain_01.yml")
+    )
+    config.encrypt_default(DEFAULT_PASSWORD_1)
+    config.encrypt_env("prod-base", "PASSWORDprod")
+    tmp_location = tempfile.NamedTemporaryFile(
+        prefix="temp-inherited", suffix=".yml"
+    ).name
+    config.save_file(tmp_location)
+
+    settings = load_settings_from_config(
+        tmp_location,
+        "prod-eu-canary",
+        passwords={"default": DEFAULT_PASSWORD_1, "prod-base": "PASSWORDprod"},
+    )
+    assert settings["postgres_password"] == "PROD_PASSWORD"
+    assert settings["api_key"] == "DEFAULT_KEY"
+    assert settings["region"] == "eu"
+
+
+def test_loading_file_using_labelled_passwords_decrypts_each_value_once(
+    monkeypatch,
+):
+    """
+    Test if values encrypted with a vault-id per env are decrypted exactly once,
+    with the password matching their label, when passwords are given as a dict.
+    """
+    config = SecretYAML(filepath=path_from_fixtures("fixtures/basic/test_1.yml"))
+    config.encrypt_default(DEFAULT_PASSWORD_1)
+    config.encrypt_env("dev", DEV_PASSWORD_1)
+    config.encrypt_env("stage", "PASSWORDstage")
+    dev_encrypted = config.get_env_as_dict("dev", use_default=False)
+    assert dev_encrypted["postgres_password"].startswith(
+        "$ANSIBLE_VAULT;1.2;AES256;dev|"
+    )
+    tmp_location = tempfile.NamedTemporaryFile(
+        prefix="temp-labelled", suffix=".yml"
+    ).name
+    config.save_file(tmp_location)
+
+    decrypt_calls = []
+    vault_decrypt = VaultLib.decrypt
+
+    def counting_decrypt(self, vaulttext):
+        decrypt_calls.append(vaulttext)
+        return vault_decrypt(self, vaulttext)
+
+    monkeypatch.setattr(VaultLib, "decrypt", counting_decrypt)
+
+    dev_config_dict = load_settings_from_config(
+        tmp_location,
+        "dev",
+        passwords={
+            "stage": "PASSWORDstage",
+            "dev": DEV_PASSWORD_1,
+            "default": DEFAULT_PASSWORD_1,
+        },
+    )
+    assert dev_config_dict["postgres_password"] == "DEVELOPMENT_PASSWORD"
+    assert dev_config_dict["google_secret_key"] == "TEST_KEY"
+    assert len(decrypt_calls) == 2
+
+
+def test_loaded_settings_can_be_modified_by_django():
+    """
+    Test if the settings are plain dicts and lists django can write to, e.g.
+    the ConnectionHandler filling in the defaults of DATABASES.
+    """
+    from django.db.utils import ConnectionHandler
+
+    settings = load_settings_from_config(DATABASES_CONFIG_PATH_1, "dev")
+    assert type(settings["DATABASES"]["default"]["OPTIONS"]) is dict
+    assert type(settings["ALLOWED_HOSTS"]) is list
+
+    databases = ConnectionHandler(settings["DATABASES"]).settings
+    assert databases["default"]["NAME"] == "dev.sqlite3"
+    assert databases["default"]["ATOMIC_REQUESTS"] is False
+    settings["ALLOWED_HOSTS"].append("example.com")
+
+    # the next load is not affected by what django wrote
+    reloaded = load_settings_from_config(DATABASES_CONFIG_PATH_1, "dev")
+    assert "ATOMIC_REQUESTS" not in reloaded["DATABASES"]["default"]
+    assert reloaded["ALLOWED_HOSTS"] == ["localhost"]
+
+
+def types_of(value):
+    """The type of value and everything nested in it, in the same shape."""
+    if isinstance(value, dict):
+        return type(value), {key: types_of(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return type(value), [types_of(item) for item in value]
+    return type(value)
+
+
+def test_loading_file_using_settings_cache(monkeypatch, caplog):
+    """
+    Test if the resolved settings are cached encrypted on disk and a cache hit
+    skips parsing, while a different password misses the cache. Decrypted
+    values are not reported as unencrypted tags along the way.
+    """
+    cache_dir = tempfile.mkdtemp(prefix="eyaml-cache")
+    dev_config_dict = load_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1,
+        "dev",
+        passwords=["PASSWORDdev"],
+        cache_dir=cache_dir,
+    )
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1
+    cache_contents = open(os.path.join(cache_dir, cache_files[0]), "rb").read()
+    assert b"DEVELOPMENT" not in cache_contents
+
+    def fail_parse(*args, **kwargs):
+        raise AssertionError("config should not be parsed on a cache hit")
+
+    monkeypatch.setattr(eyaml.processor, "SecretYAML", fail_parse)
+    cached_config_dict = load_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1,
+        "dev",
+        passwords=["PASSWORDdev"],
+        cache_dir=cache_dir,
+    )
+    assert cached_config_dict == dev_config_dict
+    # a hit returns the same plain types as a miss, not just equal values
+    assert types_of(cached_config_dict) == types_of(dev_config_dict)
+
+    monkeypatch.undo()
+    load_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1,
+        "dev",
+        passwords=["PASSWORDstage", "PASSWORDdev"],
+        cache_dir=cache_dir,
+    )
+    # entries for the same file and env replace each other
+    assert len(os.listdir(cache_dir)) == 1
+    assert CONTAINS_UNENCRYPTED_TAGS not in caplog.text
+
+
+def test_loading_file_using_lazy_secrets(monkeypatch):
+    """
+    Test if lazy settings hold LazySecret handles which decrypt once, on first
+    use, even when accessed from several threads at the same time.
+    """
+    decrypt_calls = []
+    vault_decrypt = VaultLib.decrypt
+
+    def counting_decrypt(self, vaulttext):
+        decrypt_calls.append(vaulttext)
+        return vault_decrypt(self, vaulttext)
+
+    monkeypatch.setattr(VaultLib, "decrypt", counting_decrypt)
+
+    dev_config_dict = load_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1,
+        "dev",
+        passwords=["PASSWORDstage", "PASSWORDdev"],
+        lazy=True,
+    )
+    secret = dev_config_dict["postgres_password"]
+    assert isinstance(secret, LazySecret)
+    assert not secret.is_decrypted
+    assert decrypt_calls == []
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        values = list(executor.map(str, [secret] * 8))
+    assert values == ["DEVELOPMENT"] * 8
+    assert secret == "DEVELOPMENT"
+    assert secret.lower() == "development"
+    # one failed attempt with the stage password, one with the dev password
+    assert len(decrypt_calls) == 2
+
+
+def test_compiled_settings_refuse_a_wrong_key():
+    key = compiled.generate_key()
+    artifact = compile_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1, "dev", key, passwords=["PASSWORDdev"]
+    )
+    artifact_path = tempfile.NamedTemporaryFile(
+        prefix="temp-compiled", suffix=".json"
+    ).name
+    compiled.write_compiled_settings(artifact_path, artifact)
+
+    settings = load_compiled_settings(artifact_path, key=key)
+    assert settings == load_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1, "dev", passwords=["PASSWORDdev"]
+    )
+    with pytest.raises(CompiledSettingsError):
+        load_compiled_settings(artifact_path, key=compiled.generate_key())
+
+
+def test_compiling_parses_the_config_once(monkeypatch):
+    parsed = []
+    load_file = SecretYAML.load_file
+
+    def counting_load_file(self, filepath):
+        parsed.append(filepath)
+        return load_file(self, filepath)
+
+    monkeypatch.setattr(SecretYAML, "load_file", counting_load_file)
+    artifact = compile_settings_from_config(
+        ENCRYPTED_CONFIG_PATH_1, "dev", compiled.generate_key(), passwords=["PASSWORDdev"]
+    )
+    assert parsed == [ENCRYPTED_CONFIG_PATH_1]
+    assert compiled.COMPILED_SECRET_KEY in artifact["settings"]["postgres_password"]
+
+
+def test_compiled_secrets_are_bound_to_their_key_path():
+    key = compiled.generate_key()
+    token = compiled.encrypt_secret("DEVELOPMENT", key, "DATABASES.default.PASSWORD")
+    assert compiled.decrypt_secret(token, key, "DATABASES.default.PASSWORD") == "DEVELOPMENT"
+    with pytest.raises(CompiledSettingsError):
+        compiled.decrypt_secret(token, key, "SECRET_KEY")
+
+
+def test_writing_an_artifact_that_fails_leaves_no_temporary_file():
+    tmp_dir = tempfile.mkdtemp(prefix="eyaml-compiled")
+    artifact_path = os.path.join(tmp_dir, "settings.json")
+    with pytest.raises(TypeError):
+        compiled.write_compiled_settings(artifact_path, {"settings": object()})
+    assert os.listdir(tmp_dir) == []
+
+
+def run_in_fork(func):
+    """Runs func in a forked child and returns what it wrote to the pipe."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            output = func()
+        except BaseException as e:
+            output = f"error: {e!r}"
+        os.write(write_fd, output.encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as stream:
+        output = stream.read()
+    os.waitpid(pid, 0)
+    return output
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_shared_settings_are_resolved_once_across_forks(monkeypatch):
+    """
+    Test if settings resolved in the parent are reused by forked children
+    without loading the config again, even when a thread held the registry
+    lock at fork time.
+    """
+    registry = eyaml.django.SettingsRegistry()
+    monkeypatch.setattr(eyaml.django, "SETTINGS_REGISTRY", registry)
+    settings = eyaml.django.get_shared_settings(
+        ENCRYPTED_CONFIG_PATH_1, "dev", passwords=["PASSWORDdev"]
+    )
+    assert settings["postgres_password"] == "DEVELOPMENT"
+
+    def fail_load(*args, **kwargs):
+        raise AssertionError("settings should not be loaded again")
+
+    monkeypatch.setattr(eyaml.django, "load_settings_from_config", fail_load)
+
+    def child():
+        child_settings = eyaml.django.get_shared_settings(
+            ENCRYPTED_CONFIG_PATH_1, "dev", passwords=["PASSWORDdev"]
+        )
+        # stale lock inherited from the parent, must not deadlock
+        with registry._lock:
+            pass
+        return child_settings["postgres_password"]
+
+    with registry._lock._lock:
+        assert run_in_fork(child) == "DEVELOPMENT"
+    assert list(registry.resolved_in.values()) == [os.getpid()]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_fork_safe_locks_are_replaced_in_the_child_at_fork():
+    """
+    Test if a ForkSafeLock held at fork time is already replaced when the
+    child starts, before any thread of the child checks the PID.
+    """
+    lock = ForkSafeLock()
+
+    def child():
+        return f"{lock._pid == os.getpid()} {lock._lock.locked()}"
+
+    with lock:
+        assert run_in_fork(child) == "True False"
+
+
+def test_settings_watcher_only_decrypts_changed_ciphertexts(monkeypatch):
+    """
+    Test if the watcher swaps in a new snapshot when a tunable changes, without
+    decrypting the unchanged secrets again, and notifies subscribers of the
+    changed keys only.
+    """
+    config_path = os.path.join(tempfile.mkdtemp(prefix="eyaml-watch"), "config.yml")
+    with open(ENCRYPTED_CONFIG_PATH_1, "r") as stream:
+        contents = stream.read()
+    with open(config_path, "w") as stream:
+        stream.write(contents)
+
+    decrypt_calls = []
+    vault_decrypt = VaultLib.decrypt
+
+    def counting_decrypt(self, vaulttext):
+        decrypt_calls.append(vaulttext)
+        return vault_decrypt(self, vaulttext)
+
+    monkeypatch.setattr(VaultLib, "decrypt", counting_decrypt)
+
+    watcher = SettingsWatcher(config_path, "dev", passwords=["PASSWORDdev"])
+    snapshot = watcher.settings
+    assert snapshot["postgres_password"] == "DEVELOPMENT"
+    assert len(decrypt_calls) == 1
+
+    notified, password_changes = [], []
+    watcher.subscribe(lambda settings, changed: notified.append(changed))
+    watcher.subscribe(
+        lambda settings, changed: password_changes.append(changed),
+        keys=["postgres_password"],
+    )
+
+    # same contents, new mtime, nothing is parsed again
+    stat = os.stat(config_path)
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert watcher.check() == []
+
+    with open(config_path, "w") as stream:
+        stream.write(contents.replace("sitename.dev.octave.nz", "app.dev.octave.nz"))
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert watcher.check() == ["allowed_hosts"]
+    assert watcher.settings["allowed_hosts"] == ["app.dev.octave.nz"]
+    assert watcher.settings["postgres_password"] == "DEVELOPMENT"
+    assert snapshot["allowed_hosts"] == ["sitename.dev.octave.nz"]
+    assert len(decrypt_calls) == 1
+    assert notified == [["allowed_hosts"]]
+    assert password_changes == []
+
+    with open(config_path, "w") as stream:
+        stream.write("version: [")
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 3 * 10**9))
+    assert watcher.check() == []
+    assert watcher.last_error is not None
+    assert watcher.settings["allowed_hosts"] == ["app.dev.octave.nz"]
+
+
+def test_settings_watcher_thread_reloads_and_stops():
+    """
+    Test if the polling thread picks up a change and notifies subscribers
+    outside its lock, so a subscriber may call check() itself, and if stop()
+    ends the thread.
+    """
+    config_path = os.path.join(tempfile.mkdtemp(prefix="eyaml-watch"), "config.yml")
+    with open(ENCRYPTED_CONFIG_PATH_1, "r") as stream:
+        contents = stream.read()
+    with open(config_path, "w") as stream:
+        stream.write(contents)
+
+    watcher = SettingsWatcher(
+        config_path, "dev", passwords=["PASSWORDdev"], interval=0.01
+    )
+    notified = threading.Event()
+    changes = []
+
+    def subscriber(settings, changed):
+        changes.append((changed, watcher.check()))
+        notified.set()
+
+    watcher.subscribe(subscriber)
+    watcher.start()
+    thread = watcher._thread
+    try:
+        stat = os.stat(config_path)
+        with open(config_path, "w") as stream:
+            stream.write(contents.replace('"blah2"', '"uber"'))
+        os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert notified.wait(timeout=10)
+    finally:
+        watcher.stop(timeout=10)
+
+    assert changes == [(["shared_api_keys.uber_api"], [])]
+    assert watcher.settings["shared_api_keys"]["uber_api"] == "uber"
+    assert not thread.is_alive()
+    assert watcher._thread is None
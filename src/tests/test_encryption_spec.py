@@ -1,15 +1,35 @@
 import os
 import pytest
+import tempfile
+
+import eyaml.envelope
 
 from eyaml.constants import *
 from eyaml.processor import SecretYAML
-from eyaml.exceptions import UnsupportedEncryptionMethodSpecified
+from eyaml.tags import SecretString
+from eyaml.exceptions import UnsupportedEncryptionMethodSpecified, EnvelopeKeyError
 
 def path_from_fixtures(file_name):
     return os.path.join(os.path.dirname(__file__), file_name)
 
 VALID_VAULT_SPEC_01 = path_from_fixtures("fixtures/spec/valid_vault_spec_01.yml")
 INVALID_SPEC_01 = path_from_fixtures("fixtures/spec/invalid_spec_01.yml")
+VALID_ENVELOPE_SPEC_01 = path_from_fixtures("fixtures/spec/valid_envelope_spec_01.yml")
+
+DEV_PASSWORD = "PASSWORDdev"
+DEFAULT_PASSWORD = "PASSWORDdefault"
+
+
+def count_key_unwraps(monkeypatch):
+    unwraps = []
+    unwrap_data_key = eyaml.envelope.unwrap_data_key
+
+    def counting_unwrap(header, password, vault_id):
+        unwraps.append(vault_id)
+        return unwrap_data_key(header, password, vault_id)
+
+    monkeypatch.setattr(eyaml.envelope, "unwrap_data_key", counting_unwrap)
+    return unwraps
 
 
 def test_encryption_spec():
@@ -21,3 +41,115 @@ def test_encryption_spec():
 def test_invalid_encryption_spec():
     with pytest.raises(UnsupportedEncryptionMethodSpecified):
         config = SecretYAML(filepath=INVALID_SPEC_01)
+
+
+def test_envelope_encryption_round_trip(monkeypatch):
+    """
+    Test if an env encrypted with the envelope method stores one wrapped data
+    key per env, and decrypts with a single key unwrap per env.
+    """
+    config = SecretYAML(filepath=VALID_ENVELOPE_SPEC_01)
+    assert config.encryption_method == ENVELOPE_ENCRYPTION_METHOD
+    expected_dict = config.get_env_as_dict("dev")
+
+    config.encrypt_env("dev", DEV_PASSWORD)
+    config.encrypt_default(DEFAULT_PASSWORD)
+    assert config.is_env_encrypted("dev")
+    encrypted_dict = config.to_dict()
+    assert sorted(encrypted_dict[ENCRYPTION_KEYS_KEY]) == ["default", "dev"]
+    assert encrypted_dict["dev"]["postgres_password"].startswith(
+        "$EYAML_ENVELOPE;1.0;AES256GCM;dev|"
+    )
+
+    tmp_location = tempfile.NamedTemporaryFile(
+        prefix="temp-envelope", suffix=".yml"
+    ).name
+    config.save_file(tmp_location)
+
+    unwraps = count_key_unwraps(monkeypatch)
+    config = SecretYAML(filepath=tmp_location)
+    config.decrypt_env("dev", DEV_PASSWORD)
+    config.decrypt_default(DEFAULT_PASSWORD)
+    assert unwraps == ["dev", "default"]
+    assert config.get_env_as_dict("dev") == expected_dict
+
+
+def test_envelope_wrong_password():
+    config = SecretYAML(filepath=VALID_ENVELOPE_SPEC_01)
+    config.encrypt_env("dev", DEV_PASSWORD)
+    with pytest.raises(EnvelopeKeyError):
+        config.decrypt_env("dev", "wrong_password")
+    assert config.is_env_encrypted("dev")
+
+
+def test_envelope_wrong_password_keeps_the_data_key_in_use():
+    """
+    Test if encrypting a partly encrypted env with the wrong password raises
+    instead of replacing the data key its encrypted values need, while a key
+    no value uses any more is replaced.
+    """
+    config = SecretYAML(filepath=VALID_ENVELOPE_SPEC_01)
+    config.encrypt_env("dev", DEV_PASSWORD)
+    header = config.keyring.wrapped_keys["dev"]
+    config.env("dev")["new_secret"] = SecretString("new")
+    config.reindex()
+
+    with pytest.raises(EnvelopeKeyError):
+        config.encrypt_walk(config.env("dev"), "wrong_password", vault_id="dev")
+    assert config.keyring.wrapped_keys["dev"] == header
+    config.decrypt_walk(config.env("dev"), DEV_PASSWORD, vault_id="dev")
+    assert config.get_env_as_dict("dev")["postgres_password"] == "DEVELOPMENT_PASSWORD"
+
+    # nothing is encrypted with the dev key any more
+    config.encrypt_env("dev", "new_password")
+    assert config.keyring.wrapped_keys["dev"] != header
+    config.decrypt_env("dev", "new_password")
+    assert config.get_env_as_dict("dev")["new_secret"] == "new"
+
+
+def test_envelope_and_vault_values_side_by_side():
+    """
+    Test if ansible vault values still decrypt in a file that has moved to the
+    envelope encryption method.
+    """
+    config = SecretYAML(filepath=VALID_VAULT_SPEC_01)
+    config.encrypt_env("dev", DEV_PASSWORD)
+    config.encryption_method = ENVELOPE_ENCRYPTION_METHOD
+    config.encrypt_default(DEFAULT_PASSWORD)
+
+    encrypted_dict = config.to_dict()
+    assert encrypted_dict["dev"]["postgres_password"].startswith("$ANSIBLE_VAULT")
+    assert encrypted_dict["common"]["google_secret_key"].startswith("$EYAML_ENVELOPE")
+
+    config.decrypt_env("dev", DEV_PASSWORD)
+    config.decrypt_default(DEFAULT_PASSWORD)
+    dev_dict = config.get_env_as_dict("dev")
+    assert dev_dict["postgres_password"] == "DEVELOPMENT_PASSWORD"
+    assert dev_dict["google_secret_key"] == "TEST_KEY"
+
+
+def test_envelope_rekey_only_rewraps_the_data_key():
+    """
+    Test if rekeying an envelope env keeps every value's ciphertext and only
+    replaces the wrapped data key.
+    """
+    config = SecretYAML(filepath=VALID_ENVELOPE_SPEC_01)
+    expected_dict = config.get_env_as_dict("dev")
+    config.encrypt_env("dev", DEV_PASSWORD)
+    encrypted_dict = config.to_dict()
+
+    config.rekey_env("dev", DEV_PASSWORD, "NEWPASSWORDdev")
+    rekeyed_dict = config.to_dict()
+    assert rekeyed_dict["dev"] == encrypted_dict["dev"]
+    assert (
+        rekeyed_dict[ENCRYPTION_KEYS_KEY]["dev"]
+        != encrypted_dict[ENCRYPTION_KEYS_KEY]["dev"]
+    )
+
+    tmp_location = tempfile.NamedTemporaryFile(prefix="temp-rekey", suffix=".yml").name
+    config.save_file(tmp_location)
+    config = SecretYAML(filepath=tmp_location)
+    with pytest.raises(EnvelopeKeyError):
+        config.decrypt_env("dev", DEV_PASSWORD)
+    config.decrypt_env("dev", "NEWPASSWORDdev")
+    assert config.get_env_as_dict("dev") == expected_dict
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+SRC_DIR = os.path.dirname(os.path.dirname(__file__))
+
+# seconds, best of IMPORT_RUNS fresh interpreters, override on slow machines
+IMPORT_BUDGET = float(os.environ.get("EYAML_IMPORT_BUDGET", "0.3"))
+IMPORT_RUNS = 3
+HEAVY_MODULES = ["ansible", "django", "environ", "cryptography"]
+
+MEASURE_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+loaded = sorted({{name.split(".")[0] for name in sys.modules}})
+print(json.dumps({{"seconds": elapsed, "modules": loaded}}))
+"""
+
+
+def measure_import(statement):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    runs = []
+    for _ in range(IMPORT_RUNS):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE_SCRIPT.format(statement=statement)],
+            check=True,
+            capture_output=True,
+            text=True,
+            env=env,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(run["seconds"] for run in runs), runs[0]["modules"]
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "import eyaml.processor",
+        "import eyaml.django",
+        "from eyaml.cli.eyaml import main",
+    ],
+)
+def test_import_does_not_load_optional_backends(statement):
+    """
+    Test if importing eyaml leaves ansible, django, django-environ and
+    cryptography unloaded until they are needed, within the time budget.
+    """
+    seconds, modules = measure_import(statement)
+    assert not set(HEAVY_MODULES) & set(modules)
+    assert seconds < IMPORT_BUDGET, f"{statement} took {seconds:.3f}s"
+
+
+def test_cli_help_does_not_load_the_processor():
+    seconds, modules = measure_import(
+        "from eyaml.cli.eyaml import main\n"
+        "try:\n"
+        "    main(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass"
+    )
+    assert "ruamel" not in modules
+    assert not set(HEAVY_MODULES) & set(modules)
+    assert seconds < IMPORT_BUDGET, f"eyaml --help took {seconds:.3f}s"
@@ -0,0 +1,74 @@
+import pytest
+
+from eyaml.exceptions import ReadOnlyViewError, UnsupportedMergeStrategy
+from eyaml.mappings import FrozenDict, FrozenList, LayeredMapping
+
+
+BASE = FrozenDict(
+    {
+        "debug": False,
+        "allowed_hosts": FrozenList(["localhost"]),
+        "databases": FrozenDict(
+            {"default": FrozenDict({"host": "db", "port": 5432, "name": "app"})}
+        ),
+        "caches": FrozenDict({"default": FrozenDict({"timeout": 60})}),
+    }
+)
+PROD = FrozenDict(
+    {
+        "allowed_hosts": FrozenList(["example.com"]),
+        "databases": FrozenDict({"default": FrozenDict({"host": "prod-db"})}),
+    }
+)
+CANARY = FrozenDict(
+    {
+        "debug": True,
+        "allowed_hosts": FrozenList(["canary.example.com"]),
+    }
+)
+
+
+def test_layered_mapping_merges_like_deep_update():
+    layers = LayeredMapping(BASE, PROD, CANARY)
+    assert layers == {
+        "debug": True,
+        "allowed_hosts": ["canary.example.com"],
+        "databases": {"default": {"host": "prod-db", "port": 5432, "name": "app"}},
+        "caches": {"default": {"timeout": 60}},
+    }
+    assert list(layers) == ["debug", "allowed_hosts", "databases", "caches"]
+    assert layers.materialize() == layers
+
+
+def test_layered_mapping_shares_unmerged_values():
+    """
+    Test if values found in a single layer are handed out as they are, and
+    only mappings found in several layers get a nested view.
+    """
+    layers = LayeredMapping(BASE, PROD, CANARY)
+    assert layers["caches"] is BASE["caches"]
+    assert isinstance(layers["databases"], LayeredMapping)
+    assert layers["databases"] is layers["databases"]
+    assert layers.materialize()["caches"] is BASE["caches"]
+
+
+def test_layered_mapping_strategies():
+    layers = LayeredMapping(
+        BASE,
+        PROD,
+        CANARY,
+        strategies={"allowed_hosts": "append", "databases.default": "replace"},
+    )
+    assert layers["allowed_hosts"] == ["localhost", "example.com", "canary.example.com"]
+    assert layers["databases"]["default"] == {"host": "prod-db"}
+
+    with pytest.raises(UnsupportedMergeStrategy):
+        LayeredMapping(BASE, strategies={"debug": "concat"})
+
+
+def test_layered_mapping_is_read_only():
+    layers = LayeredMapping(BASE, PROD)
+    with pytest.raises(TypeError):
+        layers["debug"] = True
+    with pytest.raises(ReadOnlyViewError):
+        layers["allowed_hosts"].append("example.org")
@@ -1,4 +1,5 @@
 import os
+import pickle
 import pytest
 import tempfile
 
@@ -7,6 +8,8 @@ from ruamel.yaml.scanner import ScannerError
 
 from eyaml.processor import SecretYAML
 from eyaml.exceptions import *
+from eyaml.tags import EncryptedString, SecretString
+from eyaml.environ_helper import EnvironOverlay
 
 
 def path_from_fixtures(file_name):
@@ -27,6 +30,9 @@ TEST_YAML_9_PATH = path_from_fixtures("fixtures/basic/test_9.yml")
 TEST_YAML_10_PATH = path_from_fixtures("fixtures/basic/test_10.yml")
 TEST_YAML_11_PATH = path_from_fixtures("fixtures/basic/test_11.yml")
 TEST_YAML_12_PATH = path_from_fixtures("fixtures/basic/test_12.yml")
+INHERITANCE_CHAIN_PATH = path_from_fixtures("fixtures/inheritance/chain_01.yml")
+REQUIRED_PATH = path_from_fixtures("fixtures/required/required_01.yml")
+INHERITANCE_CYCLE_PATH = path_from_fixtures("fixtures/inheritance/cycle_01.yml")
 
 ENCRYPTED_TEST_YAML_1_PATH = path_from_fixtures(
     "fixtures/encrypted/encrypted_test_1.yml"
@@ -307,6 +313,276 @@ def test_yml_encrypt_and_decrypt_dev_and_default_with_different_passwords():
     assert config.is_default_decrypted()
 
 
+def test_parallel_decrypt_matches_serial_decrypt():
+    """
+    Test if decrypting with a process pool writes the same values back into the
+    tree, in the same order, as the serial decryption.
+    """
+    config = SecretYAML(filepath=TEST_YAML_11_PATH)
+    config.decrypt_default("PASSWORD")
+    expected_dict = config.get_default_as_dict()
+
+    config_parallel = SecretYAML(filepath=TEST_YAML_11_PATH)
+    config_parallel.decrypt_default("PASSWORD", workers=2)
+    assert config_parallel.is_default_decrypted()
+    assert config_parallel.get_default_as_dict() == expected_dict
+
+
+def test_parallel_encrypt_keeps_style():
+    """
+    Test if encrypting with a process pool swaps in !encrypted tags with the
+    original quote style intact, and the values decrypt back.
+    """
+    config = SecretYAML(filepath=TEST_YAML_10_PATH)
+    assert config.is_default_decrypted()
+    styles = [
+        tag.style
+        for _, _, tag in config.collect_tags_of_type(config.get_default(), SecretString)
+    ]
+    expected_dict = config.get_default_as_dict()
+
+    config.encrypt_default(TEST_PASSWORD_1, workers=2)
+    assert config.is_default_encrypted()
+    encrypted = config.collect_tags_of_type(config.get_default(), EncryptedString)
+    assert [tag.style for _, _, tag in encrypted] == styles
+
+    config.decrypt_default(TEST_PASSWORD_1, workers=2)
+    assert config.get_default_as_dict() == expected_dict
+
+
+def test_tag_index_tracks_encryption_state():
+    """
+    Test if the tag index built at load time is kept up to date by
+    encrypt_walk and decrypt_walk, and can be rebuilt after a manual edit.
+    """
+    config = SecretYAML(filepath=TEST_YAML_1_PATH)
+    dev = config.get_env_by_name("dev")
+    assert config.tag_index.count(dev, SecretString) == 1
+    assert config.tag_index.count(config.data, SecretString) == 4
+
+    config.encrypt_env("dev", TEST_PASSWORD_1)
+    assert config.tag_index.count(dev, SecretString) == 0
+    assert config.tag_index.count(dev, EncryptedString) == 1
+    assert config.tag_index.count(config.data, SecretString) == 3
+    assert config.tag_index.count(config.data, EncryptedString) == 1
+
+    dev["api_key"] = SecretString("new secret")
+    config.reindex()
+    assert config.is_env_decrypted("dev")
+    assert config.is_env_encrypted("dev")
+
+
+def test_reencrypt_reuses_ciphertext_of_unchanged_secrets():
+    """
+    Test if re-encrypting after a decrypt keeps the ciphertext of unchanged
+    secrets and only encrypts the changed one, unless the password changes.
+    """
+    config = SecretYAML(filepath=TEST_YAML_10_PATH)
+    config.encrypt_default(TEST_PASSWORD_1)
+    default = config.get_default()
+    original = [
+        tag.value for _, _, tag in config.collect_tags_of_type(default, EncryptedString)
+    ]
+
+    config.decrypt_default(TEST_PASSWORD_1)
+    secrets = config.collect_tags_of_type(default, SecretString)
+    secrets[1][2].value = "changed value"
+    config.encrypt_default(TEST_PASSWORD_1)
+    reencrypted = [
+        tag.value for _, _, tag in config.collect_tags_of_type(default, EncryptedString)
+    ]
+    assert reencrypted[0] == original[0]
+    assert reencrypted[1] != original[1]
+    assert reencrypted[2:] == original[2:]
+
+    config.decrypt_default(TEST_PASSWORD_1)
+    assert config.get_default_as_dict()["single_quoted_secret_value"] == "changed value"
+    config.encrypt_default("new password")
+    rekeyed = [
+        tag.value for _, _, tag in config.collect_tags_of_type(default, EncryptedString)
+    ]
+    assert not set(rekeyed) & set(reencrypted)
+
+
+def test_failed_decrypt_without_exception_leaves_value_encrypted():
+    config_encrypted = SecretYAML(filepath=ENCRYPTED_TEST_YAML_1_PATH)
+    config_encrypted.decrypt_default("wrong_password", raise_exception=False)
+    assert config_encrypted.is_default_encrypted()
+    config_encrypted.decrypt_default(TEST_PASSWORD_1, raise_exception=False)
+    assert config_encrypted.is_default_decrypted()
+
+
+def test_read_mode_matches_round_trip_mode():
+    """
+    Test if a yml file loaded in read mode produces the same dicts as the
+    round trip mode, and decrypts the same, but can not be saved.
+    """
+    for path in [TEST_YAML_1_PATH, TEST_YAML_10_PATH, TEST_YAML_12_PATH]:
+        config = SecretYAML(filepath=path)
+        read_config = SecretYAML(filepath=path, mode="read")
+        assert isinstance(read_config.data, dict)
+        assert read_config.to_dict() == config.to_dict()
+
+    read_config = SecretYAML(filepath=TEST_YAML_11_PATH, mode="read")
+    read_config.decrypt_default("PASSWORD")
+    assert read_config.get_default_as_dict()["secret_value"] == "value3"
+    with pytest.raises(ReadOnlyModeException):
+        read_config.save_file(
+            tempfile.NamedTemporaryFile(prefix="temp-read", suffix=".yml").name
+        )
+
+
+def test_unsupported_mode():
+    with pytest.raises(UnsupportedModeSpecified):
+        SecretYAML(filepath=TEST_YAML_1_PATH, mode="write")
+
+
+def test_env_dicts_are_memoized_until_a_walk_touches_them():
+    """
+    Test if env dicts are converted and merged once, stay cached for the
+    envs a walk did not touch, and are rebuilt for the ones it did.
+    """
+    config = SecretYAML(filepath=TEST_YAML_1_PATH)
+    dev_dict = config.get_env_as_dict("dev")
+    stage_dict = config.get_env_as_dict("stage")
+    assert config.get_env_as_dict("dev") is dev_dict
+    # values the env does not override are shared with the default dict
+    assert dev_dict["POSTGRES"] is config.get_default_as_dict()["POSTGRES"]
+
+    config.encrypt_env("dev", TEST_PASSWORD_1)
+    assert config.get_env_as_dict("stage") is stage_dict
+    encrypted_dev_dict = config.get_env_as_dict("dev")
+    assert encrypted_dev_dict["postgres_password"].startswith("$ANSIBLE_VAULT")
+    assert config.to_dict()["dev"]["postgres_password"].startswith("$ANSIBLE_VAULT")
+
+    config.encrypt_default(TEST_PASSWORD_1)
+    assert config.get_env_as_dict("stage") is not stage_dict
+    assert config.get_env_as_dict("stage")["google_secret_key"].startswith(
+        "$ANSIBLE_VAULT"
+    )
+
+    config.get_env_by_name("stage")["postgres_password"] = "CHANGED"
+    config.invalidate(config.get_env_by_name("stage"))
+    assert config.get_env_as_dict("stage")["postgres_password"] == "CHANGED"
+
+
+def test_env_dicts_are_read_only():
+    config = SecretYAML(filepath=TEST_YAML_1_PATH)
+    dev_dict = config.get_env_as_dict("dev")
+    with pytest.raises(ReadOnlyViewError):
+        dev_dict["postgres_password"] = "CHANGED"
+    with pytest.raises(ReadOnlyViewError):
+        dev_dict["allowed_hosts"].append("example.com")
+    with pytest.raises(ReadOnlyViewError):
+        dev_dict["POSTGRES"].update({"db_name": "CHANGED"})
+
+    copied = dev_dict.copy()
+    copied["postgres_password"] = "CHANGED"
+    assert config.get_env_as_dict("dev")["postgres_password"] == "DEVELOPMENT_PASSWORD"
+    assert pickle.loads(pickle.dumps(dev_dict)) == dev_dict
+
+
+def test_layered_env_matches_merged_env():
+    config = SecretYAML(filepath=TEST_YAML_1_PATH)
+    for env in ["dev", "stage", "prod"]:
+        layered = config.get_env_as_dict(env, layered=True)
+        assert layered == config.get_env_as_dict(env)
+        assert config.get_env_as_dict(env, layered=True) is layered
+
+    prod = config.get_env_as_dict("prod", layered=True)
+    assert prod["POSTGRES"] == {"db_name": "hoiusdahoias", "db_password": "kjnasndasnlk"}
+    assert prod["allowed_hosts"] is config.get_env_as_dict("prod", False)["allowed_hosts"]
+
+    replaced = config.get_env_as_dict("prod", strategies={"POSTGRES": "replace"})
+    assert replaced["POSTGRES"] == {"db_password": "kjnasndasnlk"}
+
+
+def test_env_inheritance_chain():
+    config = SecretYAML(filepath=INHERITANCE_CHAIN_PATH)
+    assert config.get_env_chain("prod-eu-canary") == [
+        "prod-base",
+        "prod-eu",
+        "prod-eu-canary",
+    ]
+    assert config.get_env_as_dict("prod-eu-canary") == {
+        "debug": True,
+        "timeout": 30,
+        "allowed_hosts": ["example.com"],
+        "POSTGRES": {"db_name": "app", "db_port": 5432, "db_host": "prod-eu-db"},
+        "api_key": "DEFAULT_KEY",
+        "postgres_password": "PROD_PASSWORD",
+        "region": "eu",
+    }
+    assert "__extends__" not in config.get_env_as_dict("prod-eu", use_default=False)
+    assert config.get_env_as_dict(
+        "prod-eu-canary", layered=True
+    ) == config.get_env_as_dict("prod-eu-canary")
+
+
+def test_env_inheritance_shares_ancestor_snapshots():
+    """
+    Test if sibling envs are merged over the same memoized parent snapshot,
+    and a change to the parent reaches its descendants only.
+    """
+    config = SecretYAML(filepath=INHERITANCE_CHAIN_PATH)
+    eu = config.get_env_as_dict("prod-eu")
+    us = config.get_env_as_dict("prod-us")
+    base = config.get_env_as_dict("prod-base")
+    assert eu["allowed_hosts"] is base["allowed_hosts"]
+    assert us["POSTGRES"] is base["POSTGRES"]
+
+    config.encrypt_env("prod-base", TEST_PASSWORD_1)
+    assert config.get_env_as_dict("prod-eu-canary")["postgres_password"].startswith(
+        "$ANSIBLE_VAULT"
+    )
+    assert config.get_env_as_dict("prod-us")["postgres_password"].startswith(
+        "$ANSIBLE_VAULT"
+    )
+
+
+def test_env_inheritance_cycle():
+    with pytest.raises(EnvironmentInheritanceCycle):
+        SecretYAML(filepath=INHERITANCE_CYCLE_PATH)
+
+
+def test_missing_required_keys_reported_per_env():
+    """
+    Test if every env missing a !required key of the default section is
+    reported at once, keys defined by an extended env counting as defined.
+    """
+    config = SecretYAML(filepath=REQUIRED_PATH)
+    assert config.missing_required_keys() == {
+        "base": ["DATABASES.default.PASSWORD"],
+        "stage": ["DATABASES.default.PASSWORD"],
+        "prod": ["SECRET_KEY", "DATABASES.default.PASSWORD"],
+    }
+    assert config.missing_required_keys(["dev"]) == {}
+    config.validate_required(["dev"])
+
+    with pytest.raises(RequiredKeysMissing) as e:
+        config.validate_required()
+    assert e.value.missing["prod"] == ["SECRET_KEY", "DATABASES.default.PASSWORD"]
+
+
+def test_labelled_values_decrypt_with_vault_id_match(monkeypatch):
+    """
+    Test if labelled and unlabelled values still decrypt when ansible only
+    tries the secret matching the header label, ANSIBLE_VAULT_ID_MATCH.
+    """
+    import ansible.constants
+
+    monkeypatch.setattr(ansible.constants, "DEFAULT_VAULT_ID_MATCH", True)
+    config = SecretYAML(filepath=TEST_YAML_1_PATH)
+    config.encrypt_env("dev", TEST_PASSWORD_1)
+    config.encrypt_default(TEST_PASSWORD_1)
+    assert ";dev|" in config.get_env_as_dict("dev", use_default=False)["postgres_password"]
+
+    config.decrypt_env("dev", TEST_PASSWORD_1)
+    config.decrypt_default(TEST_PASSWORD_1)
+    assert config.get_env_as_dict("dev")["postgres_password"] == "DEVELOPMENT_PASSWORD"
+    assert config.get_env_as_dict("dev")["google_secret_key"] == "TEST_KEY"
+
+
 def test_yml_file_doesnt_exist():
     with pytest.raises(FileNotFoundError):
         config = SecretYAML(filepath="does_not_exist.yml")
@@ -423,10 +699,114 @@ def test_various_type_roundtrip():
     assert default_config_dict == expected_default_config_dict
 
 
-# def test_envrion():
-#     config = SecretYAML(filepath=TEST_YAML_12_PATH)
-#     config.patch_environs('dev')
+def test_null_and_date_values_are_returned_as_they_are(capsys):
+    """
+    Test if scalars without a dedicated branch, null and dates, are returned
+    untouched and nothing is printed while converting them.
+    """
+    import datetime
 
-# TODO:
-# add environment variable overrides via django-environs, with nested structure support
-# any variables with all uppercase
+    config_path = tempfile.NamedTemporaryFile(
+        "w", prefix="temp-scalars", suffix=".yml", delete=False
+    )
+    config_path.write(
+        "version: 1.0\n!default common:\n  empty: null\n  released: 2024-05-01\n"
+        "  ENVIRONMENT: !required\n\n!env dev:\n  ENVIRONMENT: dev\n"
+    )
+    config_path.close()
+    for mode in ["roundtrip", "read"]:
+        config = SecretYAML(filepath=config_path.name, mode=mode)
+        settings = config.get_env_as_dict("dev")
+        assert settings["empty"] is None
+        assert settings["released"] == datetime.date(2024, 5, 1)
+    assert capsys.readouterr().out == ""
+
+
+def test_environ_overlay_applies_nested_typed_overrides():
+    """
+    Test if environment variables, and the .env file beneath them, override
+    nested keys with the type of the YAML value they replace.
+    """
+    config = SecretYAML(filepath=path_from_fixtures("fixtures/environ/overlay_01.yml"))
+    env_file = tempfile.NamedTemporaryFile(
+        "w", prefix="temp-env", suffix=".env", delete=False
+    )
+    env_file.write("# overrides\nexport TIMEOUT=45\nENV='stage'\nDEBUG=false\n")
+    env_file.close()
+    overlay = EnvironOverlay(
+        environ={
+            "DEBUG": "on",
+            "SAMPLE_RATE": "0.25",
+            "ALLOWED_HOSTS": "example.com,www.example.com",
+            "PORTS": "80,443",
+            "DATABASES__default__PORT": "6432",
+            "DATABASES__replica__HOST": "replica",
+            "FEATURE_LIMITS": "uploads=20,exports=5",
+            "PATH": "/usr/bin",
+        },
+        env_file=env_file.name,
+    )
+    defaults = config.get_env_as_dict("dev")
+    settings = overlay.apply(defaults)
+
+    assert settings["DEBUG"] is True
+    assert settings["TIMEOUT"] == 45
+    assert settings["SAMPLE_RATE"] == 0.25
+    assert settings["ENV"] == "stage"
+    assert settings["ALLOWED_HOSTS"] == ["example.com", "www.example.com"]
+    assert settings["PORTS"] == [80, 443]
+    assert settings["DATABASES"] == {"default": {"HOST": "localhost", "PORT": 6432}}
+    assert settings["FEATURE_LIMITS"] == {"uploads": 20, "exports": "5"}
+    assert "PATH" not in settings
+    # the memoized view is left alone
+    assert defaults["DATABASES"]["default"]["PORT"] == 5432
+
+    with pytest.raises(InvalidEnvironOverride):
+        EnvironOverlay(environ={"TIMEOUT": "soon"}, env_file="").apply(defaults)
+
+
+def test_patch_environs_configures_settings_once(monkeypatch):
+    """
+    Test if patching settings from the environment can be repeated without
+    configuring django settings again.
+    """
+    from django.conf import settings
+    import eyaml.environ_helper as environ_helper
+
+    monkeypatch.setenv("TIMEOUT", "60")
+    environ_helper.reset_overlay()
+    configure_calls = []
+    configure = type(settings).configure
+
+    def counting_configure(self, *args, **kwargs):
+        configure_calls.append(args)
+        return configure(self, *args, **kwargs)
+
+    monkeypatch.setattr(type(settings), "configure", counting_configure)
+    config = SecretYAML(filepath=path_from_fixtures("fixtures/environ/overlay_01.yml"))
+    for _ in range(3):
+        resolved = config.patch_environs("dev")
+    environ_helper.reset_overlay()
+
+    assert resolved["TIMEOUT"] == 60
+    assert settings.TIMEOUT == 60
+    # plain dicts django can write to
+    settings.DATABASES["default"]["PORT"] = 1
+    patched = config.patch_object_with_env({}, "dev")
+    patched["DATABASES"]["default"]["PORT"] = 2
+    assert config.get_env_as_dict("dev")["DATABASES"]["default"]["PORT"] == 5432
+    # at most once, an earlier test may have configured them already
+    assert len(configure_calls) <= 1
+
+
+def test_encryption_errors_are_logged_not_printed(capsys, caplog):
+    """
+    Test if a failed encryption is reported through the eyaml logger, leaving
+    stdout to the application.
+    """
+    from eyaml.utils import encrypt_value
+
+    with pytest.raises(AnsibleVaultError):
+        encrypt_value("value", None, "key")
+    assert capsys.readouterr().out == ""
+    assert "Error during encryption" in caplog.text